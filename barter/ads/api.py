@@ -1,10 +1,177 @@
+from django.conf import settings
+from django.db import transaction
 from django.urls import path, include
+from django.utils import timezone
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.routers import DefaultRouter
-from .views import AdViewSet
+from rest_framework.views import APIView
+
+from . import percolator
+from .models import Ad, Category
+from .serializers import AdSerializer, BulkResponseSerializer
+from .signals import bulk_changed, suspended
+from .views import AdViewSet, BarterCycleViewSet, ExchangeProposalViewSet, SavedSearchViewSet
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def persist_categories(ads):
+    """Сохраняет новые категории объявлений, по одной на slug (в транзакции записи)"""
+    saved = {}
+    for ad in ads:
+        if ad.category.pk is None:
+            if ad.category.slug not in saved:
+                saved[ad.category.slug] = Category.objects.persist(ad.category)
+            ad.category = saved[ad.category.slug]
+
+
+CHUNK_SIZE_PARAMETER = OpenApiParameter(
+    'chunk_size', int, description='Сколько строк записывать одним запросом к БД',
+)
+
+
+class AdBulkView(APIView):
+    """Массовые операции с объявлениями текущего пользователя.
+
+    ``POST`` создаёт объявления из массива, ``PATCH`` меняет объявления из
+    массива с полем ``id``, ``DELETE`` удаляет объявления по массиву id.
+    Каждый элемент проверяется ``AdSerializer``, корректные записываются
+    пачками по ``chunk_size`` строк в одной транзакции, ошибочные
+    пропускаются. Ответ — результат для каждого элемента в порядке запроса.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_chunk_size(self):
+        try:
+            chunk_size = int(self.request.query_params['chunk_size'])
+        except (KeyError, ValueError):
+            return settings.ADS_BULK_CHUNK_SIZE
+        return min(max(chunk_size, 1), settings.ADS_BULK_MAX_ITEMS)
+
+    def get_items(self):
+        items = self.request.data
+        if not isinstance(items, list):
+            raise ValidationError('Ожидается массив.')
+        if len(items) > settings.ADS_BULK_MAX_ITEMS:
+            raise ValidationError(f'Не больше {settings.ADS_BULK_MAX_ITEMS} элементов за запрос.')
+        return items
+
+    def get_serializer(self, **kwargs):
+        # Общий кэш категорий: одна и та же категория не ищется в БД для каждого элемента
+        context = {'request': self.request, 'view': self, 'categories': {}}
+        return AdSerializer(context=context, **kwargs)
+
+    @staticmethod
+    def validate(serializer, item):
+        """Данные элемента или ошибки: один сериализатор на весь запрос, как в ListSerializer"""
+        try:
+            return serializer.run_validation(item), None
+        except ValidationError as exc:
+            return None, exc.detail
+
+    def get_ads(self, ids):
+        """Объявления пользователя по id одним запросом на пачку"""
+        ids = [pk for pk in ids if is_id(pk)]
+        ads = {}
+        for chunk in chunks(ids, self.get_chunk_size()):
+            ads.update(Ad.objects.filter(user=self.request.user).select_related('category').in_bulk(chunk))
+        return ads
+
+    @extend_schema(request=AdSerializer(many=True), responses=BulkResponseSerializer,
+                   parameters=[CHUNK_SIZE_PARAMETER])
+    def post(self, request):
+        serializer = self.get_serializer()
+        results, ads = [], []
+        for item in self.get_items():
+            data, errors = self.validate(serializer, item)
+            if errors is None:
+                ad = Ad(user=request.user, **data)
+                ads.append(ad)
+                results.append(ad)
+            else:
+                results.append({'id': None, 'status': 'error', 'errors': errors})
+        with transaction.atomic():
+            persist_categories(ads)
+            Ad.objects.bulk_create(ads, batch_size=self.get_chunk_size())
+            bulk_changed(added=ads)
+            percolator.percolate_later(ads)
+        results = [
+            {'id': result.pk, 'status': 'created'} if isinstance(result, Ad) else result
+            for result in results
+        ]
+        return Response({'results': results})
+
+    @extend_schema(request=AdSerializer(many=True), responses=BulkResponseSerializer,
+                   parameters=[CHUNK_SIZE_PARAMETER])
+    def patch(self, request):
+        items = self.get_items()
+        ads = self.get_ads([item.get('id') for item in items if isinstance(item, dict)])
+        serializer = self.get_serializer(partial=True)
+        results, changed, previous, fields, seen = [], [], [], {'updated_at'}, set()
+        now = timezone.now()
+        for item in items:
+            pk = item.get('id') if isinstance(item, dict) else None
+            ad = ads.get(pk) if is_id(pk) else None
+            if ad is None:
+                results.append({'id': pk if is_id(pk) else None, 'status': 'not_found'})
+                continue
+            if pk in seen:
+                results.append({'id': pk, 'status': 'error', 'errors': {'id': ['Объявление повторяется в запросе.']}})
+                continue
+            seen.add(pk)
+            data, errors = self.validate(serializer, item)
+            if errors is not None:
+                results.append({'id': pk, 'status': 'error', 'errors': errors})
+                continue
+            # Копия с прежними категорией и состоянием — для пересчёта фасетов
+            previous.append(Ad(category=ad.category, condition=ad.condition))
+            for name, value in data.items():
+                setattr(ad, name, value)
+            ad.updated_at = now  # bulk_update не обновляет auto_now-поля
+            fields.update(data)
+            changed.append(ad)
+            results.append({'id': pk, 'status': 'updated'})
+        with transaction.atomic():
+            persist_categories(changed)
+            Ad.objects.bulk_update(changed, sorted(fields), batch_size=self.get_chunk_size())
+            bulk_changed(added=changed, removed=previous)
+        return Response({'results': results})
+
+    @extend_schema(request=serializers.ListField(child=serializers.IntegerField()),
+                   responses=BulkResponseSerializer, parameters=[CHUNK_SIZE_PARAMETER])
+    def delete(self, request):
+        ids = self.get_items()
+        ads = self.get_ads(ids)
+        with transaction.atomic(), suspended():
+            for chunk in chunks(list(ads), self.get_chunk_size()):
+                Ad.objects.filter(pk__in=chunk).delete()
+            bulk_changed(removed=list(ads.values()))
+        results = [
+            {'id': pk if is_id(pk) else None, 'status': 'deleted' if is_id(pk) and pk in ads else 'not_found'}
+            for pk in ids
+        ]
+        return Response({'results': results})
+
 
 router = DefaultRouter()
 router.register(r'ads', AdViewSet, basename='ad')
+router.register(r'cycles', BarterCycleViewSet, basename='cycle')
+router.register(r'proposals', ExchangeProposalViewSet, basename='proposal')
+router.register(r'searches', SavedSearchViewSet, basename='saved-search')
 
 urlpatterns = [
+    # До маршрутов роутера, иначе «bulk» примется за id объявления
+    path('ads/bulk/', AdBulkView.as_view(), name='ad-bulk'),
     path('', include(router.urls)),
-]
\ No newline at end of file
+]
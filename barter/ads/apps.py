@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def repair_search_index(sender, using, **kwargs):
+    # Миграции SQLite пересоздают таблицу объявлений без её триггеров,
+    # поэтому после каждого migrate индекс поиска проверяется заново
+    from .search import get_backend
+    get_backend(using).repair()
 
 
 class AdsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ads'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        import core.metrics  # noqa: F401  Счётчик запросов к БД для новых соединений
+        import core.sqlite  # noqa: F401  Прагмы SQLite для новых соединений
+        post_migrate.connect(repair_search_index, sender=self)
@@ -0,0 +1,243 @@
+"""Асинхронные версии страниц и API для чтения (``core.urls_async``, ``BARTER_ASYNC_VIEWS=1``).
+
+Наследуют синхронные view; асинхронными сделаны только обращения к БД.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.contrib.messages import get_messages
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from . import conditional, cycles, events, recommendations, viewcounts
+from .facets import afacet_counts
+from .fieldsets import FieldSet, RowBuilder
+from .forms import AdFilterForm
+from .models import Ad
+from .pagination import AdKeysetPagination, InvalidCursor, KeysetPaginator
+from .serializers import AdSerializer
+from .views import AdDetailView, AdListView, AdViewSet, ExchangeProposalListView, ReplicaReadMixin
+
+
+class AsyncUserMixin:
+    """Загружает пользователя асинхронно до проверок доступа.
+
+    Синхронные миксины (``LoginRequiredMixin``) и шаблоны читают
+    ``request.user``; ленивый объект обратился бы к БД синхронно.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+
+async def fetch(queryset):
+    return [obj async for obj in queryset.aiterator()]
+
+
+class AdListAsyncView(AsyncUserMixin, AdListView):
+    """Асинхронная версия ``AdListView``"""
+
+    async def get(self, request, *args, **kwargs):
+        cache_key = self.get_cache_key()
+        response = self.get_cached_response(cache_key)
+        if response is None:
+            response = self.cache_response(await self.render_page(), cache_key)
+        return response
+
+    async def render_page(self):
+        self.object_list = queryset = self.get_queryset()
+        page_size = self.get_paginate_by(queryset)
+        if self.use_cursor_pagination():
+            paginator = KeysetPaginator(queryset, page_size, self.get_ordering())
+            try:
+                page_queryset, position, reverse = paginator.page_queryset(self.request.GET.get('cursor'))
+            except InvalidCursor:
+                raise Http404("Некорректный курсор страницы.")
+            page = paginator.build_page(await fetch(page_queryset), position, reverse)
+        else:
+            paginator = self.get_paginator(queryset, page_size)
+            paginator.count = await queryset.acount()  # Дальше Paginator не обращается к БД
+            page = self.get_page(paginator)
+            page.object_list = await fetch(page.object_list)
+        context = {
+            'view': self,
+            'paginator': paginator,
+            'page_obj': page,
+            'is_paginated': page.has_other_pages(),
+            'object_list': page.object_list,
+            self.context_object_name: page.object_list,
+        }
+        context.update(self.get_list_context(page.object_list, await afacet_counts()))
+        return self.render_to_response(context)
+
+    def get_page(self, paginator):
+        # Та же обработка номера страницы, что в MultipleObjectMixin.paginate_queryset
+        page = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        try:
+            page_number = int(page)
+        except ValueError:
+            if page != 'last':
+                raise Http404("Некорректный номер страницы.")
+            page_number = paginator.num_pages
+        try:
+            return paginator.page(page_number)
+        except InvalidPage as exc:
+            raise Http404(f"Некорректная страница ({page_number}): {exc}")
+
+
+class AdDetailAsyncView(AsyncUserMixin, AdDetailView):
+    """Асинхронная версия ``AdDetailView``"""
+
+    async def get(self, request, *args, **kwargs):
+        validate = not get_messages(request)
+        version = await conditional.aad_version(kwargs['pk']) if validate else None
+        if version is not None:
+            etag = self.get_etag(version)
+            response = conditional.precondition_response(request, etag, version)
+            if response is not None:
+                await viewcounts.arecord(kwargs['pk'])
+                return conditional.set_validators(response, etag, version)
+        try:
+            self.object = await self.get_queryset().aget(pk=kwargs['pk'])
+        except Ad.DoesNotExist:
+            raise Http404("Объявление не найдено.")
+        self.similar_ads = await sync_to_async(recommendations.similar_ads)(self.object)
+        response = self.render_to_response(self.get_context_data(object=self.object))
+        await viewcounts.arecord(self.object.pk)
+        if validate:
+            version = conditional.version_of(self.object)
+            conditional.set_validators(response, self.get_etag(version), version)
+        return response
+
+
+class ExchangeProposalListAsyncView(AsyncUserMixin, ExchangeProposalListView):
+    """Асинхронная версия ``ExchangeProposalListView``"""
+
+    async def get(self, request, *args, **kwargs):
+        self.object_list = await fetch(self.get_queryset())
+        self.barter_cycles = cycles.group_steps(await fetch(cycles.user_steps(request.user)))
+        return self.render_to_response(self.get_context_data())
+
+
+def release_connections():
+    for db in connections.all(initialized_only=True):
+        if not db.in_atomic_block:  # Внутри транзакции (тесты) закрытие лишь пометило бы её для отката
+            db.close()
+
+
+class ProposalEventsView(View):
+    """Поток событий предложений пользователя (Server-Sent Events, ``ads.events``).
+
+    Соединение держит только подписку в цикле событий, без потока из пула
+    и без соединения с БД.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return HttpResponse('Требуется вход.', status=401, content_type='text/plain; charset=utf-8')
+        # Django закрывает соединения запроса с БД только после ответа, а поток
+        # длится, пока открыта страница: тысячи подписчиков держали бы тысячи соединений
+        await sync_to_async(release_connections)()
+        response = StreamingHttpResponse(
+            events.stream(user.pk, resync='Last-Event-ID' in request.headers),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx не буферизует поток
+        return response
+
+
+class AdApiAsyncView(ReplicaReadMixin, View):
+    """Чтение API объявлений без DRF-обработки запроса.
+
+    Отвечает JSON так же, как ``AdViewSet`` (те же сериализатор, пагинация
+    и ETag). Запись, браузерный API (``?format=``, ``Accept: text/html``)
+    передаются синхронному ``AdViewSet``.
+    """
+    sync_actions = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # CSRF проверяет DRF при сессионной аутентификации, как в AdViewSet
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        wants_html = 'format' in request.GET or 'text/html' in request.headers.get('Accept', '')
+        if request.method not in ('GET', 'HEAD') or wants_html:
+            sync_view = AdViewSet.as_view(self.sync_actions)
+            return await sync_to_async(sync_view)(request, *args, **kwargs)
+        return await super().dispatch(request, *args, **kwargs)
+
+    def render(self, data, status=200):
+        return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+    def not_found(self, detail=NotFound.default_detail):
+        return self.render({'detail': str(detail)}, status=404)
+
+
+class AdApiListAsyncView(AdApiAsyncView):
+    sync_actions = {'get': 'list', 'post': 'create'}
+
+    async def get(self, request):
+        drf_request = Request(request)
+        pagination = AdKeysetPagination()
+        page_size = pagination.get_page_size(drf_request)
+        cursor = request.GET.get(pagination.cursor_query_param)
+        try:
+            fieldset = FieldSet.from_query(request.GET, AdSerializer)
+        except ValidationError as exc:
+            return self.render(exc.detail, status=400)
+        etag = conditional.list_etag(request.GET, page_size, cursor, 'json', *fieldset.variant)
+        response = conditional.precondition_response(request, etag)
+        if response is not None:
+            return conditional.set_validators(response, etag)
+
+        queryset = AdViewSet.queryset.all()
+        form = AdFilterForm(request.GET)
+        if form.is_valid():
+            queryset = form.filter_queryset(queryset)
+        builder = RowBuilder(AdSerializer(context={'fieldset': fieldset}).fields)
+        paginator = KeysetPaginator(builder.queryset(queryset), page_size, form.get_ordering())
+        try:
+            page_queryset, position, reverse = paginator.page_queryset(cursor)
+        except InvalidCursor:
+            return self.not_found('Некорректный курсор.')
+        pagination.request = drf_request
+        pagination.page = paginator.build_page(await fetch(page_queryset), position, reverse)
+        data = pagination.get_paginated_response(builder.rows(pagination.page.object_list)).data
+        return conditional.set_validators(self.render(data), etag)
+
+
+class AdApiDetailAsyncView(AdApiAsyncView):
+    sync_actions = {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}
+
+    async def get(self, request, pk):
+        try:
+            fieldset = FieldSet.from_query(request.GET, AdSerializer)
+        except ValidationError as exc:
+            return self.render(exc.detail, status=400)
+        version = await conditional.aad_version(pk)
+        if version is None:
+            return self.not_found()
+        etag = conditional.ad_etag(pk, version, 'json', *fieldset.variant)
+        response = conditional.precondition_response(request, etag, version)
+        if response is None:
+            try:
+                ad = await fieldset.apply(AdViewSet.queryset).aget(pk=pk)
+            except Ad.DoesNotExist:
+                return self.not_found()
+            response = self.render(AdSerializer(ad, context={'fieldset': fieldset}).data)
+            version = conditional.version_of(ad)
+            etag = conditional.ad_etag(pk, version, 'json', *fieldset.variant)
+        return conditional.set_validators(response, etag, version)
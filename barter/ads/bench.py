@@ -0,0 +1,194 @@
+"""Общие инструменты для бенчмарков (команды ``manage.py bench_*``).
+
+Бенчмарки наполняют базу синтетическими данными внутри транзакции и
+откатывают её в конце, поэтому их можно запускать на рабочей копии БД.
+``seed`` создаёт постоянный набор данных для ``seed_barter``.
+"""
+import datetime
+import random
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import caching, counters, facets
+from .models import Ad, Category, ExchangeProposal, ProposalEdge
+
+WORDS = [
+    'велосипед', 'самокат', 'телефон', 'ноутбук', 'книга', 'гитара', 'диван', 'стол', 'стул', 'лампа',
+    'куртка', 'ботинки', 'рюкзак', 'палатка', 'коляска', 'кресло', 'шкаф', 'часы', 'камера', 'объектив',
+    'плеер', 'наушники', 'колонка', 'монитор', 'клавиатура', 'мышь', 'принтер', 'планшет', 'игрушка',
+    'конструктор', 'пазл', 'сноуборд', 'лыжи', 'коньки', 'мяч', 'ракетка', 'удочка', 'инструмент',
+    'дрель', 'пила', 'молоток', 'картина', 'ваза', 'посуда', 'чайник', 'микроволновка', 'пылесос',
+    'утюг', 'зеркало', 'ковёр', 'новый', 'старый', 'красный', 'синий', 'зелёный', 'большой', 'маленький',
+    'детский', 'спортивный', 'кожаный', 'деревянный', 'металлический', 'отличный', 'рабочий', 'редкий',
+]
+CATEGORIES = ['Электроника', 'Спорт', 'Книги', 'Мебель', 'Одежда', 'Детские товары', 'Инструменты', 'Дом']
+
+
+class Rollback(Exception):
+    """Служебное исключение для отката транзакции бенчмарка"""
+
+
+@contextmanager
+def rollback(using='default'):
+    """Выполняет блок в транзакции и всегда откатывает её"""
+    try:
+        with transaction.atomic(using=using):
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def sentence(rng, min_words, max_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_ads(count, seed=0, user=None, batch_size=1000):
+    """Создаёт ``count`` объявлений со случайными текстами через bulk_create"""
+    rng = random.Random(seed)
+    if user is None:
+        user, _ = User.objects.get_or_create(username='bench')
+    categories = [Category.objects.resolve(name) for name in CATEGORIES]
+    for start in range(0, count, batch_size):
+        ads = Ad.objects.bulk_create([
+            Ad(
+                user=user,
+                title=sentence(rng, 2, 5).capitalize(),
+                description=sentence(rng, 10, 40),
+                category=rng.choice(categories),
+                condition=rng.choice(['new', 'used']),
+            )
+            for _ in range(min(batch_size, count - start))
+        ], batch_size=batch_size)
+        facets.adjust_counts(*facets.count_ads(ads))  # bulk_create не вызывает сигналы
+    caching.invalidate_all()
+    return user
+
+
+def make_categories(count):
+    """Первые ``count`` категорий: основные из CATEGORIES, затем вложенные в них"""
+    categories = [Category.objects.resolve(name) for name in CATEGORIES[:count]]
+    for number in range(count - len(categories)):
+        parent = categories[number % len(CATEGORIES)]
+        category = Category.objects.resolve(f'{parent.name} {number // len(CATEGORIES) + 1}')
+        if category.parent_id != parent.pk:
+            category.parent = parent
+            category.save(update_fields=['parent'])
+        categories.append(category)
+    return categories
+
+
+def batches(count, batch_size):
+    for start in range(0, count, batch_size):
+        yield range(start, min(start + batch_size, count))
+
+
+def seed(users, ads, categories, proposals, seed=0, prefix='seed', batch_size=5000, progress=None):
+    """Детерминированный набор данных: пользователи, категории, объявления, предложения.
+
+    Тексты, категории, владельцы и пары предложений зависят только от
+    ``seed``; строки пишутся ``bulk_create`` пачками по ``batch_size``,
+    счётчики фасетов и предложений пересчитываются один раз в конце.
+    """
+    rng = random.Random(seed)
+    progress = progress or (lambda message: None)
+    password = make_password('barter')  # Один хеш на всех: хеширование дорогое
+    user_ids = []
+    for batch in batches(users, batch_size):
+        created = User.objects.bulk_create([
+            User(username=f'{prefix}{number}', password=password, email=f'{prefix}{number}@example.com')
+            for number in batch
+        ])
+        user_ids += [user.pk for user in created]
+    progress(f'Пользователей: {len(user_ids)}')
+
+    category_ids = [category.pk for category in make_categories(categories)]
+    progress(f'Категорий: {len(category_ids)}')
+
+    ad_owners = []  # (id объявления, id владельца) для предложений
+    for batch in batches(ads, batch_size):
+        created = Ad.objects.bulk_create([
+            Ad(
+                user_id=rng.choice(user_ids),
+                title=sentence(rng, 2, 5).capitalize(),
+                description=sentence(rng, 10, 40),
+                image_url=f'https://example.com/images/{number}.jpg' if rng.random() < 0.3 else None,
+                category_id=rng.choice(category_ids),
+                condition=rng.choice(['new', 'used']),
+            )
+            for number in batch
+        ])
+        ad_owners += [(ad.pk, ad.user_id) for ad in created]
+        progress(f'Объявлений: {len(ad_owners)}')
+
+    now = timezone.now()
+    statuses = ['pending'] * 3 + ['accepted', 'rejected']
+    created_proposals = 0
+    for batch in batches(proposals if len(user_ids) > 1 else 0, batch_size):
+        batch_proposals, users = [], []
+        for _ in batch:
+            sender, receiver = rng.sample(ad_owners, 2)
+            while sender[1] == receiver[1]:
+                receiver = rng.choice(ad_owners)
+            users.append((sender[1], receiver[1]))
+            batch_proposals.append(ExchangeProposal(
+                ad_sender_id=sender[0],
+                ad_receiver_id=receiver[0],
+                comment=sentence(rng, 3, 12).capitalize(),
+                status=rng.choice(statuses),
+                created_at=now - datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+            ))
+        ExchangeProposal.objects.bulk_create(batch_proposals)
+        # bulk_create не вызывает сигналы: рёбра графа обменов (ads.cycles) создаём сами
+        ProposalEdge.objects.bulk_create([
+            ProposalEdge(proposal=proposal, source_user_id=source, target_user_id=target)
+            for proposal, (source, target) in zip(batch_proposals, users) if proposal.status == 'pending'
+        ])
+        created_proposals += len(batch_proposals)
+        progress(f'Предложений: {created_proposals}')
+
+    facets.recount()
+    counters.reconcile(batch_size)
+    caching.invalidate_all()
+    return {'users': len(user_ids), 'categories': len(category_ids), 'ads': len(ad_owners),
+            'proposals': created_proposals}
+
+
+def measure(func, repeat):
+    """Вызывает ``func`` ``repeat`` раз и возвращает длительности в секундах"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Сводка по длительностям в миллисекундах"""
+    return {
+        'mean': statistics.fmean(samples) * 1000,
+        'p50': percentile(samples, 50) * 1000,
+        'p95': percentile(samples, 95) * 1000,
+        'p99': percentile(samples, 99) * 1000,
+    }
+
+
+def format_summary(name, samples):
+    stats = summarize(samples)
+    return (
+        f"{name:<32} mean {stats['mean']:8.2f} ms   p50 {stats['p50']:8.2f} ms   "
+        f"p95 {stats['p95']:8.2f} ms   p99 {stats['p99']:8.2f} ms"
+    )
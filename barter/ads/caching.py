@@ -0,0 +1,181 @@
+"""Кэш страниц списка для анонимных посетителей и фрагментов объявлений.
+
+Страницы сбрасываются сменой поколений их областей «категория/состояние»
+(``invalidate_scopes``), фрагменты — сменой версии объявления в ключе (``fragment_key``).
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import category_slug
+from .search import tokenize
+
+PREFIX = 'ads:list'
+EPOCH = 'epoch'  # Общее поколение: сбрасывает все страницы разом
+POPULARITY = 'popularity'  # Поколение порядка ?ordering=popular: меняется с пересчётом оценок
+
+
+def timeout():
+    return getattr(settings, 'ADS_LIST_CACHE_TIMEOUT', 0)
+
+
+def make_key(*parts, prefix=PREFIX):
+    """Ключ кэша из ``parts``: хеш, потому что слаги и слова бывают кириллическими,
+    а memcached принимает только ASCII"""
+    digest = hashlib.md5(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+    return f'{prefix}:{digest}'
+
+
+def generation_key(category=None, condition=None):
+    return make_key('generation', category, condition)
+
+
+def affected_scopes(category, condition):
+    """Области, в которые попадает объявление с данными категорией и состоянием"""
+    return [(None, None), (category, None), (None, condition), (category, condition)]
+
+
+def get_generations(keys):
+    """Текущие поколения; отсутствующие заводятся от текущего времени.
+
+    Начальное значение из ``time_ns`` больше любого поколения, которое могло
+    быть вытеснено из кэша, поэтому старые страницы не оживут.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            initial = time.time_ns()
+            cache.add(key, initial, None)
+            generations[key] = cache.get(key, initial)
+    return [generations[key] for key in keys]
+
+
+def bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), None)
+
+
+def invalidate_scopes(*facets):
+    """Сбрасывает страницы областей объявлений с парами ``(slug категории, состояние)``"""
+    keys = {generation_key(*scope) for category, condition in facets for scope in affected_scopes(category, condition)}
+    for key in keys:
+        bump(key)
+
+
+def invalidate_all():
+    """Сбрасывает все страницы (например, после массовых изменений без сигналов)"""
+    bump(generation_key(EPOCH))
+
+
+def invalidate_popular():
+    """Сбрасывает страницы с сортировкой по популярности (после ``ads.popularity.rescore``)"""
+    bump(generation_key(POPULARITY))
+
+
+def normalize_params(cleaned_data, page, paginate_by, cursor=None):
+    """Параметры страницы в каноническом виде: разные написания дают один ключ"""
+    category = (cleaned_data.get('category') or '').strip()
+    return {
+        'query': ' '.join(tokenize(cleaned_data.get('query') or '')),
+        'category': category_slug(category) if category else None,
+        'condition': cleaned_data.get('condition') or None,
+        'ordering': cleaned_data.get('ordering') or None,
+        'page': page,
+        'cursor': cursor,
+        'paginate_by': paginate_by,
+    }
+
+
+def list_version(params):
+    """Версия выборки с данными параметрами: меняется при изменении объявлений её области.
+
+    Поисковый запрос только сужает выборку и в область не входит; порядок
+    ``?ordering=popular`` зависит ещё от поколения ``POPULARITY``.
+    """
+    keys = [generation_key(EPOCH), generation_key(params['category'], params['condition'])]
+    if params['ordering'] == 'popular':
+        keys.append(generation_key(POPULARITY))
+    return make_key(sorted(params.items()), get_generations(keys)).rsplit(':', 1)[1]
+
+
+def page_key(params):
+    return make_key('page', list_version(params))
+
+
+def get_page(key):
+    page = cache.get(key)
+    record('hits' if page is not None else 'misses')
+    return page
+
+
+def set_page(key, response):
+    cache.set(key, (response.content, response['Content-Type']), timeout())
+
+
+def record(name):
+    key = f'{PREFIX}:stats:{name}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    """Число попаданий и промахов кэша списка с момента его очистки"""
+    values = cache.get_many([f'{PREFIX}:stats:hits', f'{PREFIX}:stats:misses'])
+    hits = values.get(f'{PREFIX}:stats:hits', 0)
+    misses = values.get(f'{PREFIX}:stats:misses', 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_ratio': hits / total if total else 0.0}
+
+
+# Фрагменты объявлений
+
+ANONYMOUS, OWNER, OTHER = 'anonymous', 'owner', 'other'
+
+
+def fragment_timeout():
+    return getattr(settings, 'ADS_FRAGMENT_CACHE_TIMEOUT', 0)
+
+
+def viewer_relationship(ad, user):
+    """Отношение зрителя к объявлению: от него зависят кнопки во фрагменте"""
+    if not user.is_authenticated:
+        return ANONYMOUS
+    return OWNER if ad.user_id == user.id else OTHER
+
+
+def fragment_key(name, ad, relationship):
+    # Правка меняет updated_at, предложения — counters_version; массовые update() меняют updated_at сами
+    return f'ads:fragment:{name}:{ad.pk}:{ad.updated_at.timestamp()}:{ad.counters_version}:{relationship}'
+
+
+def render_fragments(name, template_name, ads, user):
+    """Пары ``(объявление, html)`` для страницы объявлений.
+
+    Готовые фрагменты читаются одним ``get_many``, недостающие рендерятся
+    и сохраняются одним ``set_many``.
+    """
+    ads = list(ads)
+    relationships = [viewer_relationship(ad, user) for ad in ads]
+    keys = [fragment_key(name, ad, relationship) for ad, relationship in zip(ads, relationships)]
+    timeout = fragment_timeout()
+    cached = cache.get_many(keys) if timeout else {}
+    missing = {}
+    fragments = []
+    for ad, relationship, key in zip(ads, relationships, keys):
+        html = cached.get(key)
+        if html is None:
+            html = missing[key] = render_to_string(template_name, {'ad': ad, 'relationship': relationship})
+        fragments.append((ad, mark_safe(html)))
+    if missing and timeout:
+        cache.set_many(missing, timeout)
+    return fragments
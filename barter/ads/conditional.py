@@ -0,0 +1,95 @@
+"""Условные запросы к объявлениям: ETag, Last-Modified, ответы 304 и 412.
+
+Версия объявления — ``(updated_at, counters_version)``: правка владельцем и
+счётчики предложений (``ads.counters``). Её читает один запрос по первичному
+ключу без остальных колонок, и если версия у клиента совпадает с текущей,
+объявление не загружается и не сериализуется вовсе. ``Last-Modified`` — время
+правки. Тот же ETag в ``If-Match`` защищает изменения через API от
+перезаписи чужой правки; счётчики клиент не меняет, поэтому при записи они
+в сравнении не участвуют (``write_precondition_response``).
+"""
+import hashlib
+import re
+from calendar import timegm
+
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date, parse_etags
+
+from . import caching
+from .forms import AdFilterForm
+from .models import Ad
+
+
+VERSION_FIELDS = ('updated_at', 'counters_version')
+COUNTERS_RE = re.compile(r'-c\d+')  # Версия счётчиков в ETag объявления
+
+
+def version_of(ad):
+    return ad.updated_at, ad.counters_version
+
+
+def ad_version(pk, lock=False):
+    """``(updated_at, counters_version)`` объявления или None, если его нет"""
+    queryset = Ad.objects.select_for_update() if lock else Ad.objects
+    try:
+        return queryset.filter(pk=pk).values_list(*VERSION_FIELDS).first()
+    except (ValueError, ValidationError):
+        return None
+
+
+async def aad_version(pk):
+    """Асинхронная версия ``ad_version``"""
+    try:
+        return await Ad.objects.filter(pk=pk).values_list(*VERSION_FIELDS).afirst()
+    except (ValueError, ValidationError):
+        return None
+
+
+def list_etag(query_params, page_size, cursor, fmt, *variant):
+    """ETag страницы списка API: поколения кэша списка для области фильтра (см. ads.caching)"""
+    form = AdFilterForm(query_params)
+    params = caching.normalize_params(form.cleaned_data if form.is_valid() else {}, None, page_size, cursor)
+    etag = f'ads-{fmt}-{caching.list_version(params)}'
+    if variant:
+        etag += '-' + hashlib.md5(':'.join(map(str, variant)).encode()).hexdigest()[:16]
+    return quote_etag(etag)
+
+
+def ad_etag(pk, version, *variant):
+    """Сильный ETag версии объявления; ``variant`` — от чего ещё зависит ответ"""
+    updated_at, counters_version = version
+    etag = f'ad-{pk}-{int(updated_at.timestamp())}.{updated_at.microsecond:06d}-c{counters_version}'
+    if variant:
+        etag += '-' + hashlib.md5(':'.join(map(str, variant)).encode()).hexdigest()[:16]
+    return quote_etag(etag)
+
+
+def timestamp(updated_at):
+    return timegm(updated_at.utctimetuple())
+
+
+def precondition_response(request, etag, version=None):
+    """Ответ 304 или 412 по заголовкам If-*, либо None, если запрос нужно выполнить"""
+    return get_conditional_response(
+        request, etag=etag, last_modified=timestamp(version[0]) if version else None,
+    )
+
+
+def write_precondition_response(request, etag, version):
+    """``precondition_response`` для изменения: If-Match сравнивается без версии счётчиков.
+
+    Новое предложение к объявлению не делает устаревшим ETag, с которым
+    владелец правит объявление: счётчики правкой не перезаписываются.
+    """
+    current = COUNTERS_RE.sub('', etag, count=1)
+    if_match = parse_etags(request.META.get('HTTP_IF_MATCH', ''))
+    matched = next((tag for tag in if_match if COUNTERS_RE.sub('', tag, count=1) == current), etag)
+    return precondition_response(request, matched, version)
+
+
+def set_validators(response, etag, version=None):
+    response['ETag'] = etag
+    if version:
+        response['Last-Modified'] = http_date(timestamp(version[0]))
+    return response
@@ -0,0 +1,121 @@
+"""Счётчики предложений на объявлениях.
+
+``Ad.received_count`` — входящие предложения, из них ``pending_count``
+ожидающие и ``accepted_count`` принятые; ``sent_count`` — исходящие.
+Списку и API они достаются вместе со строкой объявления, без ``COUNT`` по
+предложениям для каждой карточки.
+
+Счётчики меняются одним ``UPDATE ... SET x = x + CASE id WHEN ... END`` на
+все затронутые объявления в той же транзакции, что и само предложение
+(сигналы для ``save``/``delete``, ``ads.services`` для массовых переходов).
+Вместе со счётчиками растёт ``counters_version``: от него (и от
+``updated_at``) зависят ETag и кэш фрагментов, поэтому закэшированные
+карточки и ответы 304 не показывают старые числа. ``updated_at`` не
+меняется: он означает правку объявления владельцем, и If-Match владельца не
+устаревает от чужого предложения. ``popularity_stale`` отправляет объявление
+на пересчёт популярности (``ads.popularity``). После сбоев или записи в
+обход ORM счётчики пересчитывает ``manage.py reconcile_counters``.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import Greatest
+
+from . import caching
+from .models import Ad, ExchangeProposal
+
+FIELDS = Ad.COUNTER_FIELDS
+STATUS_FIELDS = {'pending': 'pending_count', 'accepted': 'accepted_count'}
+
+
+def proposal_deltas(proposals, sign=1):
+    """{id объявления: Counter(поле: изменение)} от появления (или удаления, ``sign=-1``) предложений"""
+    deltas = defaultdict(Counter)
+    for proposal in proposals:
+        deltas[proposal.ad_sender_id]['sent_count'] += sign
+        deltas[proposal.ad_receiver_id]['received_count'] += sign
+        if proposal.status in STATUS_FIELDS:
+            deltas[proposal.ad_receiver_id][STATUS_FIELDS[proposal.status]] += sign
+    return deltas
+
+
+def status_deltas(changes):
+    """То же для смены статусов: ``[(id объявления-получателя, старый статус, новый статус)]``"""
+    deltas = defaultdict(Counter)
+    for ad_receiver_id, old, new in changes:
+        if old in STATUS_FIELDS:
+            deltas[ad_receiver_id][STATUS_FIELDS[old]] -= 1
+        if new in STATUS_FIELDS:
+            deltas[ad_receiver_id][STATUS_FIELDS[new]] += 1
+    return deltas
+
+
+def adjust(deltas):
+    """Применяет изменения одним UPDATE и сбрасывает кэш списка затронутых объявлений"""
+    deltas = {pk: {name: value for name, value in fields.items() if value} for pk, fields in deltas.items()}
+    deltas = {pk: fields for pk, fields in deltas.items() if fields}
+    if not deltas:
+        return
+    names = sorted({name for fields in deltas.values() for name in fields})
+    changes = {
+        name: Greatest(F(name) + Case(
+            *[When(pk=pk, then=Value(fields[name])) for pk, fields in deltas.items() if name in fields],
+            default=Value(0),
+        ), Value(0))
+        for name in names
+    }
+    ads = Ad.objects.filter(pk__in=list(deltas))
+    ads.update(counters_version=F('counters_version') + 1, popularity_stale=True, **changes)
+    scopes = set(ads.values_list('category__slug', 'condition'))
+    transaction.on_commit(lambda: caching.invalidate_scopes(*scopes))
+
+
+def reconcile(batch_size=1000, progress=None):
+    """Пересчитывает счётчики по таблице предложений пачками объявлений; возвращает число исправленных"""
+    progress = progress or (lambda message: None)
+    fixed, checked, last = 0, 0, 0
+    while True:
+        ids = list(Ad.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        last = ids[-1]
+        with transaction.atomic():
+            changed = recount(ids)
+        fixed += changed
+        checked += len(ids)
+        progress(f'Проверено объявлений: {checked}, исправлено: {fixed}')
+    if fixed:
+        caching.invalidate_all()
+    return fixed
+
+
+def recount(ids):
+    """Сверяет и исправляет счётчики объявлений ``ids``: три запроса на чтение и один на запись"""
+    actual = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+    received = (
+        ExchangeProposal.objects.filter(ad_receiver__in=ids).values('ad_receiver')
+        .annotate(
+            received=Count('pk'),
+            pending=Count('pk', filter=Q(status='pending')),
+            accepted=Count('pk', filter=Q(status='accepted')),
+        ).order_by()
+    )
+    for row in received:
+        actual[row['ad_receiver']].update(
+            received_count=row['received'], pending_count=row['pending'], accepted_count=row['accepted'],
+        )
+    sent = ExchangeProposal.objects.filter(ad_sender__in=ids).values('ad_sender').annotate(sent=Count('pk'))
+    for row in sent.order_by():
+        actual[row['ad_sender']]['sent_count'] = row['sent']
+    changed = []
+    for ad in Ad.objects.filter(pk__in=ids).only('pk', *FIELDS):
+        counts = actual[ad.pk]
+        if any(getattr(ad, name) != counts[name] for name in FIELDS):
+            for name in FIELDS:
+                setattr(ad, name, counts[name])
+            ad.counters_version = F('counters_version') + 1
+            ad.popularity_stale = True
+            changed.append(ad)
+    Ad.objects.bulk_update(changed, [*FIELDS, 'counters_version', 'popularity_stale'])
+    return len(changed)
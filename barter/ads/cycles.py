@@ -0,0 +1,156 @@
+"""Поиск обменов по кругу среди ожидающих предложений.
+
+Ожидающие предложения образуют граф пользователей: ребро A → B значит, что
+A хочет объявление B (``ProposalEdge``). Цикл A → B → C → A — обмен, в котором
+каждый получает желаемое: A — объявление B, B — объявление C, C — объявление A.
+
+Новое ребро A → B замыкает цикл, только если из B есть путь обратно в A,
+поэтому поиск локален и не зависит от размера всего графа:
+
+1. обратный обход из A по индексу ``target_user`` — по одному запросу на
+   уровень, не глубже ``ADS_CYCLE_MAX_LENGTH - 1`` шагов; он же даёт
+   расстояние до A для каждой найденной вершины;
+2. обход в глубину из B по загруженным рёбрам, который идёт только в
+   вершины, откуда A достижим за оставшееся число шагов.
+
+Ребро записывается вместе с предложением, а сам поиск выполняет фоновая
+задача ``ads.find_cycles`` (``ads.jobs``), чтобы не удлинять запрос.
+"""
+from collections import defaultdict
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+
+from . import jobs
+from .models import BarterCycle, BarterCycleStep, ProposalEdge
+
+QUERY_CHUNK_SIZE = 500  # Пользователей в одном IN (...)
+MIN_LENGTH = 3  # Обмен двух пользователей — обычное встречное предложение
+
+
+def incoming_edges(users):
+    """Рёбра (отправитель, получатель, предложение), ведущие к ``users``"""
+    users = list(users)
+    for start in range(0, len(users), QUERY_CHUNK_SIZE):
+        yield from ProposalEdge.objects.filter(target_user__in=users[start:start + QUERY_CHUNK_SIZE]).values_list(
+            'source_user', 'target_user', 'proposal',
+        )
+
+
+def find_cycles(source_user, target_user, max_length=None, limit=None, max_nodes=None):
+    """Циклы, которые замыкает ребро ``source_user → target_user``.
+
+    Возвращает списки id предложений пути ``target_user → … → source_user``
+    (само новое ребро в них не входит). Из нескольких предложений между одной
+    парой пользователей берётся самое раннее.
+    """
+    max_length = max_length or settings.ADS_CYCLE_MAX_LENGTH
+    limit = limit or settings.ADS_CYCLE_MAX_RESULTS
+    max_nodes = max_nodes or settings.ADS_CYCLE_MAX_NODES
+    if source_user == target_user:
+        return []
+
+    # 1. Расстояния до source_user по обратным рёбрам
+    distance = {source_user: 0}
+    forward = defaultdict(dict)  # отправитель -> {получатель: предложение}
+    frontier = [source_user]
+    for depth in range(1, max_length):
+        next_frontier = []
+        for source, target, proposal in incoming_edges(frontier):
+            if forward[source].get(target, proposal) >= proposal:
+                forward[source][target] = proposal
+            if source not in distance:
+                distance[source] = depth
+                next_frontier.append(source)
+        frontier = next_frontier
+        if not frontier or len(distance) > max_nodes:
+            break  # Слишком большая окрестность: ищем только среди найденного
+    if target_user not in distance:
+        return []
+
+    # 2. Пути target_user → source_user длиной от MIN_LENGTH - 1 до max_length - 1 рёбер
+    cycles = []
+    path_users, path_proposals = [target_user], []
+
+    def walk(user, remaining):
+        for next_user, proposal in sorted(forward[user].items(), key=lambda item: item[1]):
+            if len(cycles) >= limit:
+                return
+            if next_user == source_user:
+                if len(path_proposals) + 1 >= MIN_LENGTH - 1:
+                    cycles.append([*path_proposals, proposal])
+            elif next_user not in path_users and distance.get(next_user, max_length) <= remaining - 1:
+                path_users.append(next_user)
+                path_proposals.append(proposal)
+                walk(next_user, remaining - 1)
+                path_users.pop()
+                path_proposals.pop()
+
+    walk(target_user, max_length - 1)
+    return cycles
+
+
+def rotate(proposals):
+    """Цикл, начиная с меньшего id: тот же цикл, найденный с любого ребра, выглядит одинаково"""
+    start = proposals.index(min(proposals))
+    return proposals[start:] + proposals[:start]
+
+
+def record_cycles(proposal_id, source_user, target_user):
+    """Находит и сохраняет циклы с новым ожидающим предложением"""
+    found = {}
+    for path in find_cycles(source_user, target_user):
+        proposals = rotate([proposal_id, *path])
+        found['-'.join(map(str, proposals))] = proposals
+    if not found:
+        return []
+    existing = set(BarterCycle.objects.filter(key__in=found).values_list('key', flat=True))
+    created = []
+    with transaction.atomic():
+        for key, proposals in found.items():
+            if key in existing:
+                continue
+            cycle = BarterCycle.objects.create(key=key)
+            BarterCycleStep.objects.bulk_create([
+                BarterCycleStep(cycle=cycle, proposal_id=proposal_id, position=position)
+                for position, proposal_id in enumerate(proposals)
+            ])
+            created.append(cycle)
+    return created
+
+
+@jobs.task('ads.find_cycles')
+def find_proposal_cycles(proposal):
+    """Задача: циклы с предложением ``proposal``, если оно всё ещё ожидает ответа"""
+    edge = ProposalEdge.objects.filter(pk=proposal).values_list('source_user', 'target_user').first()
+    if edge is None:
+        return []  # Предложение успели принять, отклонить или удалить
+    return record_cycles(proposal, *edge)
+
+
+def forget_proposal(proposal):
+    """Предложение больше не ожидает ответа: убираем ребро и циклы с ним"""
+    forget_proposals([proposal.pk])
+
+
+def forget_proposals(proposal_ids):
+    """То же для набора предложений: запросы на весь набор, а не на каждое"""
+    if not proposal_ids:
+        return
+    deleted, _ = ProposalEdge.objects.filter(proposal__in=proposal_ids).delete()
+    if deleted:  # Циклы есть только у предложений с ребром
+        BarterCycle.objects.filter(steps__proposal__in=proposal_ids).delete()
+
+
+def user_steps(user):
+    """Шаги всех циклов с участием пользователя одним запросом"""
+    cycles = BarterCycle.objects.filter(steps__proposal__ad_sender__user=user).values('id')
+    return BarterCycleStep.objects.filter(cycle__in=cycles).select_related(
+        'cycle', 'proposal__ad_sender__user', 'proposal__ad_receiver__user',
+    ).order_by('cycle_id', 'position')  # По индексу (cycle, position): в порядке нахождения
+
+
+def group_steps(steps):
+    """[(цикл, [шаги по порядку]), ...] из упорядоченных шагов"""
+    return [(cycle, list(cycle_steps)) for cycle, cycle_steps in groupby(steps, key=lambda step: step.cycle)]
@@ -0,0 +1,227 @@
+"""События предложений для открытых страниц (Server-Sent Events).
+
+Вместо опроса списка предложений клиент держит соединение
+``/events/proposals/`` (только под ASGI, ``core.urls_asgi``) и получает
+события о новых предложениях и сменах статуса, в которых он отправитель или
+получатель.
+
+* После коммита записи (``notify``) события уходят в канал (``Channel``).
+  Канал задаётся ``ADS_EVENTS_CHANNEL``: ``LocalChannel`` доставляет их
+  только в концентратор своего процесса. Для нескольких процессов нужен
+  канал через общий брокер (Redis pub/sub, ``LISTEN/NOTIFY`` PostgreSQL):
+  ``publish`` отправляет события в брокер, а ``listen`` в каждом процессе
+  передаёт полученные ``hub.dispatch``.
+* Концентратор (``Hub``) живёт в цикле событий ASGI-процесса и раскладывает
+  события по подпискам пользователей-получателей.
+* У подписки — буфер не больше ``ADS_EVENTS_BUFFER`` событий. Медленный
+  клиент не копит память: при переполнении буфер сбрасывается, и клиент
+  получает событие ``resync`` — перечитать список целиком. То же событие
+  получает переподключившийся клиент (``Last-Event-ID``): история событий
+  не хранится.
+
+Пока в процессе нет подписчиков, ``LocalChannel`` не собирает события, и
+запись предложений не делает лишнего запроса.
+"""
+import asyncio
+import json
+from collections import defaultdict, deque
+from functools import lru_cache, partial
+from itertools import count
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import ExchangeProposal
+
+
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Subscription:
+    """Одно соединение: буфер событий и ожидающий их поток ответа"""
+    __slots__ = ('user_id', 'maxsize', 'buffer', 'waiter', 'lagged')
+
+    def __init__(self, user_id, maxsize):
+        self.user_id, self.maxsize = user_id, maxsize
+        self.buffer = None  # deque создаётся с первым событием: простаивающие соединения его не держат
+        self.waiter = None
+        self.lagged = False
+
+    def push(self, event):
+        if self.lagged:
+            return
+        if self.buffer is None:
+            self.buffer = deque()
+        if len(self.buffer) >= self.maxsize:
+            self.buffer = None  # Клиент всё равно перечитает список
+            self.lagged = True
+        else:
+            self.buffer.append(event)
+        if self.waiter is not None:
+            wake(self.waiter)
+
+    async def get(self, timeout):
+        """События из буфера; пустой список — за ``timeout`` секунд ничего не пришло"""
+        if not self.buffer and not self.lagged:
+            loop = asyncio.get_running_loop()
+            self.waiter = loop.create_future()
+            timer = loop.call_later(timeout, wake, self.waiter)
+            try:
+                await self.waiter
+            finally:
+                timer.cancel()
+                self.waiter = None
+        events, self.buffer = list(self.buffer or ()), None
+        return events
+
+
+class Hub:
+    """Подписки процесса по пользователям; методы вызываются в цикле событий"""
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.loop = None
+        self.ids = count(1)
+
+    def __len__(self):
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def subscribe(self, user_id):
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(user_id, settings.ADS_EVENTS_BUFFER)
+        self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+        if not self.subscriptions:
+            self.loop = None  # Цикл событий мог завершиться (тесты запускают свой на каждый тест)
+
+    def dispatch(self, events):
+        """Раскладывает ``[(получатели, событие)]`` по подпискам получателей"""
+        for users, event in events:
+            event = {**event, 'id': next(self.ids)}
+            for user_id in users:
+                for subscription in self.subscriptions.get(user_id, ()):
+                    subscription.push(event)
+
+    def dispatch_threadsafe(self, events):
+        """``dispatch`` из любого потока (синхронные view выполняются не в цикле событий)"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.dispatch(events)
+        else:
+            loop.call_soon_threadsafe(self.dispatch, events)
+
+
+class Channel:
+    """Доставка событий после коммита в концентраторы процессов"""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.listener = None
+
+    def subscribe(self, user_id):
+        subscription = self.hub.subscribe(user_id)
+        if self.listener is None:
+            self.listener = asyncio.ensure_future(self.listen())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)
+        if not self.hub.subscriptions and self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+
+    def active(self):
+        """Нужно ли собирать события (False — никто их не ждёт)"""
+        return True
+
+    def publish(self, events):
+        """Отправляет ``[(получатели, событие)]``; вызывается из любого потока"""
+        raise NotImplementedError
+
+    async def listen(self):
+        """Передаёт события из брокера в ``self.hub.dispatch``; запускается с первой подпиской"""
+
+
+class LocalChannel(Channel):
+    """Канал в пределах процесса: для разработки и одного ASGI-процесса"""
+
+    def active(self):
+        return self.hub.loop is not None
+
+    def publish(self, events):
+        self.hub.dispatch_threadsafe(events)
+
+
+@lru_cache
+def get_channel():
+    return import_string(settings.ADS_EVENTS_CHANNEL)(Hub())
+
+
+def proposal_events(kind, ids):
+    """События ``kind`` для предложений ``ids`` и их получатели одним запросом"""
+    rows = ExchangeProposal.objects.filter(pk__in=ids).values_list(
+        'pk', 'status', 'ad_sender', 'ad_receiver', 'ad_sender__user', 'ad_receiver__user',
+    )
+    return [
+        ({sender, receiver}, {
+            'type': kind, 'proposal': pk, 'status': status, 'ad_sender': ad_sender, 'ad_receiver': ad_receiver,
+        })
+        for pk, status, ad_sender, ad_receiver, sender, receiver in rows
+    ]
+
+
+def publish(kind, ids):
+    channel = get_channel()
+    if channel.active():
+        channel.publish(proposal_events(kind, ids))
+
+
+def notify(kind, ids):
+    """Публикует события ``kind`` ('created', 'status') для предложений после коммита"""
+    if ids:
+        transaction.on_commit(partial(publish, kind, list(ids)))
+
+
+def encode(event):
+    return f"id: {event['id']}\nevent: proposal\ndata: {json.dumps(event)}\n\n".encode()
+
+
+RESYNC = b'event: resync\ndata: {}\n\n'
+
+
+async def stream(user_id, resync=False):
+    """Тело ответа text/event-stream для пользователя ``user_id``"""
+    channel = get_channel()
+    subscription = channel.subscribe(user_id)
+    try:
+        # Повтор подключения через retry мс; комментарий сразу отправляет заголовки клиенту
+        yield f"retry: {settings.ADS_EVENTS_RETRY_MS}\n: connected\n\n".encode()
+        if resync:
+            yield RESYNC
+        while True:
+            events = await subscription.get(settings.ADS_EVENTS_HEARTBEAT)
+            if subscription.lagged:
+                subscription.lagged = False
+                yield RESYNC
+            elif events:
+                yield b''.join(encode(event) for event in events)
+            else:
+                yield b': ping\n\n'  # Прокси не закрывают соединение как простаивающее
+    finally:
+        channel.unsubscribe(subscription)
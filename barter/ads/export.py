@@ -0,0 +1,126 @@
+"""Потоковая выгрузка объявлений и предложений обмена в CSV или NDJSON.
+
+Строки читаются ``QuerySet.iterator(chunk_size=...)`` в виде кортежей
+``values_list`` и сразу превращаются в байты, поэтому расход памяти не
+зависит от размера таблицы. Сжатие gzip выполняется на лету.
+"""
+import csv
+import datetime
+import json
+import zlib
+
+from .forms import AdFilterForm
+from .models import Ad, ExchangeProposal
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+CHUNK_SIZE = 2000  # Строк на одну выборку из курсора
+BUFFER_SIZE = 64 * 1024  # Байт на одну отдаваемую порцию
+
+# Колонки выгрузки: имя в файле и поле для values_list
+AD_COLUMNS = [
+    ('id', 'id'),
+    ('user', 'user__username'),
+    ('title', 'title'),
+    ('description', 'description'),
+    ('image_url', 'image_url'),
+    ('category', 'category__name'),
+    ('condition', 'condition'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+]
+PROPOSAL_COLUMNS = [
+    ('id', 'id'),
+    ('ad_sender', 'ad_sender_id'),
+    ('ad_receiver', 'ad_receiver_id'),
+    ('sender', 'ad_sender__user__username'),
+    ('receiver', 'ad_receiver__user__username'),
+    ('status', 'status'),
+    ('comment', 'comment'),
+    ('created_at', 'created_at'),
+]
+
+
+def ad_queryset(params):
+    """Объявления с фильтрами главной страницы (``query``, ``category``, ``condition``)"""
+    queryset = Ad.objects.order_by('id')
+    form = AdFilterForm(params)
+    if form.is_valid():
+        queryset = form.filter_queryset(queryset)
+    return queryset
+
+
+def proposal_queryset(params):
+    queryset = ExchangeProposal.objects.order_by('id')
+    if params.get('status'):
+        queryset = queryset.filter(status=params['status'])
+    return queryset
+
+
+EXPORTS = {
+    'ads': (ad_queryset, AD_COLUMNS),
+    'proposals': (proposal_queryset, PROPOSAL_COLUMNS),
+}
+
+
+def rows(queryset, columns, chunk_size=CHUNK_SIZE):
+    values = queryset.values_list(*(field for _, field in columns))
+    for row in values.iterator(chunk_size=chunk_size):
+        yield [value.isoformat() if isinstance(value, datetime.datetime) else value for value in row]
+
+
+class Echo:
+    """Файлоподобный объект для csv.writer: возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([name for name, _ in columns])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(columns, rows):
+    names = [name for name, _ in columns]
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), ensure_ascii=False) + '\n'
+
+
+def buffered(lines, size=BUFFER_SIZE):
+    """Склеивает строки в порции по ``size`` байт: меньше вызовов записи в сокет"""
+    buffer, length = [], 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # Заголовок gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(kind, fmt, params, compress=False, chunk_size=CHUNK_SIZE):
+    """Итератор байтов выгрузки ``kind`` ('ads' или 'proposals') в формате ``fmt``"""
+    get_queryset, columns = EXPORTS[kind]
+    lines = (csv_lines if fmt == 'csv' else ndjson_lines)(columns, rows(get_queryset(params), columns, chunk_size))
+    chunks = buffered(lines)
+    return gzipped(chunks) if compress else chunks
+
+
+def filename(kind, fmt, compress=False):
+    return f'{kind}.{fmt}' + ('.gz' if compress else '')
@@ -0,0 +1,89 @@
+"""Фасеты фильтра объявлений: счётчики по категориям и состояниям.
+
+Счётчики хранятся в ``Category.ad_count`` и ``ConditionCounter`` и
+меняются атомарными ``UPDATE ... SET ad_count = ad_count ± n`` при создании,
+изменении и удалении объявлений (см. ``ads.signals``), поэтому вывод фасетов
+не требует ``GROUP BY`` по всей таблице объявлений.
+"""
+from collections import Counter
+
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from .models import Ad, Category, ConditionCounter
+
+
+def adjust_counts(category_deltas=None, condition_deltas=None):
+    """Применяет изменения счётчиков: ``{category_id: delta}``, ``{condition: delta}``"""
+    for category_id, delta in (category_deltas or {}).items():
+        if delta:
+            Category.objects.filter(pk=category_id).update(ad_count=Greatest(F('ad_count') + delta, 0))
+    for condition, delta in (condition_deltas or {}).items():
+        if delta:
+            updated = ConditionCounter.objects.filter(pk=condition).update(
+                ad_count=Greatest(F('ad_count') + delta, 0)
+            )
+            if not updated and delta > 0:
+                ConditionCounter.objects.get_or_create(condition=condition, defaults={'ad_count': delta})
+
+
+def count_ads(ads):
+    """Дельты счётчиков для набора объявлений (например, после bulk_create)"""
+    category_deltas, condition_deltas = Counter(), Counter()
+    for ad in ads:
+        category_deltas[ad.category_id] += 1
+        condition_deltas[ad.condition] += 1
+    return category_deltas, condition_deltas
+
+
+def recount():
+    """Пересчитывает все счётчики по таблице объявлений (для восстановления после сбоев)"""
+    totals = dict(Ad.objects.values_list('category').annotate(total=Count('id')))
+    for category in Category.objects.only('id', 'ad_count'):
+        total = totals.get(category.id, 0)
+        if category.ad_count != total:
+            Category.objects.filter(pk=category.pk).update(ad_count=total)
+    totals = dict(Ad.objects.values_list('condition').annotate(total=Count('id')))
+    for condition, _ in Ad.CONDITION_CHOICES:
+        ConditionCounter.objects.update_or_create(condition=condition, defaults={'ad_count': totals.get(condition, 0)})
+
+
+def facet_counts():
+    """Фасеты для вывода рядом с фильтром.
+
+    Категории возвращаются деревом (атрибут ``subcategories``), у каждой
+    ``total_count`` — объявления самой категории и её подкатегорий; пустые
+    ветки отбрасываются. Справочник категорий мал, поэтому читается целиком.
+    """
+    return build_facets(list(Category.objects.all()), list(ConditionCounter.objects.order_by('condition')))
+
+
+async def afacet_counts():
+    """Асинхронная версия ``facet_counts``"""
+    categories = [category async for category in Category.objects.all()]
+    counters = [counter async for counter in ConditionCounter.objects.order_by('condition')]
+    return build_facets(categories, counters)
+
+
+def build_facets(categories, counters):
+    by_id = {category.id: category for category in categories}
+    for category in categories:
+        category.subcategories = []
+        category.total_count = category.ad_count
+    roots = []
+    for category in categories:
+        parent = by_id.get(category.parent_id)
+        if parent is not None:
+            parent.subcategories.append(category)
+            parent.total_count += category.ad_count
+        else:
+            roots.append(category)
+    for category in categories:
+        category.subcategories = [child for child in category.subcategories if child.total_count]
+    labels = dict(Ad.CONDITION_CHOICES)
+    conditions = [
+        {'condition': counter.condition, 'label': labels.get(counter.condition, counter.condition),
+         'ad_count': counter.ad_count}
+        for counter in counters
+    ]
+    return {'categories': [category for category in roots if category.total_count], 'conditions': conditions}
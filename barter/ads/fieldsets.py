@@ -0,0 +1,130 @@
+"""Выбор полей ответа API объявлений и быстрый путь для списка.
+
+``?fields=id,title`` оставляет в ответе только перечисленные поля
+``AdSerializer``, ``?expand=user,category`` добавляет вложенные объекты
+(владелец, запись справочника категорий), которые загружаются тем же
+запросом через ``select_related``. Счётчики предложений уже хранятся в строке
+объявления (``ads.counters``), поэтому отдельной загрузки не требуют.
+
+Список API не создаёт модели и не проходит сериализатор для каждой строки:
+``RowBuilder`` один раз сопоставляет полям сериализатора колонки ``values()``
+и преобразования (для строк и чисел — никаких), а затем собирает из каждой
+строки словарь. Результат совпадает с ``AdSerializer(many=True).data``.
+"""
+from django.conf import settings
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+# Колонки values() для полей, чей source не совпадает с колонкой модели
+VALUE_LOOKUPS = {'category': 'category__name'}
+# Поля, значение которых из БД уже имеет нужный вид
+PLAIN_FIELDS = (serializers.CharField, serializers.IntegerField, serializers.ChoiceField, serializers.BooleanField)
+# Нужны пагинации для курсора, даже если не запрошены
+CURSOR_LOOKUPS = ('id', 'created_at', 'popularity')
+
+FIELDSET_PARAMETERS = [
+    OpenApiParameter('fields', str, description='Поля ответа через запятую (по умолчанию все)'),
+    OpenApiParameter('expand', str, description='Вложенные объекты через запятую: user, category'),
+]
+
+
+def split(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else []
+
+
+class FieldSet:
+    """Поля и вложенные объекты, запрошенные через ``?fields=`` и ``?expand=``"""
+
+    def __init__(self, fields=None, expand=()):
+        self.fields = fields  # None — все поля сериализатора
+        self.expand = list(expand)
+
+    @classmethod
+    def from_query(cls, query_params, serializer_class):
+        """Набор из параметров запроса; неизвестные имена — ошибка 400"""
+        fields = split(query_params.get('fields')) or None
+        expand = list(dict.fromkeys(split(query_params.get('expand'))))
+        errors = {}
+        unknown = [name for name in expand if name not in serializer_class.EXPANDABLE]
+        if unknown:
+            errors['expand'] = [f"Неизвестные вложенные объекты: {', '.join(unknown)}."]
+        if fields is not None:
+            known = {*serializer_class.Meta.fields, *expand}
+            unknown = [name for name in fields if name not in known]
+            if unknown:
+                errors['fields'] = [f"Неизвестные поля: {', '.join(unknown)}."]
+        if errors:
+            raise serializers.ValidationError(errors)
+        return cls(fields, expand)
+
+    @property
+    def variant(self):
+        """Добавка к ETag: у полного ответа её нет, чтобы If-Match при записи совпадал с ETag чтения"""
+        if self.fields is None and not self.expand:
+            return ()
+        return (f"{','.join(self.fields or ['*'])};{','.join(sorted(self.expand))}",)
+
+    def select(self, serializer_fields, expandable):
+        """Поля сериализатора с учётом набора (для ``get_fields``)"""
+        for name in self.expand:
+            serializer_fields[name] = expandable[name](read_only=True)
+        if self.fields is None:
+            return serializer_fields
+        return {name: field for name, field in serializer_fields.items() if name in self.fields}
+
+    def apply(self, queryset):
+        """``select_related`` для вложенных объектов (имя совпадает со связью модели)"""
+        return queryset.select_related(*self.expand) if self.expand else queryset
+
+
+def converter(field):
+    """Преобразование значения колонки в значение ответа; None — подходит как есть"""
+    if isinstance(field, PLAIN_FIELDS):
+        return None
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if isinstance(field, serializers.DateTimeField) and settings.USE_TZ and str(output_format).lower() == ISO_8601:
+        # DateTimeField.to_representation без проверок на каждое значение: из БД приходит aware-время
+        zone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+
+        def iso(value):
+            value = value.astimezone(zone).isoformat()
+            return value[:-6] + 'Z' if value.endswith('+00:00') else value
+        return iso
+    return field.to_representation
+
+
+class RowBuilder:
+    """Словари ответа из строк ``values()`` по заранее составленному плану полей"""
+
+    def __init__(self, serializer_fields):
+        self.lookups = list(CURSOR_LOOKUPS)
+        self.plan = self.compile(serializer_fields, '')
+
+    def compile(self, serializer_fields, prefix):
+        plan = []
+        for name, field in serializer_fields.items():
+            if isinstance(field, serializers.BaseSerializer):
+                plan.append((name, None, None, self.compile(field.fields, f'{prefix}{field.source}__')))
+                continue
+            lookup = prefix + (VALUE_LOOKUPS.get(field.source, field.source) if not prefix else field.source)
+            if lookup not in self.lookups:
+                self.lookups.append(lookup)
+            plan.append((name, lookup, converter(field), None))
+        return plan
+
+    def queryset(self, queryset):
+        return queryset.values(*self.lookups)
+
+    def row(self, values, plan=None):
+        data = {}
+        for name, lookup, convert, nested in plan or self.plan:
+            if nested is not None:
+                data[name] = self.row(values, nested)
+                continue
+            value = values[lookup]
+            data[name] = value if convert is None or value is None else convert(value)
+        return data
+
+    def rows(self, values_list):
+        return [self.row(values) for values in values_list]
@@ -1,20 +1,55 @@
 # ads/forms.py
 from django import forms
-from .models import Ad, ExchangeProposal
+from django.db import transaction
+from django.db.models import Subquery
+
+from .models import Ad, Category, ExchangeProposal, category_slug
+from .pagination import DEFAULT_ORDERING, POPULAR_ORDERING
+from .search import search_ads
 
 
 class AdForm(forms.ModelForm):
+    # Категория вводится текстом и приводится к записи справочника при сохранении
+    # (поэтому её нет в Meta.fields: модель не проверяет ещё не созданную категорию)
+    category = forms.CharField(
+        label="Категория",
+        max_length=100,
+        widget=forms.TextInput(attrs={'class': 'form-control'})
+    )
+
     class Meta:
         model = Ad
-        fields = ['title', 'description', 'image_url', 'category', 'condition']
+        fields = ['title', 'description', 'image_url', 'condition']
         widgets = {
             'title': forms.TextInput(attrs={'class': 'form-control'}),
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 4}),
             'image_url': forms.URLInput(attrs={'class': 'form-control'}),
-            'category': forms.TextInput(attrs={'class': 'form-control'}),
             'condition': forms.Select(attrs={'class': 'form-select'}),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.category_id:
+            self.initial['category'] = self.instance.category.name
+
+    def clean_category(self):
+        name = self.cleaned_data['category']
+        if not category_slug(name):
+            raise forms.ValidationError("Укажите название категории.")
+        return Category.objects.lookup(name)
+
+    def save(self, commit=True):
+        # Новая категория создаётся вместе с объявлением, в одной транзакции
+        with transaction.atomic():
+            self.instance.category = Category.objects.persist(self.cleaned_data['category'])
+            if not commit or self.instance._state.adding:
+                return super().save(commit)
+            # Правка пишет только поля формы: счётчики, просмотры и оценку с загруженными
+            # раньше значениями не затирает (их меняют ads.counters, ads.viewcounts, ads.popularity)
+            ad = super().save(commit=False)
+            ad.save(update_fields=[*self._meta.fields, 'category', 'updated_at'])
+            return ad
+
 
 class AdFilterForm(forms.Form):
     query = forms.CharField(
@@ -33,6 +68,38 @@ class AdFilterForm(forms.Form):
         required=False,
         widget=forms.Select(attrs={'class': 'form-select'})
     )
+    ordering = forms.ChoiceField(
+        label="Сортировка",
+        choices=[('', 'Сначала новые'), ('popular', 'Популярные')],
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    ORDERINGS = {'': DEFAULT_ORDERING, 'popular': POPULAR_ORDERING}
+
+    def get_ordering(self):
+        """Ключ сортировки списка; последнее поле уникально, поэтому подходит и для курсоров"""
+        return self.ORDERINGS[self.cleaned_data.get('ordering') or ''] if self.is_valid() else DEFAULT_ORDERING
+
+    def filter_queryset(self, queryset):
+        """Применяет фильтры формы к queryset объявлений (вызывать после is_valid)"""
+        query = self.cleaned_data.get('query')
+        category = self.cleaned_data.get('category')
+        condition = self.cleaned_data.get('condition')
+
+        # Фильтрация по категории: slug или название в любом написании
+        if category:
+            category_id = Category.objects.filter(slug=category_slug(category)).values('id')[:1]
+            queryset = queryset.filter(category=Subquery(category_id))
+
+        # Фильтрация по состоянию
+        if condition:
+            queryset = queryset.filter(condition=condition)
+
+        # Полнотекстовый поиск с сортировкой по релевантности
+        if query:
+            queryset = search_ads(queryset, query)
+
+        return queryset
 
 
 class ExchangeProposalForm(forms.ModelForm):
@@ -0,0 +1,260 @@
+"""Очередь фоновых задач в основной базе, без внешнего брокера.
+
+Задача — строка ``Job`` с именем функции из реестра (декоратор ``task``) и
+JSON-аргументами. Побочные эффекты записи, которые не нужны для ответа
+(подбор сохранённых поисков, поиск обменов по кругу), ставятся в очередь и
+выполняются воркерами ``manage.py run_workers``, а не в запросе.
+
+Постановка:
+
+* ``enqueue`` пишет задачу в текущей транзакции: воркеры увидят её только
+  после коммита вместе с данными, а при откате она исчезнет вместе с ними;
+* ``enqueue_on_commit`` откладывает саму вставку до коммита
+  (``transaction.on_commit``) и не удлиняет транзакцию записи, но задача
+  теряется, если процесс упадёт между коммитом и вставкой.
+
+С ``ADS_JOBS_EAGER`` (по умолчанию — при ``DEBUG``, то есть в разработке и
+тестах) очереди нет: ``enqueue`` сразу выполняет задачу в транзакции
+вызывающего, без повторов и паузы ``delay``. В production настройка
+выключена, и без запущенных ``run_workers`` задачи копятся в очереди.
+
+Воркер забирает сразу пачку готовых задач (``claim``): на PostgreSQL, MySQL
+и Oracle — ``SELECT ... FOR UPDATE SKIP LOCKED``, и воркеры не ждут строк,
+которые уже забирает другой; на SQLite писатель один, и пачку закрепляет
+условный ``UPDATE ... WHERE status = 'queued'``. Успешные задачи удаляются
+одним ``DELETE`` на пачку, упавшие откладываются с экспоненциально растущей
+паузой, а после ``max_attempts`` попыток остаются со статусом ``failed`` и
+текстом ошибки. Задачи воркера,
+который упал посреди пачки, возвращает в очередь ``recover`` по истечении
+``ADS_JOBS_LEASE_SECONDS``, поэтому задачи должны быть идемпотентными.
+"""
+import logging
+import random
+import threading
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import DatabaseError, OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+ERROR_LENGTH = 10_000  # Символов трассировки в Job.last_error
+RETRY_ATTEMPTS = 5  # Попыток запроса воркера, если база занята
+
+
+def task(name):
+    """Регистрирует функцию как задачу ``name``; аргументы — ключи payload"""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def build(name, payload=None, delay=0, max_attempts=None):
+    if name not in TASKS:
+        raise KeyError(f'Неизвестная задача: {name}')
+    return Job(
+        task=name,
+        payload=payload or {},
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or settings.ADS_JOBS_MAX_ATTEMPTS,
+    )
+
+
+def enqueue(name, payload=None, delay=0, max_attempts=None):
+    """Ставит задачу в очередь в текущей транзакции (с ``ADS_JOBS_EAGER`` — выполняет сразу)"""
+    job = build(name, payload, delay, max_attempts)
+    if settings.ADS_JOBS_EAGER:
+        run_eager(job)
+    else:
+        job.save(force_insert=True)
+    return job
+
+
+def run_eager(job):
+    """Выполняет задачу на месте; ошибка откатывает только её точку сохранения, не запись вызывающего"""
+    try:
+        with transaction.atomic():
+            TASKS[job.task](**job.payload)
+    except Exception:
+        logger.exception('Задача %s упала (выполнение без очереди)', job.task)
+
+
+def enqueue_on_commit(name, payload=None, delay=0, max_attempts=None):
+    """Ставит задачу в очередь после коммита текущей транзакции (сразу — вне транзакции)"""
+    build(name, payload, delay, max_attempts)  # Неизвестное имя — ошибка здесь, а не после коммита
+    transaction.on_commit(partial(enqueue, name, payload, delay, max_attempts))
+
+
+def backoff(attempts):
+    """Пауза перед следующей попыткой, секунды: удваивается, со случайной долей против всплесков"""
+    delay = min(settings.ADS_JOBS_BACKOFF_MAX, settings.ADS_JOBS_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def claim(worker, limit):
+    """Забирает до ``limit`` готовых задач для воркера ``worker``"""
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    now = timezone.now()
+    ready = Job.objects.filter(status='queued', run_at__lte=now)
+    candidates = ready.order_by('run_at', 'id').values_list('id', flat=True)[:limit]
+    mark = {'status': 'running', 'locked_by': token, 'locked_at': now, 'attempts': F('attempts') + 1}
+    # Закрепление и чтение закреплённых — одна транзакция: если чтение упадёт
+    # (база занята), задачи не останутся закреплёнными до истечения аренды.
+    # Воркеры и run_pending вызывают claim вне транзакции, и блок — внешний;
+    # если вызывающий всё же открыл транзакцию, ошибка откатит её целиком, без точки сохранения
+    with transaction.atomic(savepoint=False):
+        if connection.features.has_select_for_update_skip_locked:
+            claimed = Job.objects.filter(id__in=list(candidates.select_for_update(skip_locked=True))).update(**mark)
+        else:
+            # Выборка и закрепление одним UPDATE с подзапросом: воркеры не делят
+            # одни и те же строки и не принимают проигранную гонку за пустую очередь
+            claimed = ready.filter(id__in=candidates).update(**mark)
+        if not claimed:
+            return []
+        return list(Job.objects.filter(status='running', locked_by=token).order_by('run_at', 'id'))
+
+
+def execute(job):
+    """Выполняет задачу; возвращает трассировку ошибки или None.
+
+    Общей транзакции вокруг задачи нет: на SQLite она держала бы блокировку
+    записи всё время задачи (в профиле production — с самого начала), и
+    воркеры выполняли бы задачи по одной. Транзакцию открывает сама задача.
+    """
+    try:
+        TASKS[job.task](**job.payload)
+    except Exception:
+        logger.exception('Задача %s упала (попытка %s из %s)', job, job.attempts, job.max_attempts)
+        return traceback.format_exc()[-ERROR_LENGTH:]
+    return None
+
+
+def fail(job, error):
+    """Возвращает задачу в очередь с паузой или, если попытки кончились, помечает упавшей"""
+    changes = {'locked_by': '', 'locked_at': None, 'last_error': error}
+    if job.attempts >= job.max_attempts or job.task not in TASKS:
+        changes['status'] = 'failed'
+    else:
+        changes.update(status='queued', run_at=timezone.now() + timedelta(seconds=backoff(job.attempts)))
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(**changes)
+
+
+def retry(func, *args):
+    """Вызывает ``func`` и повторяет с растущей паузой, пока база занята (``OperationalError``).
+
+    Результат пачки без повтора потерялся бы, и выполненные задачи вернул бы
+    в очередь ``recover``. Внутри транзакции повтор невозможен: она уже
+    помечена для отката, и ошибка передаётся вызывающему.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func(*args)
+        except OperationalError:
+            if attempt == RETRY_ATTEMPTS - 1 or connection.in_atomic_block:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def finish(jobs, done):
+    Job.objects.filter(pk__in=done, locked_by=jobs[0].locked_by).delete()
+
+
+def run_batch(jobs):
+    """Выполняет забранные задачи; возвращает число успешных"""
+    done = []
+    for job in jobs:
+        error = execute(job)
+        if error is None:
+            done.append(job.pk)
+        else:
+            retry(fail, job, error)
+    if done:
+        retry(finish, jobs, done)
+    return len(done)
+
+
+def recover():
+    """Возвращает в очередь задачи воркеров, не уложившихся в аренду (упавших)"""
+    stale = Job.objects.filter(
+        status='running', locked_at__lt=timezone.now() - timedelta(seconds=settings.ADS_JOBS_LEASE_SECONDS),
+    )
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='failed', locked_by='', locked_at=None, last_error='Воркер не завершил задачу',
+    )
+    return failed + stale.update(status='queued', locked_by='', locked_at=None)
+
+
+def run_pending(worker='inline', batch_size=None):
+    """Выполняет готовые задачи в текущем потоке, пока они есть; возвращает число выполненных"""
+    batch_size = batch_size or settings.ADS_JOBS_BATCH_SIZE
+    executed = 0
+    while jobs := claim(worker, batch_size):
+        run_batch(jobs)
+        executed += len(jobs)
+    return executed
+
+
+class Worker(threading.Thread):
+    """Поток воркера: забирает пачки задач, пока не выставлен ``stop``"""
+
+    def __init__(self, name, stop, batch_size, poll_interval, burst=False, recovers=False):
+        super().__init__(name=name, daemon=True)
+        self.stop, self.batch_size, self.poll_interval = stop, batch_size, poll_interval
+        self.burst = burst  # Завершиться, когда очередь опустеет
+        self.recovers = recovers  # Возвращать в очередь задачи упавших воркеров
+        self.executed = self.succeeded = 0
+
+    def run(self):
+        next_recovery = 0
+        try:
+            while not self.stop.is_set():
+                try:
+                    if self.recovers and time.monotonic() >= next_recovery:
+                        retry(recover)
+                        next_recovery = time.monotonic() + settings.ADS_JOBS_LEASE_SECONDS / 2
+                    jobs = retry(claim, self.name, self.batch_size)
+                    if jobs:
+                        self.succeeded += run_batch(jobs)
+                        self.executed += len(jobs)
+                        continue
+                except OperationalError as exc:
+                    # База занята дольше повторов или недоступна: уже забранные задачи вернёт recover
+                    logger.warning('Воркер %s: база недоступна (%s), пауза %s с', self.name, exc, self.poll_interval)
+                except DatabaseError:
+                    logger.exception('Воркер %s: ошибка базы', self.name)
+                else:
+                    if self.burst:  # Очередь пуста
+                        break
+                self.stop.wait(self.poll_interval)
+        finally:
+            connections.close_all()  # Соединения потока не закроет никто другой
+
+
+def serve(threads, batch_size=None, poll_interval=None, burst=False, stop=None, prefix='worker'):
+    """Запускает ``threads`` потоков-воркеров и ждёт их завершения; возвращает их"""
+    stop = stop or threading.Event()
+    workers = [
+        Worker(
+            f'{prefix}-{number}', stop,
+            batch_size or settings.ADS_JOBS_BATCH_SIZE,
+            settings.ADS_JOBS_POLL_INTERVAL if poll_interval is None else poll_interval,
+            burst=burst, recovers=number == 0,
+        )
+        for number in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(0.5)  # join с таймаутом не мешает обработке сигналов в главном потоке
+    return workers
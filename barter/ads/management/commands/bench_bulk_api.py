@@ -0,0 +1,56 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ads.api import AdBulkView
+from ads.bench import CATEGORIES, rollback, sentence
+from ads.views import AdViewSet
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость создания объявлений через /api/ads/ и /api/ads/bulk/ (строк в секунду)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=2000, help='Сколько объявлений создать каждым способом')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        items = [
+            {
+                'title': sentence(rng, 2, 5).capitalize(),
+                'description': sentence(rng, 10, 40),
+                'category': rng.choice(CATEGORIES),
+                'condition': rng.choice(['new', 'used']),
+            }
+            for _ in range(options['items'])
+        ]
+        # Запросы вызывают view напрямую, без HTTP и middleware: разница
+        # с реальным импортом по сети будет ещё больше
+        factory = APIRequestFactory()
+        single_view = AdViewSet.as_view({'post': 'create'})
+        bulk_view = AdBulkView.as_view()
+
+        with rollback():
+            user, _ = User.objects.get_or_create(username='bench')
+
+            def single():
+                for item in items:
+                    request = factory.post('/api/ads/', item, format='json')
+                    force_authenticate(request, user)
+                    assert single_view(request).status_code == 201
+
+            def bulk():
+                request = factory.post(f"/api/ads/bulk/?chunk_size={options['chunk_size']}", items, format='json')
+                force_authenticate(request, user)
+                assert bulk_view(request).status_code == 200
+
+            for name, func in (('по одному', single), ('массово', bulk)):
+                started = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{name:<12} {len(items)} строк за {elapsed:8.2f} с   {len(items) / elapsed:10.0f} строк/с')
@@ -0,0 +1,95 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from ads import caching, facets
+from ads.bench import format_summary, make_ads
+from ads.models import Category
+from ads.signals import suspended
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает пропускную способность и хвосты задержек страниц для чтения: '
+        'синхронные view (WSGI, пул потоков) против асинхронных (ASGI)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=5000, help='Сколько объявлений создать')
+        parser.add_argument('--requests', type=int, default=1000, help='Сколько запросов выполнить каждым способом')
+        parser.add_argument('--concurrency', type=int, default=64, help='Сколько запросов выполняется одновременно')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def get_paths(self, rng, count, ids):
+        categories = list(Category.objects.values_list('slug', flat=True))
+        paths = []
+        for _ in range(count):
+            pk = rng.choice(ids)
+            paths.append(rng.choice([
+                reverse('ad_list'),
+                f"{reverse('ad_list')}?category={rng.choice(categories)}&page=2",
+                reverse('ad_detail', args=[pk]),
+                reverse('ad-list'),
+                reverse('ad-detail', args=[pk]),
+            ]))
+        return paths
+
+    def run_sync(self, paths, concurrency):
+        def request(path):
+            started = time.perf_counter()
+            assert Client().get(path).status_code == 200, path
+            return time.perf_counter() - started
+
+        def close_connection(_):
+            connections.close_all()
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            samples = list(executor.map(request, paths))
+            list(executor.map(close_connection, range(concurrency)))
+        return samples
+
+    def run_async(self, paths, concurrency):
+        async def main():
+            semaphore = asyncio.Semaphore(concurrency)
+            client = AsyncClient()
+
+            async def request(path):
+                async with semaphore:
+                    started = time.perf_counter()
+                    assert (await client.get(path)).status_code == 200, path
+                    return time.perf_counter() - started
+
+            return await asyncio.gather(*(request(path) for path in paths))
+
+        with override_settings(ROOT_URLCONF='core.urls_async'):
+            return asyncio.run(main())
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # Потоки и цикл событий работают со своими соединениями, поэтому
+        # данные не откатываются транзакцией, а удаляются в конце
+        self.stdout.write(f"Создание {options['ads']} объявлений...")
+        user = User.objects.create_user('bench_concurrency')
+        make_ads(options['ads'], seed=options['seed'], user=user)
+        try:
+            ids = list(user.ads.values_list('id', flat=True))
+            paths = self.get_paths(rng, options['requests'], ids)
+            # Кэш списка отключён: сравниваются сами view, а не попадания в кэш
+            with override_settings(ALLOWED_HOSTS=['testserver'], ADS_LIST_CACHE_TIMEOUT=0):
+                for name, run in (('WSGI, синхронные', self.run_sync), ('ASGI, асинхронные', self.run_async)):
+                    started = time.perf_counter()
+                    samples = run(paths, options['concurrency'])
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(format_summary(name, samples) + f'   {len(samples) / elapsed:8.0f} запр/с')
+        finally:
+            with suspended():
+                user.delete()
+            facets.recount()
+            caching.invalidate_all()
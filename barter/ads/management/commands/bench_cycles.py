@@ -0,0 +1,68 @@
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ads.bench import CATEGORIES, batches, format_summary, rollback
+from ads.cycles import find_cycles
+from ads.models import Ad, Category, ExchangeProposal, ProposalEdge
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время поиска обменов по кругу для нового предложения в зависимости от числа ожидающих предложений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20_000)
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 50_000, 100_000, 200_000],
+                            help='Число ожидающих предложений на каждом шаге')
+        parser.add_argument('--queries', type=int, default=200, help='Поисков на каждом шаге')
+        parser.add_argument('--max-length', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with rollback():
+            password = make_password(None)
+            users = [
+                user.pk for user in User.objects.bulk_create([
+                    User(username=f'bench_cycles{number}', password=password) for number in range(options['users'])
+                ], batch_size=5000)
+            ]
+            category = Category.objects.resolve(CATEGORIES[0])
+            ads = Ad.objects.bulk_create([
+                Ad(user_id=user, title='Вещь', description='Описание', category=category, condition='used')
+                for user in users
+            ], batch_size=5000)
+            ad_by_user = {ad.user_id: ad.pk for ad in ads}
+
+            created = 0
+            for size in sorted(options['sizes']):
+                # Граф растёт до size рёбер: случайные пары разных пользователей
+                for batch in batches(size - created, 5000):
+                    pairs = [rng.sample(users, 2) for _ in batch]
+                    proposals = ExchangeProposal.objects.bulk_create([
+                        ExchangeProposal(ad_sender_id=ad_by_user[source], ad_receiver_id=ad_by_user[target])
+                        for source, target in pairs
+                    ])
+                    ProposalEdge.objects.bulk_create([
+                        ProposalEdge(proposal=proposal, source_user_id=source, target_user_id=target)
+                        for proposal, (source, target) in zip(proposals, pairs)
+                    ])
+                created = max(created, size)
+
+                samples, found, queries = [], 0, 0
+                for _ in range(options['queries']):
+                    source, target = rng.sample(users, 2)
+                    with CaptureQueriesContext(connection) as captured:
+                        started = time.perf_counter()
+                        found += len(find_cycles(source, target, max_length=options['max_length']))
+                        samples.append(time.perf_counter() - started)
+                    queries += len(captured)
+                self.stdout.write(
+                    format_summary(f'{created} предложений', samples)
+                    + f"   циклов {found / options['queries']:5.2f}   запросов {queries / options['queries']:4.1f}"
+                )
@@ -0,0 +1,167 @@
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ads.bench import WORDS, format_summary, rollback, summarize
+from ads.models import Ad, Category, ExchangeProposal
+from ads.views import AdListView
+
+ENDPOINTS = ['ad_list', 'ad_detail', 'exchange_proposals', 'create_exchange_proposal', 'api_ads', 'api_similar']
+METRICS = ['p50', 'p95', 'p99']
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет задержку (p50/p95/p99), число запросов к БД и пиковую память основных страниц '
+        'и API на текущей базе (см. seed_barter); результаты можно сохранить и сравнить с базовыми'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help='Запросов к каждой странице')
+        parser.add_argument('--profile-requests', type=int, default=10,
+                            help='Запросов для подсчёта обращений к БД и памяти (отдельный прогон)')
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+        parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+        parser.add_argument('--max-regression', type=float, default=None,
+                            help='Завершиться с ошибкой, если p95 вырос больше чем на эту долю (0.2 = 20%%) '
+                                 'или стало больше запросов к БД')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        proposal = ExchangeProposal.objects.select_related('ad_receiver__user').order_by('-id').first()
+        if proposal is None:
+            raise CommandError('В базе нет предложений обмена: сначала выполните manage.py seed_barter.')
+        self.user = proposal.ad_receiver.user
+        self.own_ad = proposal.ad_receiver_id
+        self.rng = random.Random(options['seed'])
+        self.id_range = Ad.objects.aggregate(low=Min('id'), high=Max('id'))
+        self.categories = list(Category.objects.values_list('slug', flat=True))
+        self.pages = min(50, max(1, -(-Ad.objects.count() // AdListView.paginate_by)))
+
+        results = {}
+        # Всё выполняется в одной транзакции с откатом: созданные предложения и сессии
+        # не остаются в базе. Кэш списка отключён, чтобы мерить сами страницы
+        with rollback(), override_settings(ALLOWED_HOSTS=['testserver'], ADS_LIST_CACHE_TIMEOUT=0):
+            for name in options['endpoints']:
+                results[name] = self.bench(name, options['requests'], options['profile_requests'])
+                self.stdout.write(self.format_result(name, results[name]))
+
+        report = {
+            'meta': {
+                'requests': options['requests'],
+                'ads': Ad.objects.count(),
+                'proposals': ExchangeProposal.objects.count(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'endpoints': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['max_regression'])
+
+    def random_ad(self):
+        pk = self.rng.randint(self.id_range['low'], self.id_range['high'])
+        return Ad.objects.filter(pk__gte=pk).order_by('pk').values_list('pk', flat=True).first()
+
+    def make_request(self, name):
+        """(метод, путь, данные, логин, ожидаемый статус) для одного запроса"""
+        rng = self.rng
+        if name == 'ad_list':
+            params = rng.choice([
+                {}, {'page': rng.randint(1, self.pages)}, {'category': rng.choice(self.categories)},
+                {'condition': rng.choice(['new', 'used']), 'query': rng.choice(WORDS)},
+            ])
+            return 'get', reverse('ad_list'), params, False, 200
+        if name == 'ad_detail':
+            return 'get', reverse('ad_detail', args=[self.random_ad()]), {}, True, 200
+        if name == 'exchange_proposals':
+            params = rng.choice([{}, {'status': 'pending'}])
+            return 'get', reverse('exchange_proposals'), params, True, 200
+        if name == 'create_exchange_proposal':
+            data = {'ad_sender': self.own_ad, 'comment': 'Обмен?'}
+            return 'post', reverse('create_exchange_proposal', args=[self.random_ad()]), data, True, 302
+        if name == 'api_similar':
+            return 'get', f'/api/ads/{self.random_ad()}/similar/', {}, False, 200
+        params = rng.choice([{}, {'condition': 'new'}, {'query': rng.choice(WORDS)}])
+        return 'get', '/api/ads/', params, False, 200
+
+    def send(self, clients, request):
+        method, path, data, login, status = request
+        response = getattr(clients[login], method)(path, data)
+        if response.status_code != status:
+            raise CommandError(f'{method.upper()} {path}: ответ {response.status_code}, ожидался {status}')
+
+    def bench(self, name, count, profile_count):
+        clients = {False: Client(), True: Client()}
+        clients[True].force_login(self.user)
+        self.send(clients, self.make_request(name))  # Прогрев: шаблоны, соединение
+
+        samples = []
+        for request in [self.make_request(name) for _ in range(count)]:
+            started = time.perf_counter()
+            self.send(clients, request)
+            samples.append(time.perf_counter() - started)
+
+        # Запросы к БД и память считаются отдельно: учёт замедляет обработку
+        queries, peaks = [], []
+        tracemalloc.start()
+        try:
+            for request in [self.make_request(name) for _ in range(profile_count)]:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                with CaptureQueriesContext(connection) as captured:
+                    self.send(clients, request)
+                queries.append(len(captured))
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+
+        result = {metric: round(value, 3) for metric, value in summarize(samples).items()}
+        result['queries'] = round(sum(queries) / len(queries), 2) if queries else 0
+        result['peak_kib'] = round(max(peaks) / 1024, 1) if peaks else 0
+        return result
+
+    def format_result(self, name, result):
+        summary = format_summary(name, [0])
+        for metric in ('mean', *METRICS):
+            summary = summary.replace(f'{metric} {0:8.2f} ms', f'{metric} {result[metric]:8.2f} ms', 1)
+        return f"{summary}   запросов к БД {result['queries']:6.1f}   память {result['peak_kib']:9.1f} КиБ"
+
+    def compare(self, results, path, max_regression):
+        with open(path) as file:
+            baseline = json.load(file)['endpoints']
+        regressions = []
+        self.stdout.write(f'Сравнение с {path}:')
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            old = baseline[name]
+            changes = [
+                f'{metric} {(result[metric] / old[metric] - 1) * 100:+6.1f}%'
+                for metric in METRICS if old[metric]
+            ]
+            changes.append(f"запросов к БД {result['queries'] - old['queries']:+.1f}")
+            if old['peak_kib']:
+                changes.append(f"память {(result['peak_kib'] / old['peak_kib'] - 1) * 100:+6.1f}%")
+            self.stdout.write(f'{name:<32} ' + '   '.join(changes))
+            if max_regression is not None and (
+                result['p95'] > old['p95'] * (1 + max_regression) or result['queries'] > old['queries']
+            ):
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"Регрессия производительности: {', '.join(regressions)}")
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ads.jobs import build, serve, task
+from ads.models import Job
+
+BENCH_TASK = 'ads.bench.sleep'
+
+
+@task(BENCH_TASK)
+def sleep(ms=0):
+    """Задача бенчмарка: имитирует работу (например, запрос к внешнему сервису)"""
+    if ms:
+        time.sleep(ms / 1000)
+
+
+class Command(BaseCommand):
+    help = ('Пропускная способность очереди фоновых задач: постановка и выполнение воркерами '
+            '(задачи пишутся в базу и удаляются после выполнения)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=2000, help='Задач в каждом прогоне')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 20])
+        parser.add_argument('--task-ms', type=float, nargs='+', default=[0, 5],
+                            help='Длительность одной задачи, мс')
+
+    def handle(self, *args, **options):
+        count = options['jobs']
+        self.stdout.write(f'База: {connection.vendor}, SKIP LOCKED: '
+                          f'{"да" if connection.features.has_select_for_update_skip_locked else "нет"}')
+        Job.objects.filter(task=BENCH_TASK).delete()
+        try:
+            started = time.perf_counter()
+            for _ in range(count):
+                build(BENCH_TASK).save(force_insert=True)  # Как enqueue без ADS_JOBS_EAGER
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'постановка по одной (autocommit): {count / elapsed:10.0f} задач/с')
+            Job.objects.filter(task=BENCH_TASK).delete()
+
+            for task_ms in options['task_ms']:
+                self.stdout.write(f'Задача {task_ms:g} мс:')
+                for batch_size in options['batch_sizes']:
+                    for threads in options['threads']:
+                        Job.objects.bulk_create([build(BENCH_TASK, {'ms': task_ms}) for _ in range(count)],
+                                                batch_size=1000)
+                        started = time.perf_counter()
+                        workers = serve(threads, batch_size, poll_interval=0.01, burst=True, prefix='bench')
+                        elapsed = time.perf_counter() - started
+                        executed = sum(worker.executed for worker in workers)
+                        left = Job.objects.filter(task=BENCH_TASK).count()
+                        self.stdout.write(
+                            f'  пачка {batch_size:>3}, потоков {threads:>2}: {executed / elapsed:8.0f} задач/с'
+                            + (f' (не выполнено: {left})' if left else '')
+                        )
+                        Job.objects.filter(task=BENCH_TASK).delete()
+        finally:
+            Job.objects.filter(task=BENCH_TASK).delete()
@@ -0,0 +1,89 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from ads.bench import CATEGORIES, format_summary, rollback
+from ads.models import Ad, Category, SavedSearch
+from ads.percolator import ad_words, index_key, matches, normalize, percolate
+
+SYLLABLES = ['ба', 'ве', 'го', 'ду', 'ке', 'ли', 'мо', 'ны', 'пра', 'ро', 'ст', 'ту', 'фе', 'хо', 'це', 'шу']
+
+
+def vocabulary(rng, size):
+    """Псевдослова из слогов: у настоящих поисков словарь намного больше, чем ads.bench.WORDS"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+class Command(BaseCommand):
+    help = 'Время подбора сохранённых поисков под новое объявление: индекс против перебора всех поисков'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--searches', type=int, default=100_000, help='Сколько поисков сохранить')
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--ads', type=int, default=200, help='Сколько новых объявлений подобрать')
+        parser.add_argument('--naive-ads', type=int, default=5, help='Объявлений для перебора всех поисков')
+        parser.add_argument('--vocabulary', type=int, default=20_000, help='Размер словаря')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = vocabulary(rng, options['vocabulary'])
+        # Слова объявлений — по закону Ципфа (немного частых и длинный хвост),
+        # слова поисков — равновероятно: ищут конкретные вещи, а не частые слова
+        weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+        def text(count):
+            return ' '.join(rng.choices(words, cum_weights=weights, k=count))
+
+        def query(count):
+            return ' '.join(rng.choices(words, k=count))
+
+        with rollback():
+            password = make_password('bench')
+            users = User.objects.bulk_create([
+                User(username=f'percolator{number}', password=password) for number in range(options['users'])
+            ])
+            categories = [Category.objects.resolve(name) for name in CATEGORIES]
+            searches = []
+            for _ in range(options['searches']):
+                roll = rng.random()
+                fields = normalize(
+                    query=query(rng.randint(1, 3)) if roll > 0.01 else '',  # 1% — только категория
+                    category=rng.choice(categories).slug if roll < 0.25 else '',
+                    condition=rng.choice(['new', 'used']) if 0.15 < roll < 0.35 else '',
+                )
+                searches.append(SavedSearch(user=rng.choice(users), index_key=index_key(**fields), **fields))
+            SavedSearch.objects.bulk_create(searches, batch_size=5000, ignore_conflicts=True)
+            self.stdout.write(f'Сохранённых поисков: {SavedSearch.objects.count()}')
+
+            owner = User.objects.create(username='percolator-owner')
+            ads = Ad.objects.bulk_create([
+                Ad(user=owner, title=text(rng.randint(2, 5)), description=text(rng.randint(10, 40)),
+                   category=rng.choice(categories), condition=rng.choice(['new', 'used']))
+                for _ in range(options['ads'])
+            ])
+
+            samples, found = [], 0
+            for ad in ads:
+                started = time.perf_counter()
+                found += percolate([ad])
+                samples.append(time.perf_counter() - started)
+            self.stdout.write(format_summary('инвертированный индекс', samples))
+            self.stdout.write(f'  совпадений на объявление: {found / len(ads):.1f}')
+
+            naive_samples = []
+            for ad in ads[:options['naive_ads']]:
+                started = time.perf_counter()
+                own_words = ad_words(ad)
+                for search in SavedSearch.objects.only('query', 'category', 'condition').iterator(chunk_size=5000):
+                    matches(search, ad, own_words)
+                naive_samples.append(time.perf_counter() - started)
+            if naive_samples:
+                self.stdout.write(format_summary('перебор всех поисков', naive_samples))
@@ -0,0 +1,42 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ads.bench import WORDS, format_summary, make_ads, measure, rollback
+from ads.models import Ad
+from ads.search import search_ads
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает полнотекстовый поиск с поиском через icontains на синтетических данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=100_000, help='Сколько объявлений создать')
+        parser.add_argument('--queries', type=int, default=50, help='Сколько запросов выполнить')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        queries = [
+            ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+            for _ in range(options['queries'])
+        ]
+        limit = options['page_size']
+        queryset = Ad.objects.order_by('-created_at')
+
+        def icontains(query):
+            return queryset.filter(Q(title__icontains=query) | Q(description__icontains=query))
+
+        def fulltext(query):
+            return search_ads(queryset, query)
+
+        with rollback():
+            self.stdout.write(f"Создание {options['ads']} объявлений...")
+            make_ads(options['ads'], seed=options['seed'])
+            for name, search in (('icontains', icontains), ('полнотекстовый', fulltext)):
+                samples = []
+                for query in queries:
+                    samples += measure(lambda: list(search(query)[:limit]), 3)
+                self.stdout.write(format_summary(name, samples))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from ads.bench import make_ads, measure, rollback, summarize
+from ads.fieldsets import FieldSet, RowBuilder
+from ads.serializers import AdSerializer
+from ads.views import AdViewSet
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость AdSerializer и сборки строк из values() для списка API (строк в секунду)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=5000, help='Сколько объявлений создать')
+        parser.add_argument('--page-sizes', type=int, nargs='+', default=[20, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--fields', default='', help='Как ?fields= в API')
+        parser.add_argument('--expand', default='', help='Как ?expand= в API')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        fieldset = FieldSet.from_query({'fields': options['fields'], 'expand': options['expand']}, AdSerializer)
+        context = {'fieldset': fieldset}
+        builder = RowBuilder(AdSerializer(context=context).fields)
+        queryset = fieldset.apply(AdViewSet.queryset.all()).order_by('-created_at', '-id')
+
+        with rollback():
+            self.stdout.write(f"Создание {options['ads']} объявлений...")
+            make_ads(options['ads'], seed=options['seed'])
+            for page_size in options['page_sizes']:
+                ads = list(queryset[:page_size])
+                rows = list(builder.queryset(queryset)[:page_size])
+                assert AdSerializer(ads, many=True, context=context).data == builder.rows(rows)
+                cases = (
+                    ('сериализатор', lambda: AdSerializer(ads, many=True, context=context).data),
+                    ('values()', lambda: builder.rows(rows)),
+                    ('сериализатор + запрос',
+                     lambda: AdSerializer(list(queryset[:page_size]), many=True, context=context).data),
+                    ('values() + запрос', lambda: builder.rows(list(builder.queryset(queryset)[:page_size]))),
+                )
+                self.stdout.write(f'Страница из {len(ads)} объявлений:')
+                for name, func in cases:
+                    stats = summarize(measure(func, options['repeat']))
+                    self.stdout.write(
+                        f"  {name:<24} p50 {stats['p50']:8.2f} ms   {len(ads) / stats['p50'] * 1000:10.0f} строк/с"
+                    )
@@ -0,0 +1,151 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from ads import caching, facets
+from ads.bench import format_summary, make_ads
+from ads.models import Ad, ExchangeProposal
+from ads.signals import suspended
+from core.sqlite import apply_pragmas
+
+
+def read_sql():
+    """SQL первой страницы ленты в виде для модуля sqlite3"""
+    queryset = Ad.objects.select_related('category').order_by('-created_at', '-id')[:20]
+    sql, params = queryset.query.get_compiler(using='default').as_sql()
+    return sql.replace('%s', '?'), params
+
+
+class Profile:
+    """Соединения с копией базы так, как их открывает Django с данным профилем"""
+
+    def __init__(self, path, options):
+        self.path = path
+        self.persistent = bool(options.get('CONN_MAX_AGE'))
+        self.pragmas = options.get('PRAGMAS', {})
+        self.begin = 'BEGIN ' + options.get('OPTIONS', {}).get('transaction_mode', 'DEFERRED')
+        self.local = threading.local()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        apply_pragmas(conn, self.pragmas)
+        return conn
+
+    def get_connection(self):
+        # Без CONN_MAX_AGE Django открывает новое соединение на каждый запрос
+        if not self.persistent:
+            return self.connect()
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+        return self.local.conn
+
+    def release(self, conn):
+        if not self.persistent:
+            conn.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает пропускную способность читателей и писателей SQLite '
+        'в профилях базы из SQLITE_PROFILES (по умолчанию и production)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=5000, help='Сколько объявлений создать')
+        parser.add_argument('--readers', type=int, default=8, help='Потоков, читающих ленту')
+        parser.add_argument('--writers', type=int, default=2, help='Потоков, создающих предложения обмена')
+        parser.add_argument('--seconds', type=float, default=5, help='Длительность каждого прогона')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Бенчмарк рассчитан на SQLite')
+        # Прогоны идут на копиях базы: данные создаются в основной и удаляются в конце
+        self.stdout.write(f"Создание {options['ads']} объявлений...")
+        user = User.objects.create_user('bench_sqlite')
+        make_ads(options['ads'], seed=options['seed'], user=user)
+        try:
+            ids = list(user.ads.values_list('id', flat=True))
+            with tempfile.TemporaryDirectory() as directory:
+                for name, profile_options in settings.SQLITE_PROFILES.items():
+                    path = os.path.join(directory, f'{name}.sqlite3')
+                    target = sqlite3.connect(path)
+                    connection.ensure_connection()
+                    connection.connection.backup(target)
+                    target.close()
+                    self.run(name, Profile(path, profile_options), ids, options)
+        finally:
+            with suspended():
+                user.delete()
+            facets.recount()
+            caching.invalidate_all()
+
+    def run(self, name, profile, ids, options):
+        sql, params = read_sql()
+        proposal_table, ad_table = ExchangeProposal._meta.db_table, Ad._meta.db_table
+        deadline = time.perf_counter() + options['seconds']
+        samples = {'read': [], 'write': []}
+        errors = {'read': 0, 'write': 0}
+
+        def read(conn, rng):
+            conn.execute(sql, params).fetchall()
+
+        def write(conn, rng):
+            now = timezone.now().isoformat()
+            sender, receiver = rng.sample(ids, 2)
+            conn.execute(profile.begin)
+            try:
+                conn.execute(
+                    f'INSERT INTO {proposal_table} (ad_sender_id, ad_receiver_id, comment, status, created_at) '
+                    'VALUES (?, ?, ?, ?, ?)', (sender, receiver, 'Обмен?', 'pending', now),
+                )
+                conn.execute(
+                    f'UPDATE {ad_table} SET counters_version = counters_version + 1 WHERE id = ?', (receiver,),
+                )
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+
+        def worker(kind, func, seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                conn = profile.get_connection()
+                try:
+                    func(conn, rng)
+                except sqlite3.OperationalError:  # database is locked
+                    errors[kind] += 1
+                else:
+                    samples[kind].append(time.perf_counter() - started)
+                finally:
+                    profile.release(conn)
+
+        threads = [
+            threading.Thread(target=worker, args=('read', read, n)) for n in range(options['readers'])
+        ] + [
+            threading.Thread(target=worker, args=('write', write, -n - 1)) for n in range(options['writers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.stdout.write(f'Профиль {name}:')
+        for kind, title in (('read', 'чтение ленты'), ('write', 'запись предложения')):
+            if samples[kind]:
+                rate = len(samples[kind]) / options['seconds']
+                self.stdout.write(
+                    format_summary(f'  {title}', samples[kind]) + f'   {rate:8.0f} оп/с   ошибок {errors[kind]}'
+                )
+            else:
+                self.stdout.write(f'  {title}: нет успешных операций, ошибок {errors[kind]}')
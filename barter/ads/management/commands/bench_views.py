@@ -0,0 +1,98 @@
+import itertools
+import random
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from django.db.models import F, Sum
+
+from ads import caching, facets
+from ads.bench import format_summary, make_ads
+from ads.models import Ad
+from ads.signals import suspended
+from ads.viewcounts import ViewBuffer
+
+
+class Command(BaseCommand):
+    help = (
+        'Учёт просмотров объявлений: UPDATE на каждый просмотр против буфера процесса '
+        'с записью раз в интервал (объявления создаются в базе и удаляются в конце)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=1000, help='Сколько объявлений создать')
+        parser.add_argument('--views', type=int, default=20_000, help='Просмотров в каждом прогоне')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+        parser.add_argument('--interval', type=float, default=1.0, help='Интервал записи буфера, секунды')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"База: {connection.vendor}. Создание {options['ads']} объявлений...")
+        user = User.objects.create_user('bench_views')
+        make_ads(options['ads'], seed=options['seed'], user=user)
+        try:
+            ads = user.ads.all()
+            ids = list(ads.values_list('id', flat=True))
+            # Популярность по закону Ципфа: немного горячих объявлений и длинный хвост
+            weights = list(itertools.accumulate(1 / rank for rank in range(1, len(ids) + 1)))
+            views = random.Random(options['seed']).choices(ids, cum_weights=weights, k=options['views'])
+
+            def naive(pk):
+                Ad.objects.filter(pk=pk).update(view_count=F('view_count') + 1)
+
+            for threads in options['threads']:
+                self.stdout.write(f'Потоков {threads}:')
+                buffer = ViewBuffer(interval=options['interval'])
+
+                def buffered(pk):
+                    if buffer.record(pk):
+                        buffer.flush()
+
+                for title, record, finish in (
+                    ('UPDATE на просмотр', naive, None),
+                    ('буфер процесса', buffered, buffer.flush),
+                ):
+                    before = ads.aggregate(total=Sum('view_count'))['total']
+                    samples, errors, elapsed = self.run(record, views, threads)
+                    if finish is not None:
+                        finish()  # Как atexit при остановке процесса
+                    written = ads.aggregate(total=Sum('view_count'))['total'] - before
+                    self.stdout.write(
+                        format_summary(f'  {title}', samples)
+                        + f'   {len(samples) / elapsed:8.0f} просм./с   ошибок {errors}   записано {written}'
+                    )
+        finally:
+            with suspended():
+                user.delete()
+            facets.recount()
+            caching.invalidate_all()
+
+    def run(self, record, views, threads):
+        """Раздаёт просмотры ``threads`` потокам; возвращает задержки, число ошибок и время прогона"""
+        samples, errors = [], []
+
+        def worker(part):
+            own_samples, own_errors = [], 0
+            try:
+                for pk in part:
+                    started = time.perf_counter()
+                    try:
+                        record(pk)
+                    except DatabaseError:  # database is locked
+                        own_errors += 1
+                    else:
+                        own_samples.append(time.perf_counter() - started)
+            finally:
+                connection.close()  # Соединение потока не закроет никто другой
+            samples.extend(own_samples)
+            errors.append(own_errors)
+
+        workers = [threading.Thread(target=worker, args=(views[number::threads],)) for number in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return samples, sum(errors), time.perf_counter() - started
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ads import export
+
+
+class Command(BaseCommand):
+    help = 'Выгружает объявления (или предложения обмена) в CSV или NDJSON потоком'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Сжимать gzip на лету')
+        parser.add_argument('--output', default='-', help='Файл для записи (по умолчанию stdout)')
+        parser.add_argument('--proposals', action='store_true', help='Выгрузить предложения обмена')
+        parser.add_argument('--query', default='', help='Поиск, как на главной странице')
+        parser.add_argument('--category', default='')
+        parser.add_argument('--condition', default='')
+        parser.add_argument('--status', default='', help='Статус предложений')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE, help='Строк на одну выборку')
+
+    def handle(self, *args, **options):
+        kind = 'proposals' if options['proposals'] else 'ads'
+        params = {name: options[name] for name in ('query', 'category', 'condition', 'status')}
+        chunks = export.export(kind, options['format'], params, options['gzip'], options['chunk_size'])
+        if options['output'] == '-':
+            if options['gzip']:
+                raise CommandError('Для --gzip укажите файл в --output.')
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
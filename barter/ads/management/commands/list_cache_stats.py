@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ads import caching
+
+
+class Command(BaseCommand):
+    help = 'Показывает попадания и промахи кэша списка объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--invalidate', action='store_true', help='Сбросить все закэшированные страницы')
+
+    def handle(self, *args, **options):
+        if options['invalidate']:
+            caching.invalidate_all()
+            self.stdout.write('Кэш списка сброшен')
+        stats = caching.stats()
+        self.stdout.write(
+            f"Попадания: {stats['hits']}, промахи: {stats['misses']}, доля попаданий: {stats['hit_ratio']:.1%}"
+        )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ads.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Пересоздаёт полнотекстовый индекс объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Алиас базы данных')
+        parser.add_argument(
+            '--recreate', action='store_true',
+            help='Удалить индекс вместе с триггерами и создать заново',
+        )
+
+    def handle(self, *args, **options):
+        backend = get_backend(options['database'])
+        if options['recreate']:
+            backend.uninstall()
+        backend.install()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Индекс поиска перестроен ({type(backend).__name__})'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ads.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики предложений на объявлениях по таблице предложений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Объявлений в одной транзакции')
+
+    def handle(self, *args, **options):
+        fixed = reconcile(options['batch_size'], progress=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f'Счётчики исправлены у объявлений: {fixed}'))
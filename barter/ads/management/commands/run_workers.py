@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import signal
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ads.jobs import serve
+
+
+@contextmanager
+def stop_on_signals(stop):
+    """SIGINT и SIGTERM завершают воркеры после текущей пачки; прежние обработчики возвращаются"""
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = {number: signal.signal(number, lambda *args: stop.set()) for number in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        yield
+    finally:
+        for number, handler in previous.items():
+            signal.signal(number, handler)
+
+
+@contextmanager
+def forward_signals(processes):
+    """SIGINT и SIGTERM родителя передаются дочерним процессам; прежние обработчики возвращаются"""
+    def forward(number, frame):
+        for process in processes:
+            if process.exitcode is None:
+                try:
+                    os.kill(process.pid, number)
+                except ProcessLookupError:
+                    pass
+
+    previous = {number: signal.signal(number, forward) for number in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        yield
+    finally:
+        for number, handler in previous.items():
+            signal.signal(number, handler)
+
+
+def serve_process(number, options):
+    stop = threading.Event()
+    with stop_on_signals(stop):
+        serve(options['threads'], options['batch_size'], options['poll_interval'], options['burst'], stop,
+              prefix=f'worker{number}')
+
+
+class Command(BaseCommand):
+    help = 'Запускает воркеры очереди фоновых задач (ads/jobs.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help='Потоков-воркеров в процессе')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Процессов (больше 1 — дочерние процессы через fork)')
+        parser.add_argument('--batch-size', type=int, default=settings.ADS_JOBS_BATCH_SIZE,
+                            help='Задач, которые воркер забирает за раз')
+        parser.add_argument('--poll-interval', type=float, default=settings.ADS_JOBS_POLL_INTERVAL,
+                            help='Пауза при пустой очереди, секунды')
+        parser.add_argument('--burst', action='store_true', help='Завершиться, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            stop = threading.Event()
+            with stop_on_signals(stop):
+                workers = serve(options['threads'], options['batch_size'], options['poll_interval'],
+                                options['burst'], stop)
+            executed = sum(worker.executed for worker in workers)
+            succeeded = sum(worker.succeeded for worker in workers)
+            self.stdout.write(f'Выполнено задач: {executed}, из них с ошибкой: {executed - succeeded}')
+            return
+
+        # Соединения родителя не должны достаться дочерним процессам
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=serve_process, args=(number, options))
+                     for number in range(options['processes'])]
+        for process in processes:
+            process.start()
+        # Родитель ждёт, пока дочерние процессы доделают текущие пачки: иначе
+        # взятые ими задачи остались бы до recover
+        with forward_signals(processes):
+            for process in processes:
+                process.join()
+        failed = [f'worker{number}: {process.exitcode}' for number, process in enumerate(processes)
+                  if process.exitcode != 0]
+        if failed:
+            raise CommandError(f"Воркеры завершились с ошибкой ({', '.join(failed)})")
@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ads.bench import seed
+
+
+class Command(BaseCommand):
+    help = 'Наполняет базу детерминированным набором данных для бенчмарков (пользователи, объявления, предложения)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--ads', type=int, default=100_000)
+        parser.add_argument('--categories', type=int, default=24)
+        parser.add_argument('--proposals', type=int, default=50_000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='seed', help='Префикс имён пользователей (пароль у всех «barter»)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Строк на один INSERT')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1:
+            raise CommandError('Нужен хотя бы один пользователь.')
+        if User.objects.filter(username=f"{options['prefix']}0").exists():
+            raise CommandError(
+                f"Пользователи с префиксом «{options['prefix']}» уже есть: укажите другой --prefix "
+                'или очистите базу (manage.py flush).'
+            )
+        with transaction.atomic():
+            counts = seed(
+                options['users'], options['ads'], options['categories'], options['proposals'],
+                seed=options['seed'], prefix=options['prefix'], batch_size=options['batch_size'],
+                progress=lambda message: self.stdout.write(message) if options['verbosity'] > 1 else None,
+            )
+        self.stdout.write(', '.join(f'{name}: {count}' for name, count in counts.items()))
@@ -0,0 +1,34 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+def sqlite_path(alias):
+    settings_dict = connections[alias].settings_dict
+    if settings_dict['ENGINE'] != 'django.db.backends.sqlite3':
+        raise CommandError(f'{alias}: копирование поддерживается только для SQLite, '
+                           'реплики других СУБД настраиваются средствами самой СУБД')
+    return str(settings_dict['NAME']).removeprefix('file:').split('?')[0]
+
+
+class Command(BaseCommand):
+    help = 'Копирует основную SQLite-базу в файлы реплик из BARTER_DB_REPLICAS (для локальной проверки)'
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('Реплики не настроены: задайте BARTER_DB_REPLICAS')
+        source = sqlite3.connect(sqlite_path('default'))
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                path = sqlite_path(alias)
+                connections[alias].close()
+                target = sqlite3.connect(path)
+                try:
+                    source.backup(target)  # Согласованный снимок даже при параллельной записи
+                finally:
+                    target.close()
+                self.stdout.write(f'{alias}: {path}')
+        finally:
+            source.close()
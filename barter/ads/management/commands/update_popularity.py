@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ads.popularity import rescore
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает оценки популярности объявлений, у которых изменились просмотры или предложения '
+        '(запускается периодически, например cron раз в минуту)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.ADS_POPULAR_CHUNK_SIZE,
+                            help='Объявлений в одной транзакции')
+        parser.add_argument('--all', action='store_true',
+                            help='Пересчитать все объявления (после изменения весов или HALF_LIFE)')
+
+    def handle(self, *args, **options):
+        rescored = rescore(options['chunk_size'], everything=options['all'], progress=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f'Пересчитана популярность объявлений: {rescored}'))
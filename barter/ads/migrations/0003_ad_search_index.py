@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def install_search_index(apps, schema_editor):
+    from ads.search import get_backend
+    get_backend(schema_editor.connection.alias).install()
+
+
+def uninstall_search_index(apps, schema_editor):
+    from ads.search import get_backend
+    get_backend(schema_editor.connection.alias).uninstall()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0002_alter_ad_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
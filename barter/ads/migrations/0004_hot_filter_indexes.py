@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 18:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0003_ad_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['created_at', 'id'], name='ad_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['condition', 'created_at', 'id'], name='ad_condition_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(fields=['ad_receiver', 'status', 'created_at'], name='proposal_receiver_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(fields=['ad_sender', 'status', 'created_at'], name='proposal_sender_status_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0004_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('slug', models.SlugField(allow_unicode=True, max_length=100, unique=True)),
+                ('ad_count', models.PositiveIntegerField(default=0)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='ads.category')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ConditionCounter',
+            fields=[
+                ('condition', models.CharField(choices=[('new', 'Новый'), ('used', 'Б/у')], max_length=10, primary_key=True, serialize=False)),
+                ('ad_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        # Временное поле: строки категорий переносятся в него следующей миграцией
+        migrations.AddField(
+            model_name='ad',
+            name='category_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='ads.category'),
+        ),
+    ]
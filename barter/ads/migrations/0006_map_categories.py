@@ -0,0 +1,45 @@
+from django.db import migrations
+from django.db.models import Count
+from django.utils.text import slugify
+
+
+def map_categories(apps, schema_editor):
+    Ad = apps.get_model('ads', 'Ad')
+    Category = apps.get_model('ads', 'Category')
+    ConditionCounter = apps.get_model('ads', 'ConditionCounter')
+
+    # Разные написания одной категории ("Спорт", " спорт ") сводятся к одному slug.
+    # Названия без букв и цифр ("???", "!!!") дают пустой slug: каждому — свой
+    # category-<n>, иначе все они слились бы в одну категорию
+    fallback = {}
+    for name in Ad.objects.values_list('category', flat=True).distinct():
+        normalized = ' '.join(name.split()) or 'Без категории'
+        slug = slugify(normalized, allow_unicode=True)
+        if not slug:
+            slug = fallback.setdefault(normalized, f'category-{len(fallback) + 1}')
+        category, _ = Category.objects.get_or_create(slug=slug, defaults={'name': normalized})
+        Ad.objects.filter(category=name).update(category_ref=category)
+
+    for row in Ad.objects.values('category_ref').annotate(total=Count('id')):
+        Category.objects.filter(pk=row['category_ref']).update(ad_count=row['total'])
+    counts = dict(Ad.objects.values_list('condition').annotate(total=Count('id')))
+    for condition in ('new', 'used'):
+        ConditionCounter.objects.create(condition=condition, ad_count=counts.get(condition, 0))
+
+
+def unmap_categories(apps, schema_editor):
+    Ad = apps.get_model('ads', 'Ad')
+    Category = apps.get_model('ads', 'Category')
+    for category in Category.objects.all():
+        Ad.objects.filter(category_ref=category).update(category=category.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0005_category'),
+    ]
+
+    operations = [
+        migrations.RunPython(map_categories, unmap_categories),
+    ]
@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0006_map_categories'),
+    ]
+
+    operations = [
+        # Значение по умолчанию нужно только для отката: старое поле возвращается
+        # пустым и заполняется обратной функцией 0006
+        migrations.AlterField(
+            model_name='ad',
+            name='category',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.RemoveField(
+            model_name='ad',
+            name='category',
+        ),
+        migrations.RenameField(
+            model_name='ad',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.AlterField(
+            model_name='ad',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ads', to='ads.category'),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['category', 'created_at', 'id'], name='ad_category_created_idx'),
+        ),
+    ]
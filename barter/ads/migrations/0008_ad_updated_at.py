@@ -0,0 +1,25 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_created_at(apps, schema_editor):
+    Ad = apps.get_model('ads', 'Ad')
+    Ad.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0007_ad_category_fk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+            preserve_default=False,
+        ),
+        # Для существующих объявлений считаем версией дату создания
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+    ]
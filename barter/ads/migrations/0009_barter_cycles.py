@@ -0,0 +1,65 @@
+# Generated by Django 5.2 on 2026-10-18 19:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def create_edges(apps, schema_editor):
+    ExchangeProposal = apps.get_model('ads', 'ExchangeProposal')
+    ProposalEdge = apps.get_model('ads', 'ProposalEdge')
+    proposals = (
+        ExchangeProposal.objects.filter(status='pending').exclude(ad_sender__user=F('ad_receiver__user'))
+        .values_list('id', 'ad_sender__user_id', 'ad_receiver__user_id')
+    )
+    edges = (
+        ProposalEdge(proposal_id=pk, source_user_id=source, target_user_id=target)
+        for pk, source, target in proposals.iterator(chunk_size=2000)
+    )
+    ProposalEdge.objects.bulk_create(edges, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0008_ad_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BarterCycle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BarterCycleStep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('cycle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='steps', to='ads.bartercycle')),
+                ('proposal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cycle_steps', to='ads.exchangeproposal')),
+            ],
+            options={
+                'ordering': ['cycle', 'position'],
+                'constraints': [models.UniqueConstraint(fields=('cycle', 'position'), name='barter_cycle_step_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProposalEdge',
+            fields=[
+                ('proposal', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='edge', serialize=False, to='ads.exchangeproposal')),
+                ('source_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('target_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['target_user', 'source_user'], name='proposal_edge_target_idx')],
+            },
+        ),
+        # Рёбра для уже ожидающих предложений
+        migrations.RunPython(create_edges, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def install_search_vocabulary(apps, schema_editor):
+    from ads.search import get_backend
+    get_backend(schema_editor.connection.alias).install_vocabulary()
+
+
+def uninstall_search_vocabulary(apps, schema_editor):
+    from ads.search import get_backend
+    get_backend(schema_editor.connection.alias).uninstall_vocabulary()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0009_barter_cycles'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_vocabulary, uninstall_search_vocabulary),
+    ]
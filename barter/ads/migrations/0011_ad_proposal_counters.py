@@ -0,0 +1,54 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_proposals(apps, schema_editor):
+    # Начальные значения по существующим предложениям; дальше счётчики ведёт ads.counters
+    Ad = apps.get_model('ads', 'Ad')
+    ExchangeProposal = apps.get_model('ads', 'ExchangeProposal')
+
+    def counted(field, **filters):
+        totals = (
+            ExchangeProposal.objects.filter(**{field: OuterRef('pk')}, **filters)
+            .values(field).annotate(total=Count('pk')).values('total')
+        )
+        return Coalesce(Subquery(totals), 0)
+
+    Ad.objects.update(
+        received_count=counted('ad_receiver'),
+        pending_count=counted('ad_receiver', status='pending'),
+        accepted_count=counted('ad_receiver', status='accepted'),
+        sent_count=counted('ad_sender'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0010_ad_search_vocabulary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='accepted_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='pending_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='received_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_proposals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 20:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0013_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='view_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2 on 2026-10-18 20:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0014_view_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='popularity',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='popularity_stale',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['popularity', 'id'], name='ad_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['condition', 'popularity', 'id'], name='ad_condition_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['category', 'popularity', 'id'], name='ad_category_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(condition=models.Q(('popularity_stale', True)), fields=['id'], name='ad_popularity_stale_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 21:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0015_popularity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='counters_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
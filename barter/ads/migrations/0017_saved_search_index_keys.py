@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def reindex_saved_searches(apps, schema_editor):
+    # Ключи поисков со словами на «ё» и «й» строились со снятой диакритикой
+    from ads.percolator import index_key
+    SavedSearch = apps.get_model('ads', 'SavedSearch')
+    changed = []
+    for search in SavedSearch.objects.using(schema_editor.connection.alias).exclude(query=''):
+        key = index_key(search.query, search.category, search.condition)
+        if key != search.index_key:
+            search.index_key = key
+            changed.append(search)
+    SavedSearch.objects.using(schema_editor.connection.alias).bulk_update(changed, ['index_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0016_counters_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex_saved_searches, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,54 @@
-from django.db import models
+from django.db import IntegrityError, models
+from django.db.models import Q
 from django.contrib.auth.models import User
+from django.utils.text import slugify
 from django.utils.timezone import now
 
 
+def category_slug(name):
+    """Нормализованный ключ категории: регистр, пробелы и знаки препинания не важны"""
+    return slugify(' '.join(name.split()), allow_unicode=True)
+
+
+class CategoryManager(models.Manager):
+    def lookup(self, name):
+        """Категория по названию в любом написании; новая возвращается несохранённой (для проверки ввода)"""
+        name = ' '.join(name.split())
+        slug = category_slug(name)
+        found = {category.slug == slug: category for category in self.filter(Q(slug=slug) | Q(name=name))}
+        return found.get(True) or found.get(False) or self.model(name=name, slug=slug)
+
+    def persist(self, category):
+        """Сохранённая категория для результата ``lookup`` (вызывать в транзакции записи объявления)"""
+        if category.pk is not None:
+            return category
+        try:
+            category, _ = self.get_or_create(slug=category.slug, defaults={'name': category.name})
+        except IntegrityError:  # Параллельный запрос создал категорию с тем же названием
+            category = self.lookup(category.name)
+        return category
+
+    def resolve(self, name):
+        """Возвращает категорию по названию в любом написании, создавая её при необходимости"""
+        return self.persist(self.lookup(name))
+
+
+class Category(models.Model):
+    """Категория объявлений"""
+    name = models.CharField(max_length=100, unique=True)
+    slug = models.SlugField(max_length=100, unique=True, allow_unicode=True)
+    parent = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='children')
+    ad_count = models.PositiveIntegerField(default=0)  # Поддерживается сигналами ads.signals
+
+    objects = CategoryManager()
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
 class Ad(models.Model):
     """Модель объявления"""
     CONDITION_CHOICES = [
@@ -15,14 +61,53 @@ class Ad(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField()
     image_url = models.URLField(blank=True, null=True)
-    category = models.CharField(max_length=100)
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name='ads')
     condition = models.CharField(max_length=10, choices=CONDITION_CHOICES)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Версия объявления для кэша фрагментов
+    # Счётчики предложений (ads.counters): входящие всего, из них ожидающие и принятые; исходящие
+    received_count = models.PositiveIntegerField(default=0, editable=False)
+    pending_count = models.PositiveIntegerField(default=0, editable=False)
+    accepted_count = models.PositiveIntegerField(default=0, editable=False)
+    sent_count = models.PositiveIntegerField(default=0, editable=False)
+    COUNTER_FIELDS = ['received_count', 'pending_count', 'accepted_count', 'sent_count']
+    # Версия счётчиков для ETag и кэша фрагментов: updated_at меняет только правка объявления
+    counters_version = models.PositiveIntegerField(default=0, editable=False)
+    # Просмотры страницы (ads.viewcounts): пишутся пачками раз в интервал, без смены updated_at
+    view_count = models.PositiveIntegerField(default=0, editable=False)
+    # Оценка для ?ordering=popular (ads.popularity); stale — счётчики изменились после пересчёта
+    popularity = models.FloatField(default=0, editable=False)
+    popularity_stale = models.BooleanField(default=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Лента и keyset-пагинация: ORDER BY created_at DESC, id DESC
+            models.Index(fields=['created_at', 'id'], name='ad_created_idx'),
+            # Фильтр по состоянию с той же сортировкой
+            models.Index(fields=['condition', 'created_at', 'id'], name='ad_condition_created_idx'),
+            # Фильтр по категории с той же сортировкой
+            models.Index(fields=['category', 'created_at', 'id'], name='ad_category_created_idx'),
+            # Те же три выборки с сортировкой ?ordering=popular: ORDER BY popularity DESC, id DESC
+            models.Index(fields=['popularity', 'id'], name='ad_popular_idx'),
+            models.Index(fields=['condition', 'popularity', 'id'], name='ad_condition_popular_idx'),
+            models.Index(fields=['category', 'popularity', 'id'], name='ad_category_popular_idx'),
+            # Объявления, ждущие пересчёта популярности
+            models.Index(fields=['id'], condition=models.Q(popularity_stale=True), name='ad_popularity_stale_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
 
+class ConditionCounter(models.Model):
+    """Число объявлений в каждом состоянии (фасет фильтра, поддерживается сигналами)"""
+    condition = models.CharField(max_length=10, choices=Ad.CONDITION_CHOICES, primary_key=True)
+    ad_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.get_condition_display()}: {self.ad_count}'
+
+
 class ExchangeProposal(models.Model):
     """Модель предложения обмена"""
     STATUS_CHOICES = [
@@ -38,5 +123,122 @@ class ExchangeProposal(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(default=now)
 
+    class Meta:
+        indexes = [
+            # Входящие и исходящие предложения пользователя с фильтром по статусу
+            models.Index(fields=['ad_receiver', 'status', 'created_at'], name='proposal_receiver_status_idx'),
+            models.Index(fields=['ad_sender', 'status', 'created_at'], name='proposal_sender_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Предложение от {self.ad_sender.user.username} к {self.ad_receiver.user.username}"
+
+
+class ProposalEdge(models.Model):
+    """Ребро графа обменов «отправитель → получатель» для ожидающего предложения.
+
+    Индекс смежности для поиска обменов по кругу (ads.cycles): пользователи
+    хранятся прямо в строке, поэтому соседи ищутся по индексу без соединения
+    с объявлениями. Поддерживается сигналами ads.signals.
+    """
+    proposal = models.OneToOneField(ExchangeProposal, on_delete=models.CASCADE, primary_key=True, related_name='edge')
+    source_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    target_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        indexes = [
+            # Обратный обход: кто хочет объявления этих пользователей
+            models.Index(fields=['target_user', 'source_user'], name='proposal_edge_target_idx'),
+        ]
+
+
+class BarterCycle(models.Model):
+    """Обмен по кругу: каждый участник получает объявление, которое хотел"""
+    key = models.CharField(max_length=255, unique=True)  # id предложений по кругу, начиная с меньшего
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Обмен по кругу {self.key}'
+
+
+class BarterCycleStep(models.Model):
+    """Шаг обмена: отправитель предложения получает объявление получателя"""
+    cycle = models.ForeignKey(BarterCycle, on_delete=models.CASCADE, related_name='steps')
+    proposal = models.ForeignKey(ExchangeProposal, on_delete=models.CASCADE, related_name='cycle_steps')
+    position = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['cycle', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['cycle', 'position'], name='barter_cycle_step_unique'),
+        ]
+
+
+class SavedSearch(models.Model):
+    """Сохранённый поиск: новые подходящие объявления попадают в ленту пользователя (ads.percolator)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='saved_searches')
+    query = models.CharField(max_length=255, blank=True)  # Слова запроса через пробел, как в ключе кэша списка
+    category = models.CharField(max_length=100, blank=True)  # slug категории
+    condition = models.CharField(max_length=10, choices=Ad.CONDITION_CHOICES, blank=True)
+    # Ключ инвертированного индекса: самое длинное слово запроса, иначе категория, состояние или «*»
+    index_key = models.CharField(max_length=110)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['index_key'], name='saved_search_key_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'query', 'category', 'condition'], name='saved_search_unique'),
+        ]
+
+    def __str__(self):
+        parts = [self.query, self.category, self.get_condition_display() if self.condition else '']
+        return ' · '.join(part for part in parts if part) or 'Все объявления'
+
+
+class SavedSearchMatch(models.Model):
+    """Новое объявление в ленте сохранённых поисков пользователя"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')  # Владелец поиска
+    search = models.ForeignKey(SavedSearch, on_delete=models.CASCADE, related_name='matches')
+    ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name='+')
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Лента пользователя по новизне и число непрочитанных
+            models.Index(fields=['user', '-id'], name='saved_search_match_feed_idx'),
+            models.Index(fields=['user', 'is_read'], name='saved_search_match_unread_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['search', 'ad'], name='saved_search_match_unique'),
+        ]
+
+
+class Job(models.Model):
+    """Фоновая задача в очереди на основной базе (ads.jobs)"""
+    STATUS_CHOICES = [
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('failed', 'Ошибка'),
+    ]
+
+    task = models.CharField(max_length=100)  # Имя из реестра ads.jobs
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=now)  # Не раньше: повторы откладываются с растущей паузой
+    locked_by = models.CharField(max_length=64, blank=True)  # Воркер и номер выборки
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_claim_idx'),
+        ]
+
     def __str__(self):
-        return f"Предложение от {self.ad_sender.user.username} к {self.ad_receiver.user.username}"
\ No newline at end of file
+        return f'{self.task} #{self.pk} ({self.get_status_display()})'
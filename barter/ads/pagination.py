@@ -0,0 +1,251 @@
+"""Курсорная (keyset) пагинация.
+
+Вместо ``OFFSET N`` и ``COUNT(*)`` страница выбирается условием
+``(created_at, id) < (курсор)`` по индексу, поэтому время ответа не зависит
+от номера страницы. Курсор — непрозрачная base64-строка с позицией
+граничной записи и направлением.
+
+Исключение — выдача поиска, отсортированная по релевантности
+(``ads.search.search_ads``): ранг вычисляется при запросе и зависит от
+статистики индекса, условия «после позиции» по нему не построить, поэтому
+такие страницы выбираются смещением, а курсор хранит его. Выдача поиска
+ограничена совпадениями, и смещение остаётся небольшим.
+"""
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+DEFAULT_ORDERING = ('-created_at', '-id')
+POPULAR_ORDERING = ('-popularity', '-id')  # ?ordering=popular (ads.popularity)
+RANK_ORDERING = '-search_rank'  # Релевантность поиска (ads.search.search_ads)
+
+
+class InvalidCursor(Exception):
+    """Курсор повреждён или не подходит к сортировке"""
+
+
+class KeysetPage:
+    """Страница keyset-пагинации (аналог ``django.core.paginator.Page`` без номеров)"""
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Пагинатор по составному ключу сортировки (по умолчанию ``-created_at, -id``).
+
+    Последнее поле сортировки должно быть уникальным, чтобы позиция
+    однозначно определяла запись.
+    """
+
+    def __init__(self, queryset, per_page, ordering=DEFAULT_ORDERING):
+        self.queryset = queryset
+        self.per_page = per_page
+        # Выдача поиска: сначала релевантность, затем ``ordering``, страницы по смещению
+        self.ranked = tuple(queryset.query.order_by[:1]) == (RANK_ORDERING,)
+        self.ordering = (RANK_ORDERING, *ordering) if self.ranked else tuple(ordering)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+
+    # Кодирование курсора
+
+    def encode_cursor(self, obj, reverse):
+        """Курсор, указывающий на запись ``obj`` (модель или словарь из values())"""
+        if isinstance(obj, dict):
+            obj = _ValuesRow(obj)
+        values = [self.model_field(name).value_to_string(obj) for name in self.fields]
+        data = json.dumps({'p': values, 'r': reverse}, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    def encode_offset(self, offset):
+        data = json.dumps({'o': offset}, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    def decode_offset(self, cursor):
+        try:
+            offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))['o']
+        except (ValueError, KeyError, TypeError):
+            raise InvalidCursor
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise InvalidCursor
+        return offset
+
+    def decode_cursor(self, cursor):
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            payload = json.loads(data)
+            values = payload['p']
+            reverse = bool(payload['r'])
+            if len(values) != len(self.fields):
+                raise InvalidCursor
+            position = [self.model_field(name).to_python(value) for name, value in zip(self.fields, values)]
+        except (ValueError, KeyError, TypeError, ValidationError):
+            raise InvalidCursor
+        return position, reverse
+
+    def model_field(self, name):
+        if name == 'pk':
+            return self.queryset.model._meta.pk
+        return self.queryset.model._meta.get_field(name)
+
+    # Выборка страницы
+
+    def after(self, position, reverse):
+        """Условие «строго после позиции» в лексикографическом порядке ключа"""
+        condition = Q()
+        for index, (name, value) in enumerate(zip(self.fields, position)):
+            step = Q(**{f'{name}__{self.lookup(index, reverse)}': value})
+            for previous_name, previous_value in zip(self.fields[:index], position[:index]):
+                step &= Q(**{previous_name: previous_value})
+            condition |= step
+        # Нестрогая граница по первому полю даёт СУБД диапазон для поиска по индексу
+        bound = Q(**{f'{self.fields[0]}__{self.lookup(0, reverse)}e': position[0]})
+        return bound & condition
+
+    def lookup(self, index, reverse):
+        descending = self.ordering[index].startswith('-') != reverse
+        return 'lt' if descending else 'gt'
+
+    def reversed_ordering(self):
+        return [field[1:] if field.startswith('-') else f'-{field}' for field in self.ordering]
+
+    def page_queryset(self, cursor=None):
+        if self.ranked:
+            offset = self.decode_offset(cursor) if cursor else 0
+            return self.queryset.order_by(*self.ordering)[offset:offset + self.per_page + 1], offset, False
+        position, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+        queryset = self.queryset.order_by(*(self.reversed_ordering() if reverse else self.ordering))
+        if position is not None:
+            queryset = queryset.filter(self.after(position, reverse))
+        return queryset[:self.per_page + 1], position, reverse
+
+    def build_page(self, rows, position, reverse):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if self.ranked:  # position — смещение страницы
+            return KeysetPage(
+                rows,
+                self.encode_offset(position + self.per_page) if has_more else None,
+                self.encode_offset(max(position - self.per_page, 0)) if position else None,
+            )
+        if reverse:
+            rows.reverse()
+        # При движении назад следующая страница есть всегда (мы с неё пришли),
+        # при движении вперёд предыдущая есть, если задан курсор
+        has_next = True if reverse else has_more
+        has_previous = has_more if reverse else position is not None
+        next_cursor = self.encode_cursor(rows[-1], False) if rows and has_next else None
+        previous_cursor = self.encode_cursor(rows[0], True) if rows and has_previous else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+    def page(self, cursor=None):
+        queryset, position, reverse = self.page_queryset(cursor)
+        return self.build_page(list(queryset), position, reverse)
+
+
+class _ValuesRow:
+    """Обёртка над словарём из values(), чтобы value_to_string читал поля как атрибуты"""
+
+    def __init__(self, row):
+        self.__dict__.update(row)
+
+
+class AdKeysetPagination(BasePagination):
+    """Keyset-пагинация для API: ответ ``{next, previous, results}`` без подсчёта строк"""
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = DEFAULT_ORDERING
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        paginator = KeysetPaginator(queryset, self.get_page_size(request), self.get_ordering(view))
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound('Некорректный курсор.')
+        return list(self.page)
+
+    def get_ordering(self, view):
+        """Ключ сортировки: ``view.get_ordering()`` (зависит от запроса), если view его задаёт"""
+        if view is not None and hasattr(view, 'get_ordering'):
+            return view.get_ordering()
+        return self.ordering
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_link(self.page.next_cursor)),
+            ('previous', self.get_link(self.page.previous_cursor)),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Курсор страницы из полей next/previous',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': f'Размер страницы (не больше {self.max_page_size})',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class FeedPagination(AdKeysetPagination):
+    """Лента сохранённых поисков: по id записи, новые первыми"""
+    ordering = ('-id',)
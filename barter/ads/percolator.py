@@ -0,0 +1,156 @@
+"""Сохранённые поиски и подбор их под новые объявления.
+
+Поиск сохраняется в том же виде, что и фильтр главной (``AdFilterForm``):
+все слова запроса должны быть началами слов заголовка или описания, а
+категория и состояние — совпадать, если заданы. Слова запроса и объявления
+приводятся к виду, в котором их хранит поисковый индекс (``terms`` бэкенда
+``ads.search``), поэтому поиск подбирает те же объявления, что и список.
+
+Чтобы не проверять каждое новое объявление по всем поискам, у поиска есть
+один ключ инвертированного индекса (``SavedSearch.index_key``): самое длинное
+слово запроса (не длиннее ``KEY_LENGTH``), а без слов — категория, состояние
+или ``*``. Объявление порождает набор ключей — все начала своих слов,
+свою категорию, своё состояние и ``*`` — и запросом по индексу
+получает только поиски, которые могут ему подойти; остальные условия
+проверяются в Python. Ключ — необходимое условие совпадения, поэтому
+подходящие поиски не теряются.
+
+Подобранные объявления записываются в ленту владельца поиска
+(``SavedSearchMatch``); свои объявления в ленту не попадают. Изменённые
+объявления повторно не подбираются. Подбор выполняется фоновой задачей
+``ads.percolate`` (``ads.jobs``), а не в запросе, создавшем объявление.
+"""
+from collections import defaultdict
+
+from django.db.models import Count, Q
+
+from . import jobs
+from .models import Ad, SavedSearch, SavedSearchMatch, category_slug
+from .search import get_backend, tokenize
+
+KEY_LENGTH = 32  # Длиннее слова различаются и по первым 32 символам
+ANY_KEY = '*'
+QUERY_CHUNK_SIZE = 500  # Ключей в одном IN (...)
+
+
+def query_terms(query):
+    """Слова как в индексе поиска: в SQLite «é» → «e», а «ё» и «й» остаются"""
+    return get_backend().terms(query or '')
+
+
+def normalize(query='', category='', condition=''):
+    """Поля поиска в каноническом виде: разные написания фильтра дают один поиск"""
+    return {
+        'query': ' '.join(tokenize(query or '')),
+        'category': category_slug(category) if category else '',
+        'condition': condition or '',
+    }
+
+
+def index_key(query, category, condition):
+    terms = query_terms(query)
+    if terms:
+        return max(terms, key=len)[:KEY_LENGTH]
+    if category:
+        return f'category:{category}'
+    if condition:
+        return f'condition:{condition}'
+    return ANY_KEY
+
+
+def save_search(user, query='', category='', condition=''):
+    """Сохраняет поиск пользователя (повторное сохранение возвращает прежний)"""
+    fields = normalize(query, category, condition)
+    search, _ = SavedSearch.objects.get_or_create(
+        user=user, **fields, defaults={'index_key': index_key(**fields)},
+    )
+    return search
+
+
+def ad_words(ad):
+    return set(query_terms(f'{ad.title} {ad.description}'))
+
+
+def ad_keys(ad, words):
+    keys = {ANY_KEY, f'category:{ad.category.slug}', f'condition:{ad.condition}'}
+    for word in words:
+        keys.update(word[:length] for length in range(1, min(len(word), KEY_LENGTH) + 1))
+    return keys
+
+
+def matches(search, ad, words):
+    """Подходит ли объявление под поиск (как фильтр главной)"""
+    if search.category and search.category != ad.category.slug:
+        return False
+    if search.condition and search.condition != ad.condition:
+        return False
+    return all(any(word.startswith(term) for word in words) for term in query_terms(search.query))
+
+
+def candidates(keys):
+    """{ключ: [поиски]} для ключей объявлений"""
+    keys, found = sorted(keys), defaultdict(list)
+    for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+        searches = SavedSearch.objects.filter(index_key__in=keys[start:start + QUERY_CHUNK_SIZE]).only(
+            'id', 'user_id', 'query', 'category', 'condition', 'index_key',
+        )
+        for search in searches:
+            found[search.index_key].append(search)
+    return found
+
+
+def percolate(ads):
+    """Записывает новые объявления в ленты подходящих поисков; возвращает число записей.
+
+    Кандидаты для всех объявлений загружаются вместе: для массовой загрузки
+    через API число запросов зависит от числа разных ключей, а не объявлений.
+    """
+    ads_order = {ad.pk: position for position, ad in enumerate(ads)}
+    words = [ad_words(ad) for ad in ads]
+    keys = [ad_keys(ad, own_words) for ad, own_words in zip(ads, words)]
+    searches = candidates(set().union(*keys))
+    found = [
+        SavedSearchMatch(user_id=search.user_id, search_id=search.pk, ad_id=ad.pk)
+        for ad, own_words, own_keys in zip(ads, words, keys)
+        for key in own_keys
+        for search in searches.get(key, ())
+        if search.user_id != ad.user_id and matches(search, ad, own_words)
+    ]
+    found.sort(key=lambda match: (ads_order[match.ad_id], match.search_id))  # Порядок ленты не зависит от хешей
+    SavedSearchMatch.objects.bulk_create(found, ignore_conflicts=True)
+    return len(found)
+
+
+@jobs.task('ads.percolate')
+def percolate_ads(ads):
+    """Задача: подбор поисков под объявления с id из ``ads`` (удалённые пропускаются)"""
+    return percolate(list(Ad.objects.filter(pk__in=ads).select_related('category')))
+
+
+def percolate_later(ads):
+    """Ставит подбор новых объявлений в очередь фоновых задач в текущей транзакции"""
+    if ads:
+        jobs.enqueue('ads.percolate', {'ads': [ad.pk for ad in ads]})
+
+
+def with_unread(searches):
+    return searches.annotate(unread_count=Count('matches', filter=Q(matches__is_read=False)))
+
+
+def unread_count(user):
+    return SavedSearchMatch.objects.filter(user=user, is_read=False).count()
+
+
+def feed(user, search=None):
+    """Лента новых объявлений пользователя, новые первыми"""
+    queryset = SavedSearchMatch.objects.filter(user=user)
+    if search is not None:
+        queryset = queryset.filter(search=search)
+    return queryset.select_related('ad__category', 'search').order_by('-id')
+
+
+def mark_read(user, search=None):
+    queryset = SavedSearchMatch.objects.filter(user=user, is_read=False)
+    if search is not None:
+        queryset = queryset.filter(search=search)
+    return queryset.update(is_read=True)
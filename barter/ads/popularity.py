@@ -0,0 +1,61 @@
+"""Популярность объявлений: сортировка списка и API по ``?ordering=popular``.
+
+Вес объявления — входящие предложения и просмотры, затухающие
+экспоненциально с возрастом объявления: вдвое за ``ADS_POPULAR_HALF_LIFE``
+секунд. Хранится не сам вес, а его логарифм со сдвигом на время создания::
+
+    popularity = log2(1 + вовлечённость) + created_at / half_life
+
+Это логарифм веса ``(1 + вовлечённость) * 2 ** (-возраст / half_life)`` плюс
+общее для всех объявлений ``now / half_life``, поэтому порядок тот же, а
+оценка со временем не меняется: пересчитывать нужно только объявления,
+у которых изменились счётчики. Их помечает ``popularity_stale`` (новые
+объявления, ``ads.counters``, ``ads.viewcounts``), и
+``manage.py update_popularity``, запускаемая периодически (cron), обходит
+только помеченные объявления пачками по частичному индексу. Сортировка
+идёт по индексам ``(popularity, id)`` так же, как лента по
+``(created_at, id)``; новое объявление попадает в популярные после
+ближайшего пересчёта.
+"""
+import math
+
+from django.conf import settings
+from django.db import transaction
+
+from . import caching
+from .models import Ad
+
+SCORE_FIELDS = ['pk', 'received_count', 'view_count', 'created_at']
+
+
+def score(received, views, created_at):
+    engagement = settings.ADS_POPULAR_PROPOSAL_WEIGHT * received + settings.ADS_POPULAR_VIEW_WEIGHT * views
+    return math.log2(1 + engagement) + created_at.timestamp() / settings.ADS_POPULAR_HALF_LIFE
+
+
+def rescore(chunk_size=None, everything=False, progress=None):
+    """Пересчитывает оценки помеченных (или всех) объявлений пачками; возвращает число пересчитанных.
+
+    Пачка читается и пишется в одной транзакции, поэтому просмотры и
+    предложения, записанные между чтением и записью, не потеряются: они
+    снова пометят объявление.
+    """
+    chunk_size = chunk_size or settings.ADS_POPULAR_CHUNK_SIZE
+    progress = progress or (lambda message: None)
+    ads = Ad.objects.all() if everything else Ad.objects.filter(popularity_stale=True)
+    rescored, last = 0, 0
+    while True:
+        with transaction.atomic():
+            chunk = list(ads.filter(pk__gt=last).select_for_update().order_by('pk').only(*SCORE_FIELDS)[:chunk_size])
+            for ad in chunk:
+                ad.popularity = score(ad.received_count, ad.view_count, ad.created_at)
+                ad.popularity_stale = False
+            Ad.objects.bulk_update(chunk, ['popularity', 'popularity_stale'])  # Без updated_at: кэш карточек цел
+        if not chunk:
+            break
+        last = chunk[-1].pk
+        rescored += len(chunk)
+        progress(f'Пересчитано объявлений: {rescored}')
+    if rescored:
+        caching.invalidate_popular()
+    return rescored
@@ -0,0 +1,113 @@
+"""Похожие объявления: самые весомые по TF-IDF слова объявления ищутся в индексе ``ads.search``.
+
+Кандидаты ранжируются по bm25 с надбавкой за ту же категорию; статистика
+слов и списки похожих кэшируются.
+"""
+import math
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+
+from .caching import make_key
+from .models import Ad, ConditionCounter
+from .search import get_backend
+
+TITLE_WEIGHT = 2
+CATEGORY_BOOST = 1.5
+MIN_TERM_LENGTH = 3  # Предлоги и союзы не отличают одно объявление от другого
+STATS_PREFIX = 'ads:similar:df'
+
+
+def ad_terms(ad, using='default'):
+    """Частоты слов объявления (в виде, как в индексе) с учётом веса заголовка"""
+    backend = get_backend(using)
+    terms = Counter()
+    for text, weight in ((ad.title, TITLE_WEIGHT), (ad.description, 1), (ad.category.name, 1)):
+        for term in backend.terms(text):
+            if len(term) >= MIN_TERM_LENGTH and not term.isdigit():
+                terms[term] += weight
+    return terms
+
+
+def stats_key(term):
+    return make_key(term, prefix=STATS_PREFIX)
+
+
+def document_stats(terms, using='default'):
+    """Число объявлений и {слово: число объявлений с ним}, по возможности из кэша"""
+    keys = {stats_key(term): term for term in terms}
+    count_key = f'{STATS_PREFIX}:total'
+    cached = cache.get_many([count_key, *keys])
+    total = cached.pop(count_key, None)
+    frequencies = {keys[key]: value for key, value in cached.items()}
+    missing = [term for term in terms if term not in frequencies]
+    timeout = settings.ADS_SIMILAR_STATS_TIMEOUT
+    if total is None:
+        # Сумма счётчиков фасетов вместо COUNT(*) по таблице объявлений
+        total = ConditionCounter.objects.using(using).aggregate(total=Sum('ad_count'))['total'] or 0
+        cache.set(count_key, total, timeout)
+    if missing:
+        counted = get_backend(using).document_frequencies(missing)
+        counted = {term: counted.get(term, 0) for term in missing}
+        cache.set_many({stats_key(term): value for term, value in counted.items()}, timeout)
+        frequencies.update(counted)
+    return total, frequencies
+
+
+def query_terms(ad, using='default'):
+    """Самые весомые по TF-IDF слова объявления"""
+    terms = ad_terms(ad, using)
+    if not terms:
+        return []
+    total, frequencies = document_stats(list(terms), using)
+    if not any(frequencies.values()):
+        # Без статистики (другая СУБД) слова ранжируются только по частоте
+        frequencies = dict.fromkeys(terms, 1)
+    # Слов, которых нет в индексе (например, из названия категории), нет и в других объявлениях
+    weights = {
+        term: count * math.log(1 + max(total, 1) / frequencies[term])
+        for term, count in terms.items() if frequencies.get(term)
+    }
+    return sorted(weights, key=lambda term: (-weights[term], term))[:settings.ADS_SIMILAR_TERMS]
+
+
+def similar_ids(ad, limit, using='default'):
+    terms = query_terms(ad, using)
+    if not terms:
+        return []
+    scores = {}
+    for pk, category_id, score in get_backend(using).similar(terms, settings.ADS_SIMILAR_CANDIDATES):
+        if pk != ad.pk:
+            scores[pk] = score * (CATEGORY_BOOST if category_id == ad.category_id else 1)
+    return sorted(scores, key=lambda pk: (-scores[pk], -pk))[:limit]
+
+
+def cache_key(ad, limit):
+    return f'ads:similar:{ad.pk}:{ad.updated_at.timestamp()}:{limit}'
+
+
+def similar_ads(ad, limit=None):
+    """До ``limit`` похожих объявлений, самые похожие первыми.
+
+    Без совпадений по словам (или без полнотекстового индекса у СУБД) —
+    последние объявления той же категории.
+    """
+    limit = limit or settings.ADS_SIMILAR_LIMIT
+    queryset = Ad.objects.select_related('category')
+    key = cache_key(ad, limit)
+    ids = cache.get(key)
+    if ids is None:
+        ids = similar_ids(ad, limit, queryset.db)
+        if not ids:
+            ids = list(
+                Ad.objects.using(queryset.db).filter(category=ad.category_id).exclude(pk=ad.pk)
+                .order_by('-created_at', '-id').values_list('id', flat=True)[:limit]
+            )
+        cache.set(key, ids, settings.ADS_SIMILAR_CACHE_TIMEOUT)
+    if not ids:
+        return []
+    ads = queryset.in_bulk(ids)
+    # Удалённые после кэширования объявления просто пропускаются
+    return [ads[pk] for pk in ids if pk in ads]
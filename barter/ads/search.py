@@ -0,0 +1,265 @@
+"""Полнотекстовый поиск: FTS5 в SQLite, ``tsvector`` в PostgreSQL, ``icontains`` в прочих СУБД.
+
+Индекс обновляют триггеры или генерируемая колонка, поэтому он актуален и после ``bulk_create``/``update``.
+"""
+import re
+import unicodedata
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Ad
+
+TOKEN_RE = re.compile(r'\w+')
+FTS_TOKEN_RE = re.compile(r'[^\W_]+')  # unicode61 делит слова и по «_»
+LATIN_END = '\u0250'  # remove_diacritics снимает знаки только с латиницы: «й» и «ё» остаются
+MAX_TERMS = 16  # Ограничение на число слов в запросе
+
+PG_CONFIG = 'russian'
+PG_VECTOR_COLUMN = 'search_vector'
+
+
+def tokenize(text):
+    """Разбивает строку на слова в нижнем регистре"""
+    return TOKEN_RE.findall(text.lower())
+
+
+class FallbackSearchBackend:
+    """Поиск подстроки без индекса (для СУБД без полнотекстового поиска)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.table = Ad._meta.db_table
+
+    def search(self, queryset, terms):
+        for term in terms:
+            queryset = queryset.filter(Q(title__icontains=term) | Q(description__icontains=term))
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    def terms(self, text):
+        """Слова текста в том виде, в каком их хранит индекс"""
+        return tokenize(text)
+
+    def similar(self, terms, limit):
+        """[(id, category_id, оценка)] ``limit`` самых релевантных объявлений с любым из слов"""
+        return []
+
+    def document_frequencies(self, terms):
+        """{слово: число объявлений с ним}; пусто, если СУБД не даёт статистики"""
+        return {}
+
+    def install(self):
+        pass
+
+    def install_vocabulary(self):
+        """Таблица статистики слов для ``document_frequencies``"""
+        pass
+
+    def uninstall_vocabulary(self):
+        pass
+
+    def repair(self):
+        """Восстанавливает индекс после миграций, если он был создан"""
+        pass
+
+    def uninstall(self):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class SQLiteSearchBackend(FallbackSearchBackend):
+    """FTS5 с синхронизацией через триггеры"""
+
+    @property
+    def fts_table(self):
+        return f'{self.table}_fts'
+
+    @property
+    def vocabulary_table(self):
+        return f'{self.table}_fts_vocab'
+
+    def match_expression(self, terms):
+        # Каждое слово в кавычках и с "*" — поиск по префиксу, как было с icontains
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def terms(self, text):
+        # Как токенизатор индекса (unicode61, remove_diacritics 2): нижний регистр, «é» → «e»
+        terms = []
+        for term in FTS_TOKEN_RE.findall(text.lower()):
+            chars = []
+            for char in unicodedata.normalize('NFD', term):
+                if not (unicodedata.combining(char) and chars and chars[-1] < LATIN_END):
+                    chars.append(char)
+            terms.append(unicodedata.normalize('NFC', ''.join(chars)))
+        return terms
+
+    def similar(self, terms, limit):
+        # Кандидатов выбирает сам FTS5 по bm25: ORDER BY rank выполняет виртуальная
+        # таблица, и строки объявлений читаются только для limit лучших совпадений
+        fts, table = self.fts_table, self.table
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {fts}.rowid, {table}.category_id, -{fts}.rank FROM {fts} '
+                f'JOIN {table} ON {table}.id = {fts}.rowid '
+                f"WHERE {fts} MATCH %s AND {fts}.rank MATCH 'bm25(2.0, 1.0)' ORDER BY {fts}.rank LIMIT %s",
+                [' OR '.join(f'"{term}"' for term in terms), limit],
+            )
+            return cursor.fetchall()
+
+    def document_frequencies(self, terms):
+        # fts5vocab считает документы обходом списка слова: дорого для частых слов,
+        # поэтому вызывающий код кэширует результат (см. ads.recommendations)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT term, doc FROM {self.vocabulary_table} WHERE term IN ({', '.join(['%s'] * len(terms))})",
+                list(terms),
+            )
+            return dict(cursor.fetchall())
+
+    def search(self, queryset, terms):
+        fts, table = self.fts_table, self.table
+        # Соединение с виртуальной таблицей: MATCH выполняется один раз на запрос.
+        # bm25 возвращает отрицательные значения (меньше — релевантнее)
+        return queryset.extra(
+            tables=[fts],
+            where=[f'{fts}.rowid = {table}.id', f'{fts} MATCH %s'],
+            params=[self.match_expression(terms)],
+            select={'search_rank': f'-bm25({fts})'},
+        )
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.fts_table} USING fts5("
+                f"title, description, content='{self.table}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+        self.install_triggers()
+        self.install_vocabulary()
+        self.rebuild()
+
+    def repair(self):
+        # Пересоздание таблицы при миграциях SQLite удаляет её триггеры
+        if self.fts_table in self.connection.introspection.table_names():
+            self.install_triggers()
+
+    def install_vocabulary(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.vocabulary_table} USING fts5vocab({self.fts_table}, 'row')"
+            )
+
+    def uninstall_vocabulary(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.vocabulary_table}')
+
+    def install_triggers(self):
+        fts, table = self.fts_table, self.table
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {fts}(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, title, description) "
+                f"VALUES ('delete', old.id, old.title, old.description); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF title, description ON {table} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, title, description) "
+                f"VALUES ('delete', old.id, old.title, old.description); "
+                f"INSERT INTO {fts}(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+            )
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            for suffix in ('ai', 'ad', 'au'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {self.fts_table}_{suffix}')
+        self.uninstall_vocabulary()
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.fts_table}')
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('optimize')")
+
+
+class PostgresSearchBackend(FallbackSearchBackend):
+    """tsvector-колонка, которую PostgreSQL пересчитывает сам, и GIN-индекс"""
+
+    @property
+    def index_name(self):
+        return f'{self.table}_search_gin'
+
+    def tsquery(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def search(self, queryset, terms):
+        query = self.tsquery(terms)
+        vector = f'{self.table}.{PG_VECTOR_COLUMN}'
+        matches = RawSQL(f"{vector} @@ to_tsquery('{PG_CONFIG}', %s)", [query], output_field=BooleanField())
+        rank = RawSQL(f"ts_rank({vector}, to_tsquery('{PG_CONFIG}', %s))", [query], output_field=FloatField())
+        return queryset.filter(matches).annotate(search_rank=rank)
+
+    def similar(self, terms, limit):
+        query = ' | '.join(terms)
+        vector = PG_VECTOR_COLUMN
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, category_id, ts_rank({vector}, to_tsquery('{PG_CONFIG}', %s)) AS rank "
+                f"FROM {self.table} WHERE {vector} @@ to_tsquery('{PG_CONFIG}', %s) "
+                f"ORDER BY rank DESC, id DESC LIMIT %s",
+                [query, query, limit],
+            )
+            return cursor.fetchall()
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS {PG_VECTOR_COLUMN} tsvector "
+                f"GENERATED ALWAYS AS ("
+                f"setweight(to_tsvector('{PG_CONFIG}', coalesce(title, '')), 'A') || "
+                f"setweight(to_tsvector('{PG_CONFIG}', coalesce(description, '')), 'B')) STORED"
+            )
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.index_name} ON {self.table} USING GIN ({PG_VECTOR_COLUMN})'
+            )
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX IF EXISTS {self.index_name}')
+            cursor.execute(f'ALTER TABLE {self.table} DROP COLUMN IF EXISTS {PG_VECTOR_COLUMN}')
+
+    def rebuild(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'REINDEX INDEX {self.index_name}')
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend(using='default'):
+    connection = connections[using]
+    return BACKENDS.get(connection.vendor, FallbackSearchBackend)(connection)
+
+
+def search_ads(queryset, query):
+    """Фильтрует объявления по запросу и сортирует по релевантности.
+
+    Добавляет аннотацию ``search_rank`` (больше — релевантнее); прежняя
+    сортировка queryset сохраняется как вторичная.
+    """
+    terms = tokenize(query)[:MAX_TERMS]
+    if not terms:
+        return queryset
+    ordering = queryset.query.order_by or Ad._meta.ordering
+    queryset = get_backend(queryset.db).search(queryset, terms)
+    return queryset.order_by('-search_rank', *ordering)
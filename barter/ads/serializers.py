@@ -1,8 +1,185 @@
+from django.conf import settings
+from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Ad
+from . import percolator
+from .models import (
+    Ad, BarterCycle, BarterCycleStep, Category, ExchangeProposal, SavedSearch, SavedSearchMatch, category_slug,
+)
+
+# Наборы статусов в ответах API; имена перечислений в схеме — SPECTACULAR_SETTINGS['ENUM_NAME_OVERRIDES']
+BULK_STATUSES = ['created', 'updated', 'deleted', 'not_found', 'error']
+TRANSITION_STATUSES = ['accepted', 'rejected']
+PROPOSAL_BULK_STATUSES = ['accepted', 'rejected', 'not_found', 'conflict']
+
+
+class AdUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username']
+
+
+class AdCategorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'slug']
 
 
 class AdSerializer(serializers.ModelSerializer):
+    """Объявление; набор полей задаёт ``FieldSet`` из контекста (``?fields=``, ``?expand=``)"""
+    # Вложенные объекты по ?expand=; имя совпадает со связью модели
+    EXPANDABLE = {'user': AdUserSerializer, 'category': AdCategorySerializer}
+
+    # Категория в API — название; при записи приводится к записи справочника
+    category = serializers.CharField(max_length=100)
+
     class Meta:
         model = Ad
-        fields = ['id', 'title', 'description', 'category', 'condition', 'created_at']
\ No newline at end of file
+        fields = [
+            'id', 'title', 'description', 'category', 'condition', 'created_at', 'updated_at',
+            'received_count', 'pending_count', 'accepted_count', 'sent_count', 'view_count',
+        ]
+        extra_kwargs = {
+            # В отличие от страницы объявления, API не знает о буфере процесса (ads.viewcounts)
+            'view_count': {'help_text': "Записанные просмотры: отстают от страницы объявления "
+                                        "до ADS_VIEWS_FLUSH_INTERVAL секунд"},
+        }
+
+    def get_fields(self):
+        fields = super().get_fields()
+        fieldset = self.context.get('fieldset')
+        return fieldset.select(fields, self.EXPANDABLE) if fieldset else fields
+
+    def validate_category(self, value):
+        slug = category_slug(value)
+        if not slug:
+            raise serializers.ValidationError("Укажите название категории.")
+        # Проверка только ищет категорию: новая создаётся при записи (persist_category).
+        # При массовой загрузке каждая категория ищется один раз на запрос
+        categories = self.context.get('categories')
+        if categories is None:
+            return Category.objects.lookup(value)
+        if slug not in categories:
+            categories[slug] = Category.objects.lookup(value)
+        return categories[slug]
+
+    def create(self, validated_data):
+        return super().create(persist_category(validated_data))
+
+    def update(self, instance, validated_data):
+        # Как AdForm.save: пишутся только переданные поля, вычисляемые не затираются
+        for name, value in persist_category(validated_data).items():
+            setattr(instance, name, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
+
+def persist_category(validated_data):
+    """Сохраняет новую категорию из проверенных данных (вызывать в транзакции записи объявления)"""
+    if 'category' in validated_data:
+        validated_data['category'] = Category.objects.persist(validated_data['category'])
+    return validated_data
+
+
+class BulkResultSerializer(serializers.Serializer):
+    """Результат массовой операции для одного элемента (в порядке запроса)"""
+    id = serializers.IntegerField(allow_null=True)
+    status = serializers.ChoiceField(choices=BULK_STATUSES)
+    errors = serializers.DictField(required=False)
+
+
+class BulkResponseSerializer(serializers.Serializer):
+    results = BulkResultSerializer(many=True)
+
+
+class CategoryFacetSerializer(serializers.ModelSerializer):
+    total_count = serializers.IntegerField()
+    subcategories = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'slug', 'ad_count', 'total_count', 'subcategories']
+
+    def get_subcategories(self, category):
+        return CategoryFacetSerializer(category.subcategories, many=True).data
+
+
+class BarterCycleStepSerializer(serializers.ModelSerializer):
+    """Шаг обмена: ``user`` получает объявление ``ad`` от ``from_user``"""
+    user = serializers.CharField(source='proposal.ad_sender.user.username')
+    ad = serializers.IntegerField(source='proposal.ad_receiver_id')
+    ad_title = serializers.CharField(source='proposal.ad_receiver.title')
+    from_user = serializers.CharField(source='proposal.ad_receiver.user.username')
+
+    class Meta:
+        model = BarterCycleStep
+        fields = ['position', 'proposal', 'user', 'ad', 'ad_title', 'from_user']
+
+
+class BarterCycleSerializer(serializers.ModelSerializer):
+    steps = BarterCycleStepSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = BarterCycle
+        fields = ['id', 'key', 'created_at', 'steps']
+
+
+class ExchangeProposalSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExchangeProposal
+        fields = ['id', 'ad_sender', 'ad_receiver', 'comment', 'status', 'created_at']
+
+
+class ProposalTransitionSerializer(serializers.Serializer):
+    """Новый статус предложения и id отклонённых вместе с ним конкурирующих"""
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=TRANSITION_STATUSES)
+    rejected = serializers.ListField(child=serializers.IntegerField())
+
+
+class ProposalBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), max_length=settings.ADS_BULK_MAX_ITEMS)
+    status = serializers.ChoiceField(choices=TRANSITION_STATUSES)
+
+
+class ProposalBulkResultSerializer(serializers.Serializer):
+    """Результат для одного предложения (в порядке запроса)"""
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=PROPOSAL_BULK_STATUSES)
+    rejected = serializers.ListField(child=serializers.IntegerField(), required=False)
+    detail = serializers.CharField(required=False)
+
+
+class ProposalBulkResponseSerializer(serializers.Serializer):
+    results = ProposalBulkResultSerializer(many=True)
+
+
+class SavedSearchSerializer(serializers.ModelSerializer):
+    """Сохранённый поиск; поля — как параметры фильтра ``/api/ads/``"""
+    unread_count = serializers.IntegerField(read_only=True, default=0)
+
+    class Meta:
+        model = SavedSearch
+        fields = ['id', 'query', 'category', 'condition', 'unread_count', 'created_at']
+
+    def validate(self, attrs):
+        fields = percolator.normalize(**attrs)
+        if not any(fields.values()):
+            raise serializers.ValidationError("Укажите запрос, категорию или состояние.")
+        return fields
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        if user.saved_searches.count() >= settings.ADS_SAVED_SEARCH_LIMIT:
+            raise serializers.ValidationError(
+                f"Можно сохранить не больше {settings.ADS_SAVED_SEARCH_LIMIT} поисков."
+            )
+        return percolator.save_search(user, **validated_data)
+
+
+class SavedSearchMatchSerializer(serializers.ModelSerializer):
+    """Объявление в ленте сохранённого поиска"""
+    ad = AdSerializer(read_only=True)
+
+    class Meta:
+        model = SavedSearchMatch
+        fields = ['id', 'search', 'ad', 'is_read', 'created_at']
@@ -0,0 +1,138 @@
+"""Переходы статусов предложений обмена.
+
+Статус меняется только у ожидающего предложения и только условным
+``UPDATE ... WHERE status = 'pending'``: из одновременных запросов к одному
+предложению изменение применяет один, остальные получают ``ProposalConflict``.
+
+Принятие блокирует оба объявления обмена (``select_for_update`` в порядке id,
+чтобы встречные принятия не ждали друг друга по кругу) и в том же условном
+UPDATE проверяет, что ни одно из них ещё не участвует в принятом обмене.
+Затем все остальные ожидающие предложения с этими объявлениями отклоняются
+одним UPDATE. На SQLite блокировок строк нет, но условие проверяет сам
+UPDATE, а после него транзакция держит блокировку записи всей базы.
+
+``update()`` не вызывает сигналов, поэтому рёбра и циклы графа обменов
+(``ads.cycles``), счётчики объявлений (``ads.counters``) и события для
+открытых страниц (``ads.events``) обновляются здесь же, для всех
+затронутых предложений сразу.
+"""
+from django.db import connection, transaction
+from django.db.models import Exists, Q
+
+from . import counters, cycles, events
+from .models import Ad, ExchangeProposal
+
+
+class ProposalConflict(Exception):
+    """Предложение уже обработано или одно из объявлений уже обменено"""
+
+
+def involving(ad_ids):
+    return Q(ad_sender__in=ad_ids) | Q(ad_receiver__in=ad_ids)
+
+
+def receivable(user):
+    """Предложения, статус которых может менять пользователь: к его объявлениям"""
+    return ExchangeProposal.objects.filter(ad_receiver__user=user)
+
+
+def conflict(proposal_id):
+    status = ExchangeProposal.objects.filter(pk=proposal_id).values_list('status', flat=True).first()
+    if status == 'pending':
+        return ProposalConflict("Одно из объявлений уже участвует в принятом обмене.")
+    return ProposalConflict("Предложение уже обработано.")
+
+
+@transaction.atomic
+def accept(proposal):
+    """Принимает предложение и отклоняет конкурирующие; возвращает id отклонённых"""
+    ads = sorted({proposal.ad_sender_id, proposal.ad_receiver_id})
+    if connection.features.has_select_for_update:  # SQLite запрос пропускает: там FOR UPDATE игнорируется
+        list(Ad.objects.select_for_update().filter(pk__in=ads).order_by('pk').values_list('pk', flat=True))
+    exchanged = ExchangeProposal.objects.filter(involving(ads), status='accepted')
+    updated = ExchangeProposal.objects.filter(~Exists(exchanged), pk=proposal.pk, status='pending').update(
+        status='accepted',
+    )
+    if not updated:
+        raise conflict(proposal.pk)
+    competing = dict(
+        ExchangeProposal.objects.filter(involving(ads), status='pending').values_list('pk', 'ad_receiver')
+    )
+    rejected = list(competing)
+    if rejected:
+        ExchangeProposal.objects.filter(pk__in=rejected, status='pending').update(status='rejected')
+    cycles.forget_proposals([proposal.pk, *rejected])
+    counters.adjust(counters.status_deltas([
+        (proposal.ad_receiver_id, 'pending', 'accepted'),
+        *[(ad_receiver, 'pending', 'rejected') for ad_receiver in competing.values()],
+    ]))
+    events.notify('status', [proposal.pk, *rejected])
+    proposal.status = 'accepted'
+    return rejected
+
+
+@transaction.atomic
+def reject(proposal):
+    if not ExchangeProposal.objects.filter(pk=proposal.pk, status='pending').update(status='rejected'):
+        raise conflict(proposal.pk)
+    cycles.forget_proposals([proposal.pk])
+    counters.adjust(counters.status_deltas([(proposal.ad_receiver_id, 'pending', 'rejected')]))
+    events.notify('status', [proposal.pk])
+    proposal.status = 'rejected'
+    return []
+
+
+TRANSITIONS = {'accepted': accept, 'rejected': reject}
+
+
+def change_status(proposal, status):
+    """Переводит ожидающее предложение в ``status``; возвращает id отклонённых заодно"""
+    if status not in TRANSITIONS:
+        raise ProposalConflict("Предложение можно только принять или отклонить.")
+    return TRANSITIONS[status](proposal)
+
+
+def change_status_many(user, ids, status):
+    """Массовое принятие или отклонение предложений к объявлениям ``user``.
+
+    Результат для каждого id в порядке запроса: ``{'id', 'status', ...}``,
+    где статус — новый статус предложения, ``not_found`` или ``conflict``.
+    Отклонение выполняется одним UPDATE для всех id; принятия идут по
+    порядку, каждое в своей точке сохранения, поэтому конфликт одного
+    (например, два предложения к одному объявлению) не отменяет остальные.
+    """
+    if status not in TRANSITIONS:
+        raise ProposalConflict("Предложение можно только принять или отклонить.")
+    proposals = receivable(user).only('id', 'ad_sender_id', 'ad_receiver_id', 'status').in_bulk(set(ids))
+    outcomes = {}
+    with transaction.atomic():
+        if status == 'rejected':
+            pending = [pk for pk, proposal in proposals.items() if proposal.status == 'pending']
+            rejected = list(
+                ExchangeProposal.objects.select_for_update().filter(pk__in=pending, status='pending')
+                .values_list('pk', flat=True)
+            )
+            ExchangeProposal.objects.filter(pk__in=rejected, status='pending').update(status='rejected')
+            cycles.forget_proposals(rejected)
+            counters.adjust(counters.status_deltas(
+                [(proposals[pk].ad_receiver_id, 'pending', 'rejected') for pk in rejected]
+            ))
+            events.notify('status', rejected)
+            outcomes = {pk: {'status': 'rejected'} for pk in rejected}
+        else:
+            for pk in dict.fromkeys(ids):
+                if pk not in proposals:
+                    continue
+                try:
+                    outcomes[pk] = {'status': 'accepted', 'rejected': accept(proposals[pk])}
+                except ProposalConflict as exc:
+                    outcomes[pk] = {'status': 'conflict', 'detail': str(exc)}
+    results = []
+    for pk in ids:
+        if pk not in proposals:
+            results.append({'id': pk, 'status': 'not_found'})
+        else:
+            results.append({'id': pk, **outcomes.get(pk, {
+                'status': 'conflict', 'detail': "Предложение уже обработано.",
+            })})
+    return results
@@ -0,0 +1,154 @@
+"""Обработчики сигналов моделей объявлений"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import caching, counters, cycles, events, facets, jobs, percolator
+from .models import Ad, ExchangeProposal, ProposalEdge
+
+_suspended = ContextVar('ads_signals_suspended', default=False)
+
+
+@contextmanager
+def suspended():
+    """Отключает обработчики: массовые операции учитывают изменения сами (``bulk_changed``)"""
+    token = _suspended.set(True)
+    try:
+        yield
+    finally:
+        _suspended.reset(token)
+
+
+def bulk_changed(added=(), removed=()):
+    """Счётчики фасетов и кэш списка после массовых операций без сигналов.
+
+    ``added`` и ``removed`` — объявления (или их копии с категорией и
+    состоянием) до и после операции; изменение передаётся парой копий.
+    """
+    category_deltas, condition_deltas = facets.count_ads(added)
+    removed_categories, removed_conditions = facets.count_ads(removed)
+    category_deltas.subtract(removed_categories)
+    condition_deltas.subtract(removed_conditions)
+    facets.adjust_counts(category_deltas, condition_deltas)
+    invalidate_list_cache(*{(ad.category.slug, ad.condition) for ad in [*added, *removed]})
+
+
+@receiver(pre_save, sender=Ad)
+def remember_previous_facets(sender, instance, raw=False, **kwargs):
+    # Старые категория и состояние нужны, чтобы перенести объявление между
+    # счётчиками и сбросить кэш страниц прежней категории
+    instance._previous_facets = None
+    if _suspended.get():
+        return
+    if not raw and not instance._state.adding:
+        instance._previous_facets = (
+            Ad.objects.filter(pk=instance.pk).values_list('category_id', 'condition', 'category__slug').first()
+        )
+
+
+def invalidate_list_cache(*facets):
+    # Сбрасываем после коммита: иначе параллельный запрос успеет закэшировать
+    # страницу со старыми данными под новым поколением
+    transaction.on_commit(lambda: caching.invalidate_scopes(*facets))
+
+
+@receiver(post_save, sender=Ad)
+def update_facet_counts_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw or _suspended.get():
+        return
+    previous = getattr(instance, '_previous_facets', None)
+    current = (instance.category_id, instance.condition)
+    if created or previous is None:
+        facets.adjust_counts({current[0]: 1}, {current[1]: 1})
+    elif previous[:2] != current:
+        facets.adjust_counts(
+            {previous[0]: -1, current[0]: 1} if previous[0] != current[0] else {},
+            {previous[1]: -1, current[1]: 1} if previous[1] != current[1] else {},
+        )
+    scopes = [(instance.category.slug, instance.condition)]
+    if previous is not None and previous[:2] != current:
+        scopes.append((previous[2], previous[1]))
+    invalidate_list_cache(*scopes)
+
+
+@receiver(post_save, sender=Ad)
+def percolate_new_ad(sender, instance, created, raw=False, **kwargs):
+    # Новое объявление — в ленты подходящих сохранённых поисков (фоновой задачей)
+    if created and not raw and not _suspended.get():
+        percolator.percolate_later([instance])
+
+
+@receiver(post_delete, sender=Ad)
+def update_facet_counts_on_delete(sender, instance, **kwargs):
+    if _suspended.get():
+        return
+    facets.adjust_counts({instance.category_id: -1}, {instance.condition: -1})
+    invalidate_list_cache((instance.category.slug, instance.condition))
+
+
+@receiver(pre_save, sender=ExchangeProposal)
+def remember_previous_status(sender, instance, raw=False, **kwargs):
+    # Прежний статус нужен, чтобы перенести предложение между счётчиками объявления
+    instance._previous_status = None
+    if not raw and not instance._state.adding:
+        instance._previous_status = (
+            ExchangeProposal.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def update_proposal_counters(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        counters.adjust(counters.proposal_deltas([instance]))
+        return
+    previous = getattr(instance, '_previous_status', None)
+    if previous is not None and previous != instance.status:
+        counters.adjust(counters.status_deltas([(instance.ad_receiver_id, previous, instance.status)]))
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def publish_proposal_event(sender, instance, created, raw=False, **kwargs):
+    # Открытым страницам отправителя и получателя (ads.events); переходы через ads.services публикуют там
+    if raw:
+        return
+    if created:
+        events.notify('created', [instance.pk])
+    elif getattr(instance, '_previous_status', None) not in (None, instance.status):
+        events.notify('status', [instance.pk])
+
+
+@receiver(post_delete, sender=ExchangeProposal)
+def update_proposal_counters_on_delete(sender, instance, **kwargs):
+    counters.adjust(counters.proposal_deltas([instance], sign=-1))
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def update_proposal_graph(sender, instance, created, raw=False, **kwargs):
+    # Граф ожидающих предложений для поиска обменов по кругу (ads.cycles)
+    if raw:
+        return
+    if instance.status != 'pending':
+        if not created:
+            cycles.forget_proposal(instance)
+        return
+    source_user, target_user = instance.ad_sender.user_id, instance.ad_receiver.user_id
+    if source_user == target_user:
+        return
+    edge = {'source_user_id': source_user, 'target_user_id': target_user}
+    if created:
+        ProposalEdge.objects.create(proposal=instance, **edge)
+    else:
+        # Предложение могли вернуть в ожидание
+        _, created = ProposalEdge.objects.get_or_create(proposal=instance, defaults=edge)
+    if created:
+        jobs.enqueue('ads.find_cycles', {'proposal': instance.pk})
+
+
+@receiver(pre_delete, sender=ExchangeProposal)
+def forget_deleted_proposal(sender, instance, **kwargs):
+    cycles.forget_proposal(instance)
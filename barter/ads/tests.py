@@ -1,9 +1,49 @@
+import asyncio
+import csv
+import datetime
+import gc
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from io import StringIO
+
 from django.core.exceptions import ValidationError
-from django.test import TestCase, Client
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.test import (
+    AsyncClient, AsyncRequestFactory, Client, RequestFactory, TestCase, TransactionTestCase, override_settings,
+)
 from django.contrib.auth.models import User
-from django.urls import reverse
+from django.contrib.sessions.models import Session
+from django.urls import resolve, reverse
+
+from core import db_router, metrics
 
-from .models import Ad, ExchangeProposal
+from . import (
+    async_views, caching, counters, cycles, events, facets, jobs, percolator, popularity, recommendations, search,
+    services, viewcounts,
+)
+from .forms import AdForm
+from .management.commands import run_workers
+from .models import Ad, BarterCycle, Category, ConditionCounter, ExchangeProposal, Job, ProposalEdge, SavedSearch
+from .serializers import AdSerializer
+from .views import AdListView, AdViewSet
 
 
 class AdModelTest(TestCase):
@@ -18,12 +58,12 @@ class AdModelTest(TestCase):
             user=self.user,
             title="Тестовое объявление",
             description="Это тестовое описание.",
-            category="Тестовая категория",
+            category=Category.objects.resolve("Тестовая категория"),
             condition="new"
         )
         self.assertEqual(ad.title, "Тестовое объявление")
         self.assertEqual(ad.description, "Это тестовое описание.")
-        self.assertEqual(ad.category, "Тестовая категория")
+        self.assertEqual(ad.category.name, "Тестовая категория")
         self.assertEqual(ad.condition, "new")
 
     def test_ad_str_method(self):
@@ -32,7 +72,7 @@ class AdModelTest(TestCase):
             user=self.user,
             title="Тестовое объявление",
             description="Описание",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="used"
         )
         self.assertEqual(str(ad), "Тестовое объявление")
@@ -43,7 +83,7 @@ class AdModelTest(TestCase):
             user=self.user,
             title="",  # Пустой заголовок
             description="Описание",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="new"
         )
         with self.assertRaises(ValidationError) as context:
@@ -55,7 +95,7 @@ class AdModelTest(TestCase):
             user=self.user,
             title="Заголовок",
             description="Описание",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="invalid_choice"  # Некорректное значение
         )
         with self.assertRaises(ValidationError) as context:
@@ -75,14 +115,14 @@ class ExchangeProposalModelTest(TestCase):
             user=cls.user1,
             title="Отправитель",
             description="Описание отправителя",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="new"
         )
         cls.ad_receiver = Ad.objects.create(
             user=cls.user2,
             title="Получатель",
             description="Описание получателя",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="used"
         )
 
@@ -129,6 +169,8 @@ class ExchangeProposalModelTest(TestCase):
             )
 
 
+# Тесты страниц проверяют контекст шаблона, которого нет у ответа из кэша
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
 class AdListViewTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -140,14 +182,14 @@ class AdListViewTest(TestCase):
             user=cls.user,
             title="Объявление 1",
             description="Описание 1",
-            category="Категория 1",
+            category=Category.objects.resolve("Категория 1"),
             condition="new"
         )
         Ad.objects.create(
             user=cls.user,
             title="Объявление 2",
             description="Описание 2",
-            category="Категория 2",
+            category=Category.objects.resolve("Категория 2"),
             condition="used"
         )
 
@@ -227,7 +269,7 @@ class AdDetailViewTest(TestCase):
             user=cls.user,
             title="Объявление 1",
             description="Описание 1",
-            category="Категория 1",
+            category=Category.objects.resolve("Категория 1"),
             condition="new"
         )
 
@@ -256,7 +298,7 @@ class AdUpdateViewTest(TestCase):
             user=cls.user,
             title="Объявление 1",
             description="Описание 1",
-            category="Категория 1",
+            category=Category.objects.resolve("Категория 1"),
             condition="new"
         )
 
@@ -307,7 +349,7 @@ class AdDeleteViewTest(TestCase):
             user=cls.user,
             title="Объявление 1",
             description="Описание 1",
-            category="Категория 1",
+            category=Category.objects.resolve("Категория 1"),
             condition="new"
         )
 
@@ -345,14 +387,14 @@ class ExchangeProposalTests(TestCase):
             user=cls.user1,
             title="Отправитель",
             description="Описание отправителя",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="new"
         )
         cls.ad_receiver = Ad.objects.create(
             user=cls.user2,
             title="Получатель",
             description="Описание получателя",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="used"
         )
 
@@ -368,7 +410,7 @@ class ExchangeProposalTests(TestCase):
             user=self.user2,
             title="Объявление получателя",
             description="Описание объявления получателя",
-            category="Категория",
+            category=Category.objects.resolve("Категория"),
             condition="used"
         )
 
@@ -458,3 +500,2201 @@ class ExchangeProposalTests(TestCase):
         self.assertEqual(proposal.status, 'pending')  # Статус не изменился
 
 
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class AdSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='12345')
+        cls.bike = Ad.objects.create(
+            user=cls.user,
+            title="Горный велосипед",
+            description="Велосипед в хорошем состоянии, велосипед почти новый",
+            category=Category.objects.resolve("Спорт"),
+            condition="used"
+        )
+        cls.helmet = Ad.objects.create(
+            user=cls.user,
+            title="Шлем",
+            description="Шлем для велосипеда",
+            category=Category.objects.resolve("Спорт"),
+            condition="new"
+        )
+
+    def test_search_ranks_by_relevance(self):
+        response = self.client.get(reverse('ad_list') + '?query=велосипед')
+        self.assertEqual(list(response.context['ads']), [self.bike, self.helmet])
+
+    def test_search_matches_word_prefix(self):
+        response = self.client.get(reverse('ad_list') + '?query=вело шлем')
+        self.assertEqual(list(response.context['ads']), [self.helmet])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.helmet.title = "Самокат"
+        self.helmet.description = "Детский самокат"
+        self.helmet.save()
+        response = self.client.get(reverse('ad_list') + '?query=самокат')
+        self.assertEqual(list(response.context['ads']), [self.helmet])
+
+        self.helmet.delete()
+        response = self.client.get(reverse('ad_list') + '?query=самокат')
+        self.assertEqual(len(response.context['ads']), 0)
+
+    def test_api_search(self):
+        response = self.client.get('/api/ads/?query=шлем')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([ad['id'] for ad in response.json()['results']], [self.helmet.id])
+
+    def test_api_search_ranks_by_relevance(self):
+        # Лучшее совпадение старше: лента по дате поставила бы его вторым
+        response = self.client.get('/api/ads/?query=велосипед')
+        self.assertEqual([ad['id'] for ad in response.json()['results']], [self.bike.id, self.helmet.id])
+
+        data = self.client.get('/api/ads/', {'query': 'велосипед', 'page_size': 1}).json()
+        ids = [ad['id'] for ad in data['results']]
+        while data['next']:
+            data = self.client.get(data['next']).json()
+            ids += [ad['id'] for ad in data['results']]
+        self.assertEqual(ids, [self.bike.id, self.helmet.id])
+        previous = self.client.get(data['previous']).json()
+        self.assertEqual([ad['id'] for ad in previous['results']], [self.bike.id])
+
+    @override_settings(ROOT_URLCONF='core.urls_async')
+    def test_async_api_search_ranks_by_relevance(self):
+        response = self.client.get('/api/ads/?query=велосипед')
+        self.assertEqual([ad['id'] for ad in response.json()['results']], [self.bike.id, self.helmet.id])
+
+    def test_cursor_mode_search_ranks_by_relevance(self):
+        response = self.client.get(reverse('ad_list'), {'query': 'велосипед', 'cursor': ''})
+        self.assertEqual(list(response.context['page_obj']), [self.bike, self.helmet])
+
+    def test_rebuild_search_index_command(self):
+        call_command('rebuild_search_index', '--recreate', stdout=StringIO())
+        response = self.client.get(reverse('ad_list') + '?query=горный')
+        self.assertEqual(list(response.context['ads']), [self.bike])
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='12345')
+        category = Category.objects.resolve("Категория")
+        Ad.objects.bulk_create([
+            Ad(user=cls.user, title=f"Объявление {i}", description="Описание", category=category, condition="new")
+            for i in range(7)
+        ])
+        # Одинаковая дата у нескольких объявлений: порядок должен задаваться id
+        created_at = timezone.now()
+        Ad.objects.filter(id__in=Ad.objects.order_by('id').values('id')[:4]).update(created_at=created_at)
+        cls.expected = list(Ad.objects.order_by('-created_at', '-id'))
+
+    def walk_html(self):
+        pages, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get(reverse('ad_list'), {'cursor': cursor, 'paginate_by': 5})
+            self.assertEqual(response.status_code, 200)
+            page = response.context['page_obj']
+            pages.append(list(page))
+            cursor = page.next_cursor
+        return pages, page
+
+    def test_html_pages_forward_and_back(self):
+        pages, last_page = self.walk_html()
+        self.assertEqual([ad for page in pages for ad in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [5, 2])
+
+        response = self.client.get(reverse('ad_list'), {'cursor': last_page.previous_cursor, 'paginate_by': 5})
+        self.assertEqual(list(response.context['page_obj']), self.expected[:5])
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_cursor_mode_does_not_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('ad_list'), {'cursor': ''})
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('ad_list'), {'cursor': 'мусор'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/ads/', {'cursor': 'bm90LWpzb24'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_api_pages(self):
+        ids, url = [], '/api/ads/?page_size=3'
+        while url:
+            data = self.client.get(url).json()
+            self.assertNotIn('count', data)
+            ids += [ad['id'] for ad in data['results']]
+            url = data['next']
+        self.assertEqual(ids, [ad.id for ad in self.expected])
+
+        data = self.client.get('/api/ads/?page_size=3').json()
+        second = self.client.get(data['next']).json()
+        first = self.client.get(second['previous']).json()
+        self.assertEqual(first['results'], data['results'])
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class QueryPlanTest(TestCase):
+    """Планы запросов горячих страниц не должны деградировать до полного сканирования.
+
+    Каждый SELECT, выполненный представлением, прогоняется через
+    EXPLAIN QUERY PLAN (SQLite); запрещены сканирование таблицы без индекса
+    и сортировка во временном B-дереве. Поиск по релевантности сюда не входит:
+    сортировка найденных строк по рангу — неотъемлемая часть такого запроса.
+    """
+    FULL_SCAN_RE = re.compile(r'^SCAN (\S+)$')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user1 = User.objects.create_user(username='user1', password='12345')
+        cls.user2 = User.objects.create_user(username='user2', password='12345')
+        category = Category.objects.resolve("Категория")
+        ads = Ad.objects.bulk_create([
+            Ad(user=user, title=f"Объявление {i}", description="Описание", category=category, condition=condition)
+            for i, (user, condition) in enumerate([(cls.user1, 'new'), (cls.user2, 'used')] * 6)
+        ])
+        ExchangeProposal.objects.bulk_create([
+            ExchangeProposal(ad_sender=sender, ad_receiver=receiver, status=status)
+            for sender, receiver, status in zip(ads[::2], ads[1::2], ['pending', 'accepted', 'rejected'] * 2)
+        ])
+        cls.ad = ads[0]
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN есть только в SQLite')
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedPlans(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            plan = self.explain(sql)
+            for step in plan:
+                self.assertIsNone(self.FULL_SCAN_RE.match(step), f'Полное сканирование: {step}\n{sql}')
+                self.assertNotIn('TEMP B-TREE', step, f'Сортировка без индекса: {step}\n{sql}')
+
+    def test_ad_list(self):
+        self.assertIndexedPlans(reverse('ad_list'))
+        self.assertIndexedPlans(reverse('ad_list'), {'page': 2})
+        self.assertIndexedPlans(reverse('ad_list'), {'condition': 'used', 'paginate_by': 5})
+        self.assertIndexedPlans(reverse('ad_list'), {'category': 'категория'})
+        self.assertIndexedPlans('/api/ads/facets/')
+
+    def test_ad_list_cursor(self):
+        response = self.client.get(reverse('ad_list'), {'cursor': '', 'condition': 'new'})
+        cursor = response.context['page_obj'].next_cursor
+        self.assertIndexedPlans(reverse('ad_list'), {'cursor': cursor, 'condition': 'new'})
+        self.assertIndexedPlans(reverse('ad_list'), {'cursor': cursor})
+
+    def test_popular_ordering(self):
+        # Сортировка по популярности обходится индексами так же, как лента по дате
+        for params in [{}, {'condition': 'used'}, {'category': 'категория'}, {'page': 2}]:
+            self.assertIndexedPlans(reverse('ad_list'), {'ordering': 'popular', **params})
+        response = self.client.get(reverse('ad_list'), {'cursor': '', 'ordering': 'popular', 'condition': 'new'})
+        cursor = response.context['page_obj'].next_cursor
+        self.assertIndexedPlans(reverse('ad_list'), {'cursor': cursor, 'ordering': 'popular', 'condition': 'new'})
+        self.assertIndexedPlans('/api/ads/', {'ordering': 'popular'})
+        self.assertIndexedPlans('/api/ads/', {'ordering': 'popular', 'condition': 'new'})
+
+    def test_popularity_rescore(self):
+        with CaptureQueriesContext(connection) as queries:
+            popularity.rescore(chunk_size=5)
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 4)  # Три пачки и пустая
+        for sql in selects:
+            self.assertIn('ad_popularity_stale_idx', ' '.join(self.explain(sql)))
+
+    def test_ad_detail(self):
+        self.assertIndexedPlans(reverse('ad_detail', args=[self.ad.id]))
+
+    def test_api(self):
+        self.assertIndexedPlans('/api/ads/')
+        self.assertIndexedPlans('/api/ads/', {'condition': 'new'})
+        self.assertIndexedPlans(f'/api/ads/{self.ad.id}/')
+
+    def test_exchange_proposals(self):
+        self.client.login(username='user1', password='12345')
+        self.assertIndexedPlans(reverse('exchange_proposals'))
+        self.assertIndexedPlans(reverse('exchange_proposals'), {'status': 'pending'})
+        self.assertIndexedPlans(reverse('exchange_proposals'), {'sender': 'Объявление', 'receiver': '1'})
+
+
+class QueryBudgetMixin:
+    """Проверки числа SQL-запросов с выводом самих запросов при превышении"""
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        """Выполняет func и проверяет, что она уложилась в ``budget`` запросов"""
+        with CaptureQueriesContext(connection) as queries:
+            result = func(*args, **kwargs)
+        executed = len(queries.captured_queries)
+        if executed > budget:
+            listing = '\n'.join(f"{i}. {query['sql']}" for i, query in enumerate(queries.captured_queries, 1))
+            self.fail(f'Выполнено {executed} запросов при бюджете {budget}:\n{listing}')
+        return result
+
+    def assertConstantQueries(self, func, grow):
+        """Число запросов func не должно зависеть от объёма данных, добавленных grow()"""
+        with CaptureQueriesContext(connection) as before:
+            func()
+        grow()
+        with CaptureQueriesContext(connection) as after:
+            func()
+        self.assertEqual(
+            len(before.captured_queries), len(after.captured_queries),
+            'Число запросов растёт вместе с данными (N+1)',
+        )
+
+
+# Запись буфера просмотров не должна попасть в бюджет запросов страницы
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0, ADS_VIEWS_FLUSH_INTERVAL=60 * 60, ADS_JOBS_EAGER=False)
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """Бюджеты запросов для каждой страницы и эндпоинта API.
+
+    Для авторизованных запросов два запроса уходят на сессию и пользователя.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user1 = User.objects.create_user(username='user1', password='12345')
+        cls.user2 = User.objects.create_user(username='user2', password='12345')
+        cls.ad1 = Ad.objects.create(user=cls.user1, title="Велосипед", description="Описание",
+                                    category=Category.objects.resolve("Спорт"), condition="new")
+        cls.ad2 = Ad.objects.create(user=cls.user2, title="Самокат", description="Описание",
+                                    category=Category.objects.resolve("Спорт"), condition="used")
+        cls.proposal = ExchangeProposal.objects.create(ad_sender=cls.ad1, ad_receiver=cls.ad2)
+
+    def add_proposals(self, count=10):
+        start = User.objects.count()
+        for i in range(start, start + count):
+            user = User.objects.create(username=f'extra{i}')
+            ad = Ad.objects.create(user=user, title=f"Доп {i}", description="Описание",
+                                   category=Category.objects.resolve("Спорт"), condition="new")
+            ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=ad)
+            ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=self.ad1)
+
+    def get(self, url, data=None):
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_ad_list(self):
+        self.assertQueryBudget(4, self.get, reverse('ad_list'))
+        self.assertQueryBudget(3, self.get, reverse('ad_list'), {'cursor': ''})
+        self.client.force_login(self.user1)
+        self.assertQueryBudget(6, self.get, reverse('ad_list'))
+        self.assertConstantQueries(lambda: self.get(reverse('ad_list'), {'paginate_by': 20}), self.add_proposals)
+
+    def test_ad_detail(self):
+        # Версия для ETag, само объявление и похожие; ответ 304 обходится одним запросом версии
+        cache.clear()
+        url = reverse('ad_detail', args=[self.ad1.id])
+        # Без кэша: плюс число объявлений, статистика слов и поиск по индексу
+        self.assertQueryBudget(6, self.get, url)
+        self.assertQueryBudget(3, self.get, url)
+
+    def test_ad_forms(self):
+        self.client.force_login(self.user1)
+        self.assertQueryBudget(2, self.get, reverse('create_ad'))
+        self.assertQueryBudget(3, self.get, reverse('edit_ad', args=[self.ad1.id]))
+        self.assertQueryBudget(3, self.get, reverse('delete_ad', args=[self.ad1.id]))
+
+    def test_exchange_proposals(self):
+        self.client.force_login(self.user1)
+        url = reverse('exchange_proposals')
+        # Сессия, пользователь, обмены по кругу, предложения
+        self.assertQueryBudget(4, self.get, url)
+        self.assertQueryBudget(4, self.get, url, {'status': 'pending', 'sender': 'Вел'})
+        self.assertConstantQueries(lambda: self.get(url), self.add_proposals)
+        self.assertConstantQueries(lambda: self.get(url, {'status': 'pending'}), self.add_proposals)
+
+    def test_create_exchange_proposal(self):
+        self.client.force_login(self.user1)
+        url = reverse('create_exchange_proposal', args=[self.ad2.id])
+        self.assertQueryBudget(4, self.get, url)
+        # Плюс точка сохранения, счётчики объявлений, ребро графа обменов и поиск циклов
+        # (один уровень: у user1 нет входящих предложений)
+        response = self.assertQueryBudget(
+            13, self.client.post, url, {'ad_sender': self.ad1.id, 'comment': 'Меняю'},
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_update_exchange_proposal_status(self):
+        self.client.force_login(self.user2)
+        url = reverse('update_exchange_proposal_status', args=[self.proposal.id])
+        self.assertQueryBudget(3, self.get, url)
+        # Условный UPDATE, поиск и отклонение конкурирующих, удаление рёбер и циклов, счётчики, точка сохранения
+        response = self.assertQueryBudget(11, self.client.post, url, {'status': 'accepted'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_api(self):
+        self.assertQueryBudget(1, self.get, '/api/ads/')
+        self.assertQueryBudget(1, self.get, '/api/ads/', {'query': 'велосипед', 'condition': 'new'})
+        self.assertQueryBudget(2, self.get, f'/api/ads/{self.ad1.id}/')
+        self.assertConstantQueries(lambda: self.get('/api/ads/'), self.add_proposals)
+
+    def test_auth_pages(self):
+        self.assertQueryBudget(0, self.get, reverse('login'))
+        self.assertQueryBudget(0, self.get, reverse('register'))
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class CategoryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='12345')
+        cls.sport = Category.objects.resolve("Спорт")
+        cls.bikes = Category.objects.create(name="Велосипеды", slug="велосипеды", parent=cls.sport)
+        cls.books = Category.objects.resolve("Книги")
+
+    def create_ad(self, category, condition='new'):
+        return Ad.objects.create(user=self.user, title="Объявление", description="Описание",
+                                 category=category, condition=condition)
+
+    def counts(self):
+        categories = dict(Category.objects.values_list('slug', 'ad_count'))
+        conditions = dict(ConditionCounter.objects.values_list('condition', 'ad_count'))
+        return categories, conditions
+
+    def test_resolve_normalizes_spelling(self):
+        self.assertEqual(Category.objects.resolve("  СПОРТ "), self.sport)
+        self.assertEqual(Category.objects.count(), 3)
+
+    def test_counters_follow_ad_changes(self):
+        ad = self.create_ad(self.sport)
+        self.create_ad(self.bikes, 'used')
+        categories, conditions = self.counts()
+        self.assertEqual((categories['спорт'], categories['велосипеды'], categories['книги']), (1, 1, 0))
+        self.assertEqual(conditions, {'new': 1, 'used': 1})
+
+        ad.category = self.books
+        ad.condition = 'used'
+        ad.save()
+        categories, conditions = self.counts()
+        self.assertEqual((categories['спорт'], categories['книги']), (0, 1))
+        self.assertEqual(conditions, {'new': 0, 'used': 2})
+
+        ad.delete()
+        categories, conditions = self.counts()
+        self.assertEqual(categories['книги'], 0)
+        self.assertEqual(conditions['used'], 1)
+
+    def test_recount_repairs_counters(self):
+        self.create_ad(self.sport)
+        Category.objects.update(ad_count=42)
+        ConditionCounter.objects.all().delete()
+        facets.recount()
+        categories, conditions = self.counts()
+        self.assertEqual(categories, {'спорт': 1, 'велосипеды': 0, 'книги': 0})
+        self.assertEqual(conditions, {'new': 1, 'used': 0})
+
+    def test_create_ad_form_maps_category(self):
+        self.client.login(username='testuser', password='12345')
+        self.client.post(reverse('create_ad'), {
+            'title': 'Мяч', 'description': 'Описание', 'category': 'спорт', 'condition': 'new',
+        })
+        self.assertEqual(Ad.objects.get().category, self.sport)
+
+    def test_validation_does_not_create_categories(self):
+        self.client.login(username='testuser', password='12345')
+        response = self.client.post(reverse('create_ad'), {
+            'title': '', 'description': 'Описание', 'category': 'Игрушки', 'condition': 'new',
+        })
+        self.assertFalse(response.context['form'].is_valid())
+        response = self.client.post('/api/ads/', {'title': 'Мяч', 'category': 'Игрушки', 'condition': 'плохое'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.post('/api/ads/bulk/', [
+            {'title': 'Мяч', 'description': 'Описание', 'category': 'Игрушки', 'condition': 'плохое'},
+        ], content_type='application/json')
+        self.assertFalse(Category.objects.filter(name='Игрушки').exists())
+
+    def test_name_with_other_slug_is_found(self):
+        games = Category.objects.create(name="Игры", slug="games")
+        self.assertEqual(Category.objects.resolve("Игры"), games)
+        self.client.login(username='testuser', password='12345')
+        response = self.client.post('/api/ads/', {
+            'title': 'Шахматы', 'description': 'Описание', 'category': 'Игры', 'condition': 'used',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Ad.objects.get(pk=response.json()['id']).category, games)
+
+    def test_filter_and_facets_on_list(self):
+        bike = self.create_ad(self.bikes)
+        self.create_ad(self.books, 'used')
+        response = self.client.get(reverse('ad_list'), {'category': 'Велосипеды'})
+        self.assertEqual(list(response.context['ads']), [bike])
+
+        facets_context = response.context['facets']
+        sport = next(category for category in facets_context['categories'] if category.slug == 'спорт')
+        self.assertEqual((sport.total_count, [c.slug for c in sport.subcategories]), (1, ['велосипеды']))
+        self.assertContains(response, 'Книги (1)')
+
+    def test_api_category_and_facets(self):
+        self.client.login(username='testuser', password='12345')
+        response = self.client.post('/api/ads/', {
+            'title': 'Роман', 'description': 'Описание', 'category': ' книги', 'condition': 'used',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['category'], 'Книги')
+
+        data = self.client.get('/api/ads/facets/').json()
+        self.assertEqual([(c['slug'], c['ad_count']) for c in data['categories']], [('книги', 1)])
+        self.assertEqual({c['condition']: c['ad_count'] for c in data['conditions']}, {'new': 0, 'used': 1})
+
+
+class ListCacheTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='12345')
+        cls.sport = Category.objects.resolve("Спорт")
+        cls.books = Category.objects.resolve("Книги")
+        cls.ad = Ad.objects.create(user=cls.user, title="Велосипед", description="Горный",
+                                   category=cls.sport, condition="new")
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, params=None):
+        response = self.client.get(reverse('ad_list'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def create_ad(self, category, condition='new'):
+        # Кэш сбрасывается после коммита транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            return Ad.objects.create(user=self.user, title="Мяч", description="Описание",
+                                     category=category, condition=condition)
+
+    def test_hit_without_queries(self):
+        self.assertEqual(self.get()['X-Cache'], 'MISS')
+        response = self.assertQueryBudget(0, self.get)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertContains(response, 'Велосипед')
+        self.assertEqual(caching.stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+        out = StringIO()
+        call_command('list_cache_stats', stdout=out)
+        self.assertIn('Попадания: 1, промахи: 1', out.getvalue())
+
+    def test_normalized_params_share_entry(self):
+        self.get({'query': 'Велосипед', 'category': 'Спорт'})
+        response = self.get({'query': '  велосипед ', 'category': ' спорт', 'page': '1', 'utm_source': 'x'})
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.get()
+        self.assertEqual(self.get({'paginate_by': 5})['X-Cache'], 'MISS')
+        self.assertEqual(self.get({'paginate_by': 7})['X-Cache'], 'HIT')  # Недопустимое значение = по умолчанию
+
+    def test_invalidation_by_scope(self):
+        for params in ({}, {'category': 'Спорт'}, {'category': 'Книги'}, {'condition': 'used'},
+                       {'category': 'Книги', 'condition': 'new'}):
+            self.get(params)
+        self.create_ad(self.books, 'used')
+        # Сброшены общий список и страницы категории и состояния нового объявления
+        for params in ({}, {'category': 'Книги'}, {'condition': 'used'}):
+            response = self.get(params)
+            self.assertEqual(response['X-Cache'], 'MISS')
+            self.assertContains(response, 'Мяч')
+        self.assertEqual(self.get({'category': 'Спорт'})['X-Cache'], 'HIT')
+        self.assertEqual(self.get({'category': 'Книги', 'condition': 'new'})['X-Cache'], 'HIT')
+
+    def test_update_and_delete_invalidate_old_and_new_scope(self):
+        self.get({'category': 'Спорт'})
+        self.get({'category': 'Книги'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad.category = self.books
+            self.ad.save()
+        self.assertNotContains(self.get({'category': 'Спорт'}), 'Велосипед')
+        self.assertContains(self.get({'category': 'Книги'}), 'Велосипед')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad.delete()
+        self.assertNotContains(self.get({'category': 'Книги'}), 'Велосипед')
+
+    def test_invalidate_all(self):
+        self.get()
+        caching.invalidate_all()
+        self.assertEqual(self.get()['X-Cache'], 'MISS')
+
+    def test_authenticated_and_messages_bypass_cache(self):
+        self.get()
+        self.client.force_login(self.user)
+        response = self.get()
+        self.assertNotIn('X-Cache', response)
+        self.assertContains(response, 'Привет, testuser!')
+        self.client.post(reverse('logout'))
+        response = self.get()  # Сообщение о выходе не должно попасть в кэш
+        self.assertNotIn('X-Cache', response)
+        self.assertContains(response, 'Вы вышли из системы.')
+        self.assertEqual(self.get()['X-Cache'], 'HIT')
+
+    @override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.get()
+        self.assertNotIn('X-Cache', self.get())
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class FragmentCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.other = User.objects.create_user(username='other', password='12345')
+        cls.ad = Ad.objects.create(user=cls.owner, title="Велосипед", description="Горный",
+                                   category=Category.objects.resolve("Спорт"), condition="new")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cards_come_from_cache(self):
+        self.client.get(reverse('ad_list'))
+        key = caching.fragment_key('ad_card', self.ad, caching.ANONYMOUS)
+        self.assertIn('Велосипед', cache.get(key))
+        cache.set(key, '<p>из кэша</p>')
+        self.assertContains(self.client.get(reverse('ad_list')), '<p>из кэша</p>')
+
+    def test_buttons_follow_viewer(self):
+        self.assertContains(self.client.get(reverse('ad_list')), 'Авторизуйтесь, чтобы предложить обмен')
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get(reverse('ad_list')), 'Ваше объявление')
+        self.assertContains(self.client.get(reverse('ad_detail', args=[self.ad.id])), 'Редактировать')
+        self.client.force_login(self.other)
+        self.assertContains(self.client.get(reverse('ad_list')), 'Предложить обмен')
+        self.assertNotContains(self.client.get(reverse('ad_detail', args=[self.ad.id])), 'Редактировать')
+
+    def test_update_renders_new_version(self):
+        self.client.get(reverse('ad_list'))
+        self.client.get(reverse('ad_detail', args=[self.ad.id]))
+        self.ad.title = "Самокат"
+        self.ad.save()
+        self.assertContains(self.client.get(reverse('ad_list')), 'Самокат')
+        self.assertContains(self.client.get(reverse('ad_detail', args=[self.ad.id])), 'Самокат')
+
+
+# Запись буфера просмотров не должна попасть в бюджет запросов страницы
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0, ADS_VIEWS_FLUSH_INTERVAL=60 * 60)
+class ConditionalRequestTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.other = User.objects.create_user(username='other', password='12345')
+        cls.ad = Ad.objects.create(user=cls.owner, title="Велосипед", description="Горный",
+                                   category=Category.objects.resolve("Спорт"), condition="new")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_detail_not_modified(self):
+        url = reverse('ad_detail', args=[self.ad.id])
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        response = self.assertQueryBudget(1, self.client.get, url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad.title = "Самокат"
+            self.ad.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, 'Самокат')
+
+    def test_detail_etag_depends_on_viewer(self):
+        url = reverse('ad_detail', args=[self.ad.id])
+        etag = self.client.get(url)['ETag']
+        self.client.force_login(self.owner)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Редактировать')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_api_retrieve_and_list(self):
+        url = f'/api/ads/{self.ad.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.assertQueryBudget(1, self.client.get, url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        list_etag = self.client.get('/api/ads/', {'condition': 'new'})['ETag']
+        other_etag = self.client.get('/api/ads/', {'condition': 'used'})['ETag']
+        response = self.assertQueryBudget(0, self.client.get, '/api/ads/', {'condition': 'new'},
+                                          HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Ad.objects.create(user=self.owner, title="Мяч", description="Описание",
+                              category=Category.objects.resolve("Спорт"), condition="new")
+        response = self.client.get('/api/ads/', {'condition': 'new'}, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(len(response.json()['results']), 2)
+        response = self.client.get('/api/ads/', {'condition': 'used'}, HTTP_IF_NONE_MATCH=other_etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_api_if_match(self):
+        self.client.force_login(self.owner)
+        url = f'/api/ads/{self.ad.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.patch(url, {'title': 'Самокат'}, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # Вторая правка с устаревшей версией отклоняется
+        response = self.client.patch(url, {'title': 'Мяч'}, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        response = self.client.delete(url, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Ad.objects.get().title, 'Самокат')
+        # Без If-Match изменения работают как раньше
+        response = self.client.patch(url, {'title': 'Мяч'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_proposal_keeps_owner_if_match(self):
+        url = f'/api/ads/{self.ad.id}/'
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        offer = Ad.objects.create(user=self.other, title="Самокат", description="Детский",
+                                  category=self.ad.category, condition="used")
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeProposal.objects.create(ad_sender=offer, ad_receiver=self.ad)
+        # Счётчики в ответе изменились, время правки — нет
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()['received_count']), (200, 1))
+        self.assertEqual(response['Last-Modified'], last_modified)
+        self.client.force_login(self.owner)
+        response = self.client.patch(url, {'title': 'Велосипед горный'}, content_type='application/json',
+                                     HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch(url, {'title': 'Мяч'}, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+
+
+@override_settings(ADS_JOBS_EAGER=False)  # Бюджеты запросов — без выполнения задач на месте
+class BulkApiTest(QueryBudgetMixin, TestCase):
+    url = '/api/ads/bulk/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user1', password='12345')
+        cls.stranger = User.objects.create_user(username='user2', password='12345')
+        cls.sport = Category.objects.resolve("Спорт")
+        cls.foreign = Ad.objects.create(user=cls.stranger, title="Чужое", description="Описание",
+                                        category=cls.sport, condition="new")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def send(self, method, data, **params):
+        url = self.url + ('?' + '&'.join(f'{k}={v}' for k, v in params.items()) if params else '')
+        response = getattr(self.client, method)(url, data, content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['results']
+
+    def item(self, title, category='Книги', condition='used'):
+        return {'title': title, 'description': 'Описание', 'category': category, 'condition': condition}
+
+    def counts(self):
+        return dict(Category.objects.values_list('slug', 'ad_count')), \
+            dict(ConditionCounter.objects.values_list('condition', 'ad_count'))
+
+    def test_create_reports_each_item(self):
+        items = [self.item(f'Книга {i}') for i in range(5)] + [self.item('', category='')]
+        # Сессия и пользователь, категория один раз на запрос (поиск при проверке,
+        # get_or_create в транзакции записи), вставки по две строки, по одному UPDATE
+        # на счётчик, один запрос сохранённых поисков
+        results = self.assertQueryBudget(15, self.send, 'post', items, chunk_size=2)
+        self.assertEqual([r['status'] for r in results], ['created'] * 5 + ['error'])
+        self.assertIn('title', results[-1]['errors'])
+        self.assertEqual(sorted(Ad.objects.filter(user=self.user).values_list('id', flat=True)),
+                         sorted(r['id'] for r in results[:5]))
+        self.assertEqual(self.counts(), ({'спорт': 1, 'книги': 5}, {'new': 1, 'used': 5}))
+        response = self.client.get(reverse('ad_list'), {'query': 'книга'})
+        self.assertEqual(len(response.context['ads']), 4)
+
+    def test_update_own_ads(self):
+        ids = [r['id'] for r in self.send('post', [self.item('Книга'), self.item('Роман')])]
+        results = self.send('patch', [
+            {'id': ids[0], 'title': 'Учебник', 'category': 'Спорт', 'condition': 'new'},
+            {'id': ids[1], 'condition': 'плохое'},
+            {'id': self.foreign.id, 'title': 'Моё'},
+            {'id': 'x'},
+        ])
+        self.assertEqual([r['status'] for r in results], ['updated', 'error', 'not_found', 'not_found'])
+        ad = Ad.objects.get(pk=ids[0])
+        self.assertEqual((ad.title, ad.category, ad.condition), ('Учебник', self.sport, 'new'))
+        self.assertGreater(ad.updated_at, ad.created_at)
+        self.assertEqual(Ad.objects.get(pk=self.foreign.id).title, 'Чужое')
+        self.assertEqual(self.counts(), ({'спорт': 2, 'книги': 1}, {'new': 2, 'used': 1}))
+
+    def test_delete_own_ads(self):
+        ids = [r['id'] for r in self.send('post', [self.item('Книга'), self.item('Роман')])]
+        results = self.send('delete', [ids[0], self.foreign.id, 'x'])
+        self.assertEqual([r['status'] for r in results], ['deleted', 'not_found', 'not_found'])
+        self.assertEqual(set(Ad.objects.values_list('id', flat=True)), {ids[1], self.foreign.id})
+        self.assertEqual(self.counts(), ({'спорт': 1, 'книги': 1}, {'new': 1, 'used': 1}))
+
+    def test_rejects_non_list_and_anonymous(self):
+        response = self.client.post(self.url, {'title': 'x'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.post(self.url, [], content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='staff', password='12345', is_staff=True)
+        cls.user = User.objects.create_user(username='user1', password='12345')
+        sport = Category.objects.resolve("Спорт")
+        cls.bike = Ad.objects.create(user=cls.user, title="Велосипед", description='Горный, "почти новый"',
+                                     category=sport, condition="used")
+        cls.ball = Ad.objects.create(user=cls.staff, title="Мяч", description="Футбольный",
+                                     category=Category.objects.resolve("Игры"), condition="new")
+        ExchangeProposal.objects.create(ad_sender=cls.bike, ad_receiver=cls.ball, status='accepted')
+        ExchangeProposal.objects.create(ad_sender=cls.ball, ad_receiver=cls.bike)
+
+    def download(self, kind, **params):
+        response = self.client.get(reverse('export', args=[kind]), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_staff_only(self):
+        url = reverse('export', args=['ads'])
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_csv_with_filters(self):
+        self.client.force_login(self.staff)
+        rows = list(csv.reader(self.download('ads').decode().splitlines()))
+        self.assertEqual(rows[0][:3], ['id', 'user', 'title'])
+        self.assertEqual([row[2] for row in rows[1:]], ['Велосипед', 'Мяч'])
+        self.assertEqual(rows[1][3], 'Горный, "почти новый"')
+        rows = list(csv.reader(self.download('ads', category='спорт', query='велосипед').decode().splitlines()))
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.bike.id)])
+
+    def test_ndjson_gzip_and_proposals(self):
+        self.client.force_login(self.staff)
+        data = gzip.decompress(self.download('proposals', format='ndjson', gzip='1', status='accepted'))
+        records = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]['sender'], records[0]['receiver']), ('user1', 'staff'))
+        response = self.client.get(reverse('export', args=['users']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_ads', '--format', 'ndjson', '--condition', 'new', '--chunk-size', '1', stdout=out)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record['title'] for record in records], ['Мяч'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'proposals.csv.gz')
+            call_command('export_ads', '--proposals', '--gzip', '--output', path)
+            with gzip.open(path, 'rt') as file:
+                self.assertEqual(len(list(csv.reader(file))), 3)
+
+
+@override_settings(ROOT_URLCONF='core.urls_asgi')
+class AsgiRoutesTest(TestCase):
+    def test_sync_pages_with_event_stream(self):
+        self.assertIs(resolve('/').func.view_class, AdListView)
+        self.assertIs(resolve('/api/ads/').func.cls, AdViewSet)
+        self.assertEqual(reverse('proposal_events'), '/events/proposals/')
+
+
+@override_settings(ROOT_URLCONF='core.urls_async', ADS_LIST_CACHE_TIMEOUT=0)
+class AsyncViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.other = User.objects.create_user(username='other', password='12345')
+        sport = Category.objects.resolve("Спорт")
+        cls.ads = [
+            Ad.objects.create(user=cls.owner, title=f"Мяч {i}", description="Описание",
+                              category=sport, condition="new" if i % 2 else "used")
+            for i in range(12)
+        ]
+        cls.other_ad = Ad.objects.create(user=cls.other, title="Книга", description="Описание",
+                                         category=Category.objects.resolve("Книги"), condition="used")
+        ExchangeProposal.objects.create(ad_sender=cls.other_ad, ad_receiver=cls.ads[0], comment="Обмен?")
+
+    async def test_list_pages_and_filters(self):
+        response = await self.async_client.get(reverse('ad_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].paginator.count, 13)
+        self.assertContains(response, 'Книга')
+        response = await self.async_client.get(reverse('ad_list'), {'condition': 'new', 'page': 'last'})
+        self.assertEqual(response.context['page_obj'].paginator.count, 6)
+        response = await self.async_client.get(reverse('ad_list'), {'page': 100})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(ADS_LIST_PAGINATION='cursor')
+    async def test_list_cursor(self):
+        response = await self.async_client.get(reverse('ad_list'))
+        page = response.context['page_obj']
+        self.assertTrue(page.has_next())
+        response = await self.async_client.get(reverse('ad_list'), {'cursor': page.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(page.object_list[0], response.context['page_obj'].object_list)
+        response = await self.async_client.get(reverse('ad_list'), {'cursor': 'мусор'})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_detail(self):
+        url = reverse('ad_detail', args=[self.ads[0].id])
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'Мяч 0')
+        self.assertNotContains(response, 'Редактировать')
+        response = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+        await self.async_client.aforce_login(self.owner)
+        self.assertContains(await self.async_client.get(url), 'Редактировать')
+        response = await self.async_client.get(reverse('ad_detail', args=[10 ** 6]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_proposals_require_login(self):
+        response = await self.async_client.get(reverse('exchange_proposals'))
+        self.assertEqual(response.status_code, 302)
+        await self.async_client.aforce_login(self.owner)
+        response = await self.async_client.get(reverse('exchange_proposals'))
+        self.assertContains(response, 'Обмен?')
+
+    async def test_api_matches_sync(self):
+        urls = [
+            '/api/ads/', '/api/ads/?condition=used&page_size=2', f'/api/ads/{self.ads[0].id}/',
+            '/api/ads/?fields=id,title,user&expand=user', f'/api/ads/{self.ads[0].id}/?expand=category',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = await self.async_client.get(url)
+                with override_settings(ROOT_URLCONF='core.urls'):
+                    expected = await sync_to_async(self.client.get)(url)
+                self.assertEqual(response.json(), expected.json())
+                self.assertEqual(response['ETag'], expected['ETag'])
+                response = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+                self.assertEqual(response.status_code, 304)
+        response = await self.async_client.get('/api/ads/1000000/')
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get('/api/ads/?fields=password')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_api_writes_use_sync_views(self):
+        await self.async_client.aforce_login(self.owner)
+        data = {'title': 'Велосипед', 'description': 'Горный', 'category': 'Спорт', 'condition': 'new'}
+        response = await self.async_client.post('/api/ads/', data, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = f"/api/ads/{response.json()['id']}/"
+        response = await self.async_client.patch(url, {'title': 'Самокат'}, content_type='application/json')
+        self.assertEqual(response.json()['title'], 'Самокат')
+        response = await self.async_client.delete(url)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(await Ad.objects.filter(title='Самокат').aexists())
+
+
+class AvailableReplicaRouter(db_router.ReplicaRouter):
+    def is_available(self, alias):
+        return True
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRouterTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user1', password='12345')
+
+    def tearDown(self):
+        db_router._unavailable_until.clear()
+
+    def test_reads_from_replica(self):
+        router = AvailableReplicaRouter()
+        self.assertIsNone(router.db_for_read(Ad))
+        with db_router.replica_reads():
+            replica = router.db_for_read(Ad)
+            self.assertIn(replica, ['replica1', 'replica2'])
+            # Все чтения ответа — с одной реплики
+            self.assertEqual({router.db_for_read(Ad) for _ in range(20)}, {replica})
+            self.assertIsNone(router.db_for_read(User))
+            with db_router.request_state(pinned=True):
+                self.assertEqual(router.db_for_read(Ad), 'default')
+            with db_router.request_state() as state:
+                self.assertEqual(router.db_for_read(Ad), replica)
+                self.assertEqual(router.db_for_write(Session), 'default')
+                self.assertFalse(state.wrote)  # Сессии не привязывают клиента к основной базе
+                self.assertEqual(router.db_for_write(Ad), 'default')
+                self.assertTrue(state.wrote)
+                self.assertEqual(router.db_for_read(Ad), 'default')
+        self.assertFalse(router.allow_migrate('replica1', 'ads'))
+
+    @override_settings(DATABASE_REPLICAS=['missing'])
+    def test_unavailable_replica_falls_back_to_primary(self):
+        with db_router.replica_reads():
+            self.assertEqual(db_router.ReplicaRouter().db_for_read(Ad), 'default')
+        self.assertIn('missing', db_router._unavailable_until)
+        self.assertEqual(self.client.get('/api/ads/').status_code, 200)
+
+    @override_settings(DATABASE_REPLICAS=['default'], ADS_LIST_CACHE_TIMEOUT=0)
+    def test_replica_failing_mid_request_retries_on_primary(self):
+        failed = []
+
+        def replica_down(execute, sql, params, many, context):
+            if not failed and 'ads_ad' in sql:
+                failed.append(sql)
+                raise OperationalError('disk I/O error')
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(replica_down), self.assertLogs('core.db_router', 'WARNING'):
+            response = self.client.get('/api/ads/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(failed)
+        self.assertIn('default', db_router._unavailable_until)  # «Реплика» пропускается до конца паузы
+
+    @override_settings(DATABASE_REPLICAS=['default'])
+    def test_fail_over_counts_view_once(self):
+        ad = Ad.objects.create(user=self.user, title='Мяч', description='Описание',
+                               category=Category.objects.resolve('Спорт'), condition='new')
+        before = viewcounts.current(ad)
+        failed = []
+
+        def replica_down(execute, sql, params, many, context):
+            # Объявление уже прочитано, отказывает запрос похожих объявлений
+            if not failed and '_fts' in sql:
+                failed.append(sql)
+                raise OperationalError('disk I/O error')
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(replica_down), self.assertLogs('core.db_router', 'WARNING'):
+            response = self.client.get(reverse('ad_detail', args=[ad.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(failed)
+        self.assertEqual(viewcounts.current(Ad.objects.get(pk=ad.pk)), before + 1)
+        self.assertEqual(response.context['view_count'], before + 1)
+
+    @override_settings(DATABASE_REPLICAS=['missing'])
+    def test_login_does_not_pin_client(self):
+        response = self.client.post(reverse('login'), {'username': 'user1', 'password': '12345'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+    @override_settings(DATABASE_REPLICAS=['missing'])
+    def test_write_pins_client_to_primary(self):
+        response = self.client.get('/api/ads/')
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+        self.client.force_login(self.user)
+        data = {'title': 'Мяч', 'description': 'Описание', 'category': 'Спорт', 'condition': 'new'}
+        response = self.client.post('/api/ads/', data, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        cookie = response.cookies[db_router.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+        request = RequestFactory().get('/', HTTP_COOKIE=f'{db_router.PIN_COOKIE}={cookie.value}')
+        self.assertTrue(db_router.is_pinned(request))
+        with override_settings(DATABASE_REPLICAS=[]):
+            response = self.client.post('/api/ads/', data, content_type='application/json')
+            self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+
+class SQLiteProfileTest(TestCase):
+    def test_production_pragmas_applied_on_connect(self):
+        options = settings.SQLITE_PROFILES['production']
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = DatabaseWrapper(
+                {**connection.settings_dict, **options, 'NAME': os.path.join(directory, 'db.sqlite3')},
+                alias='profile_test',
+            )
+            try:
+                wrapper.ensure_connection()
+                with wrapper.cursor() as cursor:
+                    pragmas = {
+                        name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                        for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')
+                    }
+            finally:
+                wrapper.close()
+        self.assertEqual(pragmas, {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000, 'mmap_size': 256 * 1024 * 1024,
+        })
+        self.assertTrue(options['CONN_HEALTH_CHECKS'])
+
+
+class SeedAndBenchmarkTest(TestCase):
+    def test_seed_is_deterministic(self):
+        out = StringIO()
+        call_command('seed_barter', '--users', '5', '--ads', '40', '--categories', '10',
+                     '--proposals', '30', '--batch-size', '16', stdout=out)
+        self.assertIn('ads: 40', out.getvalue())
+        first = list(Ad.objects.order_by('id').values_list('title', 'category__name', 'user__username'))
+        self.assertEqual(Category.objects.filter(parent__isnull=False).count(), 2)
+        self.assertEqual(sum(Category.objects.values_list('ad_count', flat=True)), 40)
+        self.assertFalse(ExchangeProposal.objects.filter(ad_sender__user=F('ad_receiver__user')).exists())
+        self.assertEqual(counters.reconcile(), 0)
+        with self.assertRaises(CommandError):
+            call_command('seed_barter', '--users', '1', stdout=StringIO())
+
+        call_command('seed_barter', '--users', '5', '--ads', '40', '--categories', '10',
+                     '--proposals', '0', '--prefix', 'again', stdout=StringIO())
+        second = list(Ad.objects.filter(user__username__startswith='again').order_by('id')
+                      .values_list('title', 'category__name', 'user__username'))
+        self.assertEqual([row[:2] for row in first], [row[:2] for row in second])
+        self.assertEqual([row[2][len('seed'):] for row in first], [row[2][len('again'):] for row in second])
+
+    def test_bench_endpoints_writes_and_compares_baseline(self):
+        call_command('seed_barter', '--users', '3', '--ads', '20', '--proposals', '10', stdout=StringIO())
+        proposals = ExchangeProposal.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            call_command('bench_endpoints', '--requests', '3', '--profile-requests', '2',
+                         '--output', path, stdout=StringIO())
+            with open(path) as file:
+                report = json.load(file)
+            self.assertEqual(set(report['endpoints']), {
+                'ad_list', 'ad_detail', 'exchange_proposals', 'create_exchange_proposal', 'api_ads', 'api_similar',
+            })
+            self.assertGreater(report['endpoints']['ad_detail']['queries'], 0)
+            out = StringIO()
+            call_command('bench_endpoints', '--requests', '3', '--endpoints', 'ad_detail',
+                         '--baseline', path, stdout=out)
+            self.assertIn('Сравнение', out.getvalue())
+        self.assertEqual(ExchangeProposal.objects.count(), proposals)  # Созданные бенчмарком откатились
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0)
+class MetricsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user1', password='12345')
+        cls.ad = Ad.objects.create(user=cls.user, title="Велосипед", description="Горный",
+                                   category=Category.objects.resolve("Спорт"), condition="new")
+
+    def setUp(self):
+        metrics.registry.clear()
+
+    def sample(self, text, line_start):
+        for line in text.splitlines():
+            if line.startswith(line_start):
+                return float(line.rsplit(' ', 1)[1])
+        self.fail(f'Нет метрики {line_start}')
+
+    def test_records_requests_per_view(self):
+        self.client.get(reverse('ad_list'))
+        self.client.get(reverse('ad_list'))
+        self.client.get(reverse('ad_detail', args=[self.ad.id]))
+        self.client.get(f'/api/ads/{self.ad.id}/')
+        self.client.get('/no-such-page/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertEqual(self.sample(text, 'barter_requests_total{view="ad_list",method="GET",status="200"}'), 2)
+        self.assertEqual(self.sample(text, 'barter_request_duration_seconds_count{view="ad_list"}'), 2)
+        self.assertEqual(self.sample(text, 'barter_request_duration_seconds_bucket{view="ad_list",le="+Inf"}'), 2)
+        self.assertGreater(self.sample(text, 'barter_db_queries_total{view="ad_detail"}'), 0)
+        self.assertGreater(self.sample(text, 'barter_response_size_bytes_sum{view="ad-detail"}'), 0)
+        self.assertEqual(self.sample(text, 'barter_requests_total{view="unmatched",method="GET",status="404"}'), 1)
+
+    def test_access_and_process_snapshots(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        self.client.get(reverse('ad_list'))
+        other = metrics.Registry()
+        other.inc('barter_requests_total', (('view', 'ad_list'), ('method', 'GET'), ('status', '200')), 3)
+        other.observe('barter_request_duration_seconds', (('view', 'ad_list'),), 0.2)
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, '1.json'), 'w') as file:
+                json.dump(other.snapshot(), file)
+            text = self.client.get('/metrics').content.decode()
+        self.assertEqual(self.sample(text, 'barter_requests_total{view="ad_list",method="GET",status="200"}'), 4)
+        self.assertEqual(self.sample(text, 'barter_request_duration_seconds_count{view="ad_list"}'), 2)
+        self.assertGreaterEqual(self.sample(text, 'barter_request_duration_seconds_sum{view="ad_list"}'), 0.2)
+
+    def test_retires_snapshots_of_finished_processes(self):
+        key = ('barter_requests_total', (('view', 'ad_list'), ('method', 'GET'), ('status', '200')))
+        other = metrics.Registry()
+        other.inc(*key, 3)
+        child = subprocess.Popen([sys.executable, '-c', ''])
+        child.wait()
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            for name in (f'{child.pid}-dead.json', f'{os.getpid()}-previous.json', '1-alive.json'):
+                with open(os.path.join(directory, name), 'w') as file:
+                    json.dump(other.snapshot(), file)
+            self.assertEqual(metrics.collect()[0][key], 9)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(['.lock', '1-alive.json', metrics.snapshot_path().name, 'retired.json']))
+            metrics.registry.inc(*key)
+            self.assertEqual(metrics.collect()[0][key], 10)
+            metrics.shutdown()  # Остановка процесса: его снимок уходит в retired.json
+            metrics.registry.clear()
+            self.assertEqual(sorted(os.listdir(directory)), ['.lock', '1-alive.json', 'retired.json'])
+            self.assertEqual(metrics.collect()[0][key], 10)  # Счётчики не убывают
+
+    @override_settings(ROOT_URLCONF='core.urls_async')
+    async def test_async_views_count_queries(self):
+        await self.async_client.get(reverse('ad_detail', args=[self.ad.id]))
+        state = metrics.merge([metrics.registry.snapshot()])[0]
+        self.assertGreater(state[('barter_db_queries_total', (('view', 'ad_detail'),))], 0)
+
+
+class BarterCycleTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.resolve("Спорт")
+        cls.users, cls.ads = [], []
+        for name in ['anna', 'boris', 'clara', 'denis']:
+            user = User.objects.create_user(username=name, password='12345')
+            cls.users.append(user)
+            cls.ads.append(Ad.objects.create(user=user, title=f"Вещь {name}", description="Описание",
+                                             category=category, condition="used"))
+
+    def propose(self, sender, receiver, **kwargs):
+        proposal = ExchangeProposal.objects.create(ad_sender=self.ads[sender], ad_receiver=self.ads[receiver], **kwargs)
+        return proposal
+
+    def test_three_way_cycle(self):
+        first, second = self.propose(0, 1), self.propose(1, 2)
+        self.propose(1, 0)  # Встречное предложение двух пользователей — не обмен по кругу
+        self.assertFalse(BarterCycle.objects.exists())
+        closing = self.propose(2, 0)
+        cycle = BarterCycle.objects.get()
+        self.assertEqual(cycle.key, f'{first.id}-{second.id}-{closing.id}')
+
+        self.client.force_login(self.users[1])
+        response = self.client.get(reverse('exchange_proposals'))
+        self.assertContains(response, 'Обмен на 3 участников')
+        self.assertContains(response, '<strong>boris</strong> получает «Вещь clara»', html=False)
+        data = self.client.get('/api/cycles/').json()
+        self.assertEqual([step['user'] for step in data[0]['steps']], ['anna', 'boris', 'clara'])
+        self.assertEqual(data[0]['steps'][0]['ad'], self.ads[1].id)
+        self.client.force_login(self.users[3])
+        self.assertEqual(self.client.get('/api/cycles/').json(), [])
+
+        second.status = 'rejected'
+        second.save()
+        self.assertFalse(BarterCycle.objects.exists())
+        second.status = 'pending'
+        second.save()
+        self.assertEqual(BarterCycle.objects.get().steps.count(), 3)
+        closing.delete()
+        self.assertFalse(BarterCycle.objects.exists())
+
+    def test_max_length(self):
+        self.propose(0, 1), self.propose(1, 2), self.propose(2, 3)
+        with override_settings(ADS_CYCLE_MAX_LENGTH=3):
+            self.propose(3, 0)
+        self.assertFalse(BarterCycle.objects.exists())
+        self.propose(3, 0)
+        self.assertEqual(BarterCycle.objects.get().steps.count(), 4)
+
+    def test_search_is_local(self):
+        self.propose(0, 1), self.propose(1, 2), self.propose(2, 0)
+        # Один запрос на уровень обратного обхода, не больше max_length - 1
+        with self.assertNumQueries(2):
+            paths = cycles.find_cycles(self.users[2].id, self.users[0].id, max_length=3)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(cycles.find_cycles(self.users[3].id, self.users[0].id), [])
+
+
+class SimilarAdsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user1', password='12345')
+        sport, home = Category.objects.resolve("Спорт"), Category.objects.resolve("Дом")
+
+        def create(title, description, category):
+            return Ad.objects.create(user=cls.user, title=title, description=description,
+                                     category=category, condition="used")
+
+        cls.bike = create("Горный велосипед", "Велосипед с дисковыми тормозами", sport)
+        cls.road_bike = create("Шоссейный велосипед", "Лёгкая рама", sport)
+        cls.bike_lamp = create("Фонарь для велосипеда", "Велосипед не продаю, только фонарь", home)
+        cls.helmet = create("Шлем", "Для велосипеда", home)
+        cls.sofa = create("Диван", "Раскладной", home)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_ranking(self):
+        similar = recommendations.similar_ads(self.bike)
+        self.assertNotIn(self.bike, similar)
+        self.assertNotIn(self.sofa, similar)
+        # «Велосипед» в заголовке той же категории важнее упоминания в описании
+        self.assertEqual(similar[:2], [self.road_bike, self.bike_lamp])
+        self.assertEqual(recommendations.similar_ads(self.bike, limit=1), [self.road_bike])
+
+    def test_rare_terms_weigh_more(self):
+        terms = recommendations.query_terms(self.bike_lamp)
+        # «Фонарь» есть только в этом объявлении, «велосипед» — почти во всех
+        self.assertLess(terms.index('фонарь'), terms.index('велосипед'))
+
+    @override_settings(ADS_SIMILAR_CANDIDATES=3)
+    def test_candidates_are_best_matches(self):
+        for number in range(2):  # Новее всех, но «велосипед» только в описании
+            Ad.objects.create(user=self.user, title=f"Насос {number}", description="Подходит и для велосипед",
+                              category=self.sofa.category, condition="new")
+        self.assertEqual(recommendations.similar_ads(self.bike)[0], self.road_bike)
+
+    def test_terms_are_folded_like_index(self):
+        dessert = Ad.objects.create(user=self.user, title="Crème brûlée", description="Десерт",
+                                    category=self.bike.category, condition="new")
+        cake = Ad.objects.create(user=self.user, title="Creme brulee", description="Торт",
+                                 category=self.sofa.category, condition="new")
+        self.assertEqual(recommendations.ad_terms(dessert)['creme'], recommendations.TITLE_WEIGHT)
+        self.assertEqual(recommendations.similar_ads(dessert), [cake])
+
+    def test_category_fallback(self):
+        # Слова «Диван» и «Раскладной» больше нигде не встречаются
+        self.assertEqual(recommendations.similar_ads(self.sofa), [self.helmet, self.bike_lamp])
+
+    def test_index_follows_changes(self):
+        self.sofa.title = "Велосипед-диван"
+        self.sofa.save()  # Новый updated_at: закэшированный список больше не читается
+        self.assertIn(self.bike, recommendations.similar_ads(self.sofa))
+        self.road_bike.delete()
+        self.assertNotIn(self.road_bike, recommendations.similar_ads(self.bike))
+
+    def test_views(self):
+        response = self.client.get(reverse('ad_detail', args=[self.bike.id]))
+        self.assertContains(response, 'Похожие объявления')
+        self.assertContains(response, reverse('ad_detail', args=[self.road_bike.id]))
+        data = self.client.get(f'/api/ads/{self.bike.id}/similar/', {'limit': 2}).json()
+        self.assertEqual([ad['id'] for ad in data], [self.road_bike.id, self.bike_lamp.id])
+        self.assertEqual(self.client.get('/api/ads/0/similar/').status_code, 404)
+
+
+class ProposalTransitionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.resolve("Спорт")
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.ad = Ad.objects.create(user=cls.owner, title="Велосипед", description="Описание",
+                                   category=category, condition="used")
+        cls.other_ad = Ad.objects.create(user=cls.owner, title="Самокат", description="Описание",
+                                         category=category, condition="used")
+        cls.senders, cls.proposals = [], []
+        for number in range(3):
+            user = User.objects.create_user(username=f'sender{number}', password='12345')
+            ad = Ad.objects.create(user=user, title=f"Вещь {number}", description="Описание",
+                                   category=category, condition="used")
+            cls.senders.append(user)
+            cls.proposals.append(ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=cls.ad))
+        # Предложение от владельца тем же объявлением — тоже конкурирует
+        cls.outgoing = ExchangeProposal.objects.create(ad_sender=cls.ad, ad_receiver=cls.senders[2].ads.get())
+        cls.unrelated = ExchangeProposal.objects.create(ad_sender=cls.senders[0].ads.get(), ad_receiver=cls.other_ad)
+
+    def statuses(self):
+        return dict(ExchangeProposal.objects.values_list('id', 'status'))
+
+    def test_accept_rejects_competing(self):
+        first, second, third = self.proposals
+        rejected = services.accept(first)
+        # Конкурируют предложения с любым из двух объявлений обмена
+        self.assertCountEqual(rejected, [second.id, third.id, self.outgoing.id, self.unrelated.id])
+        self.assertEqual(self.statuses()[first.id], 'accepted')
+        self.assertEqual(set(self.statuses().values()), {'accepted', 'rejected'})
+        self.assertFalse(ProposalEdge.objects.exists())
+        with self.assertRaisesMessage(services.ProposalConflict, 'уже обработано'):
+            services.accept(second)
+        # Объявление уже обменено: вернуть предложение в ожидание не помогает
+        ExchangeProposal.objects.filter(pk=second.id).update(status='pending')
+        with self.assertRaisesMessage(services.ProposalConflict, 'принятом обмене'):
+            services.accept(second)
+        with self.assertRaises(services.ProposalConflict):
+            services.change_status(third, 'pending')
+
+    def test_status_view(self):
+        self.client.force_login(self.owner)
+        url = reverse('update_exchange_proposal_status', args=[self.proposals[0].id])
+        response = self.client.post(url, {'status': 'accepted'}, follow=True)
+        self.assertContains(response, 'Отклонено конкурирующих предложений: 4.')
+        response = self.client.post(url, {'status': 'rejected'}, follow=True)
+        self.assertContains(response, 'Предложение уже обработано.')
+        self.assertEqual(self.statuses()[self.proposals[0].id], 'accepted')
+
+    def test_api(self):
+        first, second, third = self.proposals
+        self.client.force_login(self.senders[0])
+        self.assertEqual(self.client.post(f'/api/proposals/{first.id}/accept/').status_code, 403)
+        self.assertEqual(self.client.post(f'/api/proposals/{self.outgoing.id}/accept/').status_code, 404)
+        self.assertEqual(len(self.client.get('/api/proposals/').json()), 2)
+
+        self.client.force_login(self.owner)
+        response = self.client.post(f'/api/proposals/{second.id}/reject/')
+        self.assertEqual(response.json(), {'id': second.id, 'status': 'rejected', 'rejected': []})
+        response = self.client.post(f'/api/proposals/{first.id}/accept/')
+        self.assertEqual(response.json()['status'], 'accepted')
+        self.assertCountEqual(response.json()['rejected'], [third.id, self.outgoing.id, self.unrelated.id])
+        response = self.client.post(f'/api/proposals/{third.id}/accept/')
+        self.assertEqual(response.status_code, 409)
+
+    def test_bulk(self):
+        first, second, third = self.proposals
+        self.client.force_login(self.owner)
+        url = '/api/proposals/bulk/'
+        data = {'ids': [second.id, third.id, self.outgoing.id, 0], 'status': 'rejected'}
+        # Сессия, пользователь, предложения, отбор и UPDATE, рёбра и циклы, счётчики, точка сохранения
+        with self.assertNumQueries(11):
+            response = self.client.post(url, data, content_type='application/json')
+        self.assertEqual([result['status'] for result in response.json()['results']],
+                         ['rejected', 'rejected', 'not_found', 'not_found'])
+
+        data = {'ids': [first.id, self.unrelated.id, second.id], 'status': 'accepted'}
+        results = self.client.post(url, data, content_type='application/json').json()['results']
+        # Второе предложение — с тем же объявлением отправителя, поэтому его отклонило принятие первого
+        self.assertEqual([result['status'] for result in results], ['accepted', 'conflict', 'conflict'])
+        self.assertCountEqual(results[0]['rejected'], [self.outgoing.id, self.unrelated.id])
+        response = self.client.post(url, {'ids': [first.id], 'status': 'pending'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_schema_has_stable_enum_names(self):
+        # Несколько полей status с разными значениями не дают предупреждений и автоимён вида Status720Enum
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'schema.yml')
+            call_command('spectacular', '--validate', '--fail-on-warn', '--file', path, stderr=StringIO())
+            with open(path) as file:
+                schema = file.read()
+        for name in ('ProposalStatusEnum', 'TransitionStatusEnum', 'BulkStatusEnum', 'ProposalBulkStatusEnum'):
+            self.assertIn(f'    {name}:', schema)
+
+
+class FieldSetTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='owner', password='12345')
+        cls.ads = [
+            Ad.objects.create(user=cls.user, title=f"Мяч {i}", description="Описание",
+                              category=Category.objects.resolve("Спорт"), condition="new")
+            for i in range(5)
+        ]
+        ExchangeProposal.objects.create(ad_sender=cls.ads[0], ad_receiver=cls.ads[1])
+
+    def test_list_matches_serializer(self):
+        results = self.assertQueryBudget(1, self.client.get, '/api/ads/').json()['results']
+        ads = Ad.objects.select_related('category').order_by('-created_at', '-id')
+        self.assertEqual(results, json.loads(json.dumps(AdSerializer(ads, many=True).data)))
+
+    def test_fields_and_expand(self):
+        response = self.assertQueryBudget(1, self.client.get, '/api/ads/', {'fields': 'id,title,user',
+                                                                            'expand': 'user,category'})
+        row = response.json()['results'][0]
+        self.assertEqual(row, {'id': self.ads[-1].id, 'title': 'Мяч 4',
+                               'user': {'id': self.user.id, 'username': 'owner'}})
+        data = self.client.get(f'/api/ads/{self.ads[1].id}/', {'expand': 'category'}).json()
+        self.assertEqual(data['category'], {'id': self.ads[1].category_id, 'name': 'Спорт', 'slug': 'спорт'})
+        self.assertEqual(data['pending_count'], 1)
+        cache.clear()
+        url = f'/api/ads/{self.ads[0].id}/similar/'
+        # Объявление, статистика слов, кандидаты, похожие и один запрос владельцев на все
+        self.assertQueryBudget(6, self.client.get, url, {'expand': 'user'})
+
+    def test_etag_and_errors(self):
+        full = self.client.get('/api/ads/')
+        sparse = self.client.get('/api/ads/', {'fields': 'id'})
+        self.assertNotEqual(full['ETag'], sparse['ETag'])
+        response = self.client.get('/api/ads/', {'fields': 'id'}, headers={'If-None-Match': sparse['ETag']})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/ads/', {'fields': 'id,password', 'expand': 'proposals'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()), {'fields', 'expand'})
+        # Ответ записи не зависит от ?fields=, поэтому If-Match с ETag полного ответа подходит
+        self.client.force_login(self.user)
+        url = f'/api/ads/{self.ads[0].id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.patch(f'{url}?fields=id', {'title': 'Мяч'}, content_type='application/json',
+                                     headers={'If-Match': etag})
+        self.assertEqual(response.json()['title'], 'Мяч')
+        self.assertIn('description', response.json())
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_serializers', '--ads', '30', '--page-sizes', '10', '--repeat', '2',
+                     '--expand', 'user', stdout=out)
+        self.assertIn('values() + запрос', out.getvalue())
+        self.assertEqual(Ad.objects.count(), len(self.ads))
+
+
+class SavedSearchTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(username='seller', password='12345')
+        cls.buyer = User.objects.create_user(username='buyer', password='12345')
+        cls.sport = Category.objects.resolve("Спорт")
+
+    def create_ad(self, title, description="Описание", condition="used", user=None):
+        self.client.force_login(user or self.seller)
+        self.client.post(reverse('create_ad'), {'title': title, 'description': description,
+                                                'category': 'Спорт', 'condition': condition})
+        return Ad.objects.latest('id')
+
+    def feed(self, user=None):
+        return list(percolator.feed(user or self.buyer).values_list('search__query', 'ad__title'))
+
+    def test_new_ads_match_saved_searches(self):
+        percolator.save_search(self.buyer, query='Горный  вело')
+        percolator.save_search(self.buyer, query='ковёр', condition='new')
+        percolator.save_search(self.buyer, category='спорт', condition='used')
+        percolator.save_search(self.buyer, query='самокат')
+        self.assertEqual(percolator.save_search(self.buyer, query='горный вело').query, 'горный вело')
+        self.assertEqual(SavedSearch.objects.count(), 4)
+
+        self.create_ad("Горный велосипед")
+        self.create_ad("Ковёр", description="Новый ковёр", condition="new")
+        self.create_ad("Велосипед", description="Городской")
+        self.create_ad("Самокат", user=self.buyer)  # Свои объявления в ленту не попадают
+        self.assertEqual(self.feed(), [
+            ('', 'Велосипед'), ('ковёр', 'Ковёр'), ('', 'Горный велосипед'), ('горный вело', 'Горный велосипед'),
+        ])
+
+    def test_matches_like_list_search(self):
+        # В индексе FTS5 «ё» и «й» — отдельные буквы: «елка» не находит «ёлку»
+        queries = ['ёлка', 'елка', 'йогурт', 'иогурт']
+        for query in queries:
+            percolator.save_search(self.buyer, query=query)
+        self.create_ad("Ёлка искусственная")
+        self.create_ad("Йогурт домашний")
+        self.create_ad("Иогурт", description="Опечатка")
+        feed = self.feed()
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual({title for found, title in feed if found == query},
+                                 {ad.title for ad in search.search_ads(Ad.objects.all(), query)})
+        self.assertNotIn('елка', {found for found, _ in feed})
+
+    @override_settings(ADS_JOBS_EAGER=False)
+    def test_only_indexed_searches_are_checked(self):
+        SavedSearch.objects.bulk_create([
+            SavedSearch(user=self.buyer, query=f'слово{number}', index_key=f'слово{number}')
+            for number in range(200)
+        ])
+        percolator.save_search(self.buyer, query='палатка туристическая')
+        ad = Ad.objects.create(user=self.seller, title="Палатка", description="Туристическая, двухместная",
+                               category=self.sport, condition="used")
+        self.assertFalse(self.feed())
+        jobs.run_pending()
+        self.assertEqual(self.feed(), [('палатка туристическая', 'Палатка')])
+        self.assertEqual(SavedSearch.objects.filter(index_key__in=percolator.ad_keys(ad, percolator.ad_words(ad)))
+                         .count(), 1)
+        # Один запрос кандидатов и одна вставка, сколько бы поисков ни было сохранено
+        self.assertQueryBudget(2, percolator.percolate, [ad])
+
+    @override_settings(ADS_JOBS_EAGER=False)
+    def test_bulk_api_percolates(self):
+        percolator.save_search(self.buyer, query='мяч')
+        self.client.force_login(self.seller)
+        items = [{'title': f'Мяч {number}', 'description': 'Футбольный', 'category': 'Спорт', 'condition': 'new'}
+                 for number in range(3)]
+        self.client.post('/api/ads/bulk/', items, content_type='application/json')
+        self.assertEqual(Job.objects.get().payload, {'ads': list(Ad.objects.order_by('id').values_list('id', flat=True))})
+        jobs.run_pending()
+        self.assertEqual(len(self.feed()), 3)
+
+    def test_pages(self):
+        self.client.force_login(self.buyer)
+        response = self.client.get(reverse('ad_list'), {'query': 'лыжи'})
+        self.assertContains(response, 'Сохранить поиск')
+        self.assertNotContains(self.client.get(reverse('ad_list')), 'Сохранить поиск')
+        response = self.client.post(reverse('save_search'), {'query': 'Лыжи', 'condition': ''}, follow=True)
+        self.assertContains(response, 'Поиск сохранён')
+        response = self.client.post(reverse('save_search'), {'query': ' '}, follow=True)
+        self.assertContains(response, 'Укажите запрос')
+
+        self.create_ad("Лыжи беговые")
+        self.client.force_login(self.buyer)
+        response = self.client.get(reverse('saved_searches'))
+        self.assertContains(response, 'Новых: 1')
+        self.assertContains(response, 'Лыжи беговые')
+        search = SavedSearch.objects.get()
+        self.client.post(reverse('read_saved_searches'), {'search': search.id})
+        self.assertNotContains(self.client.get(reverse('saved_searches')), 'Новых: 1')
+        self.client.force_login(self.seller)
+        self.assertEqual(self.client.post(reverse('delete_saved_search', args=[search.id])).status_code, 404)
+        self.client.force_login(self.buyer)
+        self.client.post(reverse('delete_saved_search', args=[search.id]))
+        self.assertFalse(SavedSearch.objects.exists())
+
+    @override_settings(ADS_SAVED_SEARCH_LIMIT=2)
+    def test_api(self):
+        self.client.force_login(self.buyer)
+        url = '/api/searches/'
+        response = self.client.post(url, {'query': 'Удочка', 'category': 'Спорт'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['category'], 'спорт')
+        self.assertEqual(self.client.post(url, {'query': ''}, content_type='application/json').status_code, 400)
+        self.client.post(url, {'condition': 'new'}, content_type='application/json')
+        response = self.client.post(url, {'query': 'Лодка'}, content_type='application/json')
+        self.assertIn('не больше 2', str(response.json()))
+
+        self.create_ad("Удочка", condition="new")
+        self.create_ad("Катушка", condition="new")
+        self.client.force_login(self.buyer)
+        searches = self.client.get(url).json()
+        self.assertEqual([search['unread_count'] for search in searches], [2, 1])
+        feed = self.client.get(f'{url}feed/', {'page_size': 2}).json()
+        self.assertEqual([match['ad']['title'] for match in feed['results']], ['Катушка', 'Удочка'])
+        self.assertIsNotNone(feed['next'])
+        self.assertEqual(self.client.post(f"{url}{searches[0]['id']}/read/").status_code, 204)
+        self.assertEqual([search['unread_count'] for search in self.client.get(url).json()], [0, 1])
+        self.client.force_login(self.seller)
+        self.assertEqual(self.client.get(url).json(), [])
+        self.assertEqual(self.client.get(f'{url}feed/', {'search': searches[0]['id']}).status_code, 404)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_saved_searches', '--searches', '300', '--users', '10', '--ads', '5',
+                     '--naive-ads', '1', '--vocabulary', '200', stdout=out)
+        self.assertIn('инвертированный индекс', out.getvalue())
+        self.assertFalse(SavedSearch.objects.exists())
+
+
+recorded_jobs = []
+
+
+@jobs.task('tests.record')
+def record_job(value, fail=False):
+    if fail:
+        raise ValueError('Сбой задачи')
+    recorded_jobs.append(value)
+
+
+@override_settings(ADS_JOBS_EAGER=False)
+class JobQueueTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        recorded_jobs.clear()
+
+    def test_enqueue_follows_transaction(self):
+        with self.assertRaises(KeyError):
+            jobs.enqueue('tests.unknown')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                jobs.enqueue('tests.record', {'value': 1})
+                raise ValueError
+        self.assertFalse(Job.objects.exists())  # Откатилась вместе с транзакцией
+
+        with self.captureOnCommitCallbacks(execute=True):
+            jobs.enqueue_on_commit('tests.record', {'value': 2})
+            self.assertFalse(Job.objects.exists())
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(recorded_jobs, [2])
+        self.assertFalse(Job.objects.exists())
+
+    def test_claims_batches(self):
+        for value in range(5):
+            jobs.enqueue('tests.record', {'value': value})
+        jobs.enqueue('tests.record', {'value': 9}, delay=60)
+        # UPDATE с подзапросом и выборка забранных
+        batch = self.assertQueryBudget(2, jobs.claim, 'first', 3)
+        self.assertEqual([job.payload['value'] for job in batch], [0, 1, 2])
+        self.assertEqual(len(jobs.claim('second', 10)), 2)  # Без чужих и отложенных задач
+        self.assertEqual(jobs.claim('third', 10), [])
+        # Успешные задачи удаляются одним запросом на пачку
+        self.assertEqual(self.assertQueryBudget(1, jobs.run_batch, batch), 3)
+        self.assertEqual(recorded_jobs, [0, 1, 2])
+        self.assertEqual(Job.objects.count(), 3)
+
+    def test_retries_with_backoff(self):
+        job = jobs.enqueue('tests.record', {'value': 1, 'fail': True}, max_attempts=2)
+        with self.assertLogs('ads.jobs', 'ERROR'):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_by), ('queued', 1, ''))
+        self.assertGreater(job.run_at, timezone.now() + datetime.timedelta(seconds=settings.ADS_JOBS_BACKOFF_BASE / 3))
+        self.assertIn('Сбой задачи', job.last_error)
+        self.assertEqual(jobs.run_pending(), 0)  # Пауза ещё не прошла
+
+        Job.objects.update(run_at=timezone.now())
+        with self.assertLogs('ads.jobs', 'ERROR'):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertTrue(10 <= jobs.backoff(3) <= 20)
+        with override_settings(ADS_JOBS_BACKOFF_MAX=7):
+            self.assertLessEqual(jobs.backoff(10), 7)
+
+    def test_recovers_jobs_of_dead_workers(self):
+        jobs.enqueue('tests.record', {'value': 1})
+        jobs.claim('dead', 1)
+        self.assertEqual(jobs.recover(), 0)
+        Job.objects.update(locked_at=timezone.now() - datetime.timedelta(seconds=settings.ADS_JOBS_LEASE_SECONDS + 1))
+        self.assertEqual(jobs.recover(), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(recorded_jobs, [1])
+
+    def test_proposal_side_effects_are_queued(self):
+        category = Category.objects.resolve("Спорт")
+        ads = [Ad.objects.create(user=User.objects.create_user(username=name), title=name, description="Описание",
+                                 category=category, condition="used") for name in ('anna', 'boris')]
+        proposal = ExchangeProposal.objects.create(ad_sender=ads[0], ad_receiver=ads[1])
+        self.assertEqual(list(Job.objects.filter(task='ads.find_cycles').values_list('payload', flat=True)),
+                         [{'proposal': proposal.pk}])
+        services.change_status(proposal, 'rejected')
+        self.assertEqual(jobs.run_pending(), 3)  # Подбор поисков для двух объявлений и поиск циклов
+        self.assertFalse(Job.objects.exists())  # Предложение уже не ожидает ответа: задача просто завершилась
+
+
+@override_settings(ADS_JOBS_EAGER=True)
+class EagerJobTest(TestCase):
+    def setUp(self):
+        recorded_jobs.clear()
+
+    def test_enqueue_runs_task_at_once(self):
+        jobs.enqueue('tests.record', {'value': 1})
+        self.assertEqual(recorded_jobs, [1])
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_task_keeps_callers_writes(self):
+        with transaction.atomic():
+            category = Category.objects.create(name="Книги", slug="knigi")
+            with self.assertLogs('ads.jobs', 'ERROR'):
+                jobs.enqueue('tests.record', {'value': 1, 'fail': True})
+        self.assertTrue(Category.objects.filter(pk=category.pk).exists())
+        self.assertEqual(recorded_jobs, [])
+
+
+@override_settings(ADS_JOBS_EAGER=False)
+class JobWorkerTest(TransactionTestCase):
+    """Воркеры в потоках, у каждого своё соединение"""
+
+    def setUp(self):
+        recorded_jobs.clear()
+
+    def test_workers_run_each_job_once(self):
+        Job.objects.bulk_create([jobs.build('tests.record', {'value': value}) for value in range(60)])
+        out = StringIO()
+        call_command('run_workers', '--threads', '3', '--batch-size', '4', '--poll-interval', '0.01', '--burst',
+                     stdout=out)
+        self.assertEqual(sorted(recorded_jobs), list(range(60)))
+        self.assertFalse(Job.objects.exists())
+        self.assertIn('Выполнено задач: 60, из них с ошибкой: 0', out.getvalue())
+
+    def test_signal_reaches_child_processes(self):
+        process = multiprocessing.get_context('fork').Process(target=time.sleep, args=(60,))
+        process.start()
+        with run_workers.forward_signals([process]):
+            os.kill(os.getpid(), signal.SIGTERM)
+            process.join(10)
+        self.assertEqual(process.exitcode, -signal.SIGTERM)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_jobs', '--jobs', '20', '--threads', '1', '2', '--batch-sizes', '5', '--task-ms', '0',
+                     stdout=out)
+        self.assertIn('пачка   5, потоков  2', out.getvalue())
+        self.assertFalse(Job.objects.exists())
+
+
+class EventStream:
+    """Тело ответа SSE, которое тест читает по частям, как сервер"""
+
+    def __init__(self, response):
+        self.chunks = aiter(response.streaming_content)
+        self.pending = None
+
+    async def read(self, timeout=1):
+        """Следующая часть потока или None, если за ``timeout`` секунд ничего не пришло"""
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(anext(self.chunks))
+        done, _ = await asyncio.wait({self.pending}, timeout=timeout)
+        if not done:
+            return None
+        chunk, self.pending = self.pending.result(), None
+        return chunk
+
+    async def close(self):
+        """Отключение клиента: сервер отменяет задачу, которая ждёт следующую часть"""
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(anext(self.chunks))
+            await asyncio.sleep(0)
+        self.pending.cancel()
+        await asyncio.gather(self.pending, return_exceptions=True)
+
+
+def event_data(chunk):
+    return [json.loads(line[len(b'data: '):]) for line in chunk.splitlines() if line.startswith(b'data: ')]
+
+
+@override_settings(ROOT_URLCONF='core.urls_async')
+class ProposalEventsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.resolve("Спорт")
+        cls.users, cls.ads = [], []
+        for name in ['anna', 'boris', 'clara']:
+            user = User.objects.create_user(username=name, password='12345')
+            cls.users.append(user)
+            cls.ads.append(Ad.objects.create(user=user, title=f"Вещь {name}", description="Описание",
+                                             category=category, condition="used"))
+
+    async def connect(self, user, headers=None):
+        client = AsyncClient()
+        await client.aforce_login(user)
+        response = await client.get(reverse('proposal_events'), headers=headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = EventStream(response)
+        self.assertTrue((await stream.read()).startswith(b'retry: '))
+        return stream
+
+    async def test_requires_login(self):
+        response = await self.async_client.get(reverse('proposal_events'))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_streams_events_to_sender_and_receiver(self):
+        anna, boris, clara = [await self.connect(user) for user in self.users]
+
+        def propose():
+            with self.captureOnCommitCallbacks(execute=True):
+                return ExchangeProposal.objects.create(ad_sender=self.ads[0], ad_receiver=self.ads[1])
+
+        def accept(proposal):
+            with self.captureOnCommitCallbacks(execute=True):
+                services.change_status(proposal, 'accepted')
+
+        proposal = await sync_to_async(propose)()  # Публикация из другого потока, как в синхронном view
+        for stream in (anna, boris):
+            [event] = event_data(await stream.read())
+            self.assertEqual(event, {
+                'type': 'created', 'proposal': proposal.pk, 'status': 'pending',
+                'ad_sender': self.ads[0].pk, 'ad_receiver': self.ads[1].pk, 'id': event['id'],
+            })
+        self.assertIsNone(await clara.read(timeout=0.05))
+        await sync_to_async(accept)(proposal)
+        self.assertEqual([event['status'] for event in event_data(await anna.read())], ['accepted'])
+        self.assertIn(f"id: {event['id'] + 1}\nevent: proposal\n".encode(), await boris.read())
+
+        for stream in (anna, boris, clara):
+            await stream.close()
+        self.assertEqual(len(events.get_channel().hub), 0)
+
+        def publish_without_listeners():
+            with self.assertNumQueries(0):  # Подписчиков нет: события не собираются
+                events.publish('status', [proposal.pk])
+        await sync_to_async(publish_without_listeners)()
+
+    async def test_heartbeat_and_resync(self):
+        with override_settings(ADS_EVENTS_HEARTBEAT=0.01, ADS_EVENTS_BUFFER=2):
+            stream = await self.connect(self.users[0])
+            self.assertEqual(await stream.read(), b': ping\n\n')
+            # Клиент не читает: после переполнения буфера вместо событий — resync
+            events.get_channel().hub.dispatch([({self.users[0].pk}, {'type': 'status'})] * 3)
+            self.assertEqual(await stream.read(), events.RESYNC)
+            # Переподключение: пропущенные события не хранятся, клиент перечитывает список
+            reconnected = await self.connect(self.users[0], headers={'Last-Event-ID': '7'})
+            self.assertEqual(await reconnected.read(), events.RESYNC)
+            await stream.close()
+            await reconnected.close()
+
+    async def test_holds_thousands_of_idle_connections(self):
+        view, factory = async_views.ProposalEventsView.as_view(), AsyncRequestFactory()
+
+        async def connect(user_id):
+            async def auser():
+                return User(pk=user_id)  # Без запросов к БД: подписке нужен только id
+            request = factory.get('/events/proposals/')
+            request.auser = auser
+            stream = EventStream(await view(request))
+            await stream.read()
+            return stream
+
+        count = 2000
+        streams = [await connect(0)]
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            streams += [await connect(user_id) for user_id in range(1, count)]
+            for stream in streams:  # Каждое соединение ждёт событий, как простаивающий клиент
+                self.assertIsNone(await stream.read(timeout=0))
+            gc.collect()
+            per_connection = (tracemalloc.get_traced_memory()[0] - before) / (count - 1)
+            hub = events.get_channel().hub
+            self.assertEqual(len(hub), count)
+            # Запрос, поток ответа, подписка и ожидание — несколько КиБ, без буфера событий
+            self.assertLess(per_connection, 16 * 1024)
+
+            hub.dispatch([({7}, {'type': 'status'})])
+            await asyncio.sleep(0.01)
+            self.assertEqual([stream.pending.done() for stream in streams].count(True), 1)
+            self.assertEqual(event_data(await streams[7].read())[0]['type'], 'status')
+
+            for stream in streams:
+                await stream.close()
+            del stream, streams
+            gc.collect()
+            self.assertEqual(len(hub), 0)
+            self.assertLess(tracemalloc.get_traced_memory()[0] - before, count * 1024)
+        finally:
+            tracemalloc.stop()
+
+
+class ProposalCounterTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.resolve("Спорт")
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.sender = User.objects.create_user(username='sender', password='12345')
+        cls.ad = Ad.objects.create(user=cls.owner, title="Велосипед", description="Описание",
+                                   category=category, condition="used")
+        cls.other_ad = Ad.objects.create(user=cls.owner, title="Самокат", description="Описание",
+                                         category=category, condition="used")
+        cls.offers = [
+            Ad.objects.create(user=cls.sender, title=f"Вещь {number}", description="Описание",
+                              category=category, condition="used")
+            for number in range(3)
+        ]
+
+    def counts(self, ad):
+        return tuple(Ad.objects.filter(pk=ad.pk).values_list(*counters.FIELDS).get())
+
+    def test_signals(self):
+        proposal = ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.ad)
+        ExchangeProposal.objects.create(ad_sender=self.offers[1], ad_receiver=self.ad, status='rejected')
+        self.assertEqual(self.counts(self.ad), (2, 1, 0, 0))
+        self.assertEqual(self.counts(self.offers[0]), (0, 0, 0, 1))
+        proposal.status = 'accepted'
+        proposal.save()
+        self.assertEqual(self.counts(self.ad), (2, 0, 1, 0))
+        proposal.delete()
+        self.assertEqual(self.counts(self.ad), (1, 0, 0, 0))
+        self.assertEqual(self.counts(self.offers[0]), (0, 0, 0, 0))
+
+    def test_stale_save_keeps_counters(self):
+        stale = Ad.objects.get(pk=self.ad.pk)
+        ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.ad)
+        form = AdForm({'title': "Горный велосипед", 'description': "Описание", 'category': "Спорт",
+                       'condition': "used"}, instance=stale)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.counts(self.ad), (1, 1, 0, 0))
+
+    def test_plain_save_writes_all_fields(self):
+        # Правки формы и API пишут только свои поля; обычный save() остаётся обычным
+        ad = Ad.objects.get(pk=self.other_ad.pk)
+        Ad.objects.filter(pk=ad.pk).delete()
+        ad.save()
+        self.assertTrue(Ad.objects.filter(pk=ad.pk, title="Самокат").exists())
+
+    def test_services(self):
+        first, second, third = [
+            ExchangeProposal.objects.create(ad_sender=offer, ad_receiver=self.ad) for offer in self.offers
+        ]
+        services.reject(third)
+        self.assertEqual(self.counts(self.ad), (3, 2, 0, 0))
+        services.accept(first)
+        self.assertEqual(self.counts(self.ad), (3, 0, 1, 0))
+        services.change_status_many(self.owner, [second.id], 'rejected')
+        self.assertEqual(self.counts(self.ad), (3, 0, 1, 0))
+        self.assertEqual(counters.reconcile(), 0)
+
+    def test_reconcile_command(self):
+        ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.ad)
+        Ad.objects.filter(pk=self.ad.pk).update(received_count=7, pending_count=0)
+        Ad.objects.filter(pk=self.other_ad.pk).update(sent_count=3)
+        out = StringIO()
+        call_command('reconcile_counters', '--batch-size', '2', stdout=out)
+        self.assertIn('Счётчики исправлены у объявлений: 2', out.getvalue())
+        self.assertEqual(self.counts(self.ad), (1, 1, 0, 0))
+        self.assertEqual(self.counts(self.other_ad), (0, 0, 0, 0))
+
+    def test_list_and_api(self):
+        ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.ad)
+        cache.clear()
+        response = self.assertQueryBudget(4, self.client.get, reverse('ad_list'), {'paginate_by': 10})
+        self.assertContains(response, 'Предложений: 1, ожидают ответа: 1')
+        data = self.assertQueryBudget(2, self.client.get, f'/api/ads/{self.ad.pk}/').json()  # Версия для ETag и строка
+        self.assertEqual([data[name] for name in counters.FIELDS], [1, 1, 0, 0])
+
+
+class ProposalConcurrencyTest(TransactionTestCase):
+    """Одновременные принятия и отклонения из разных потоков (у каждого своё соединение)"""
+
+    def setUp(self):
+        category = Category.objects.resolve("Спорт")
+        owner = User.objects.create_user(username='owner')
+        self.ad = Ad.objects.create(user=owner, title="Велосипед", description="Описание",
+                                    category=category, condition="used")
+        self.proposals = []
+        for number in range(8):
+            user = User.objects.create_user(username=f'sender{number}')
+            ad = Ad.objects.create(user=user, title=f"Вещь {number}", description="Описание",
+                                   category=category, condition="used")
+            self.proposals.append(ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=self.ad))
+
+    def hammer(self, proposal, status, barrier, outcomes):
+        barrier.wait()
+        try:
+            while True:
+                try:
+                    services.change_status(proposal, status)
+                    outcomes.append(status)
+                    return
+                except services.ProposalConflict:
+                    outcomes.append('conflict')
+                    return
+                except OperationalError:
+                    continue  # База занята другой записью: повторяем, как сделал бы busy_timeout
+        finally:
+            connection.close()
+
+    def test_one_accept_wins(self):
+        jobs = [(proposal, status) for proposal in self.proposals for status in ('accepted', 'accepted', 'rejected')]
+        barrier, outcomes = threading.Barrier(len(jobs)), []
+        threads = [threading.Thread(target=self.hammer, args=(*job, barrier, outcomes)) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        statuses = list(ExchangeProposal.objects.values_list('status', flat=True))
+        self.assertEqual(statuses.count('accepted'), 1)
+        self.assertEqual(statuses.count('rejected'), len(self.proposals) - 1)
+        # Успешно ровно одно принятие; остальные запросы отклонили своё предложение или получили отказ
+        self.assertEqual(len(outcomes), len(jobs))
+        self.assertEqual(outcomes.count('accepted'), 1)
+        self.assertLessEqual(outcomes.count('rejected'), len(self.proposals) - 1)
+        self.assertFalse(ProposalEdge.objects.exists())
+        self.ad.refresh_from_db()
+        self.assertEqual((self.ad.pending_count, self.ad.accepted_count), (0, 1))
+
+
+@override_settings(ADS_VIEWS_FLUSH_INTERVAL=60 * 60)
+class ViewCountTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        category = Category.objects.resolve("Спорт")
+        cls.ads = [
+            Ad.objects.create(user=cls.owner, title=f"Мяч {number}", description="Футбольный",
+                              category=category, condition="used")
+            for number in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        viewcounts.buffer.flush()  # Просмотры прошлых тестов
+
+    def view_counts(self):
+        return dict(Ad.objects.filter(pk__in=[ad.pk for ad in self.ads]).values_list('pk', 'view_count'))
+
+    def test_flush_is_one_update(self):
+        buffer = viewcounts.ViewBuffer()
+        for ad in [self.ads[0]] * 3 + [self.ads[1]] * 2:
+            self.assertFalse(buffer.record(ad.pk))
+        self.assertEqual(buffer.pending(self.ads[0].pk), 3)
+        updated_at = self.ads[0].updated_at
+        self.assertQueryBudget(1, buffer.flush)
+        self.assertEqual(self.view_counts(), {self.ads[0].pk: 3, self.ads[1].pk: 2, self.ads[2].pk: 0})
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.flush(), 0)
+        # Кэш фрагментов и ETag объявления запись просмотров не сбрасывает
+        self.ads[0].refresh_from_db()
+        self.assertEqual(self.ads[0].updated_at, updated_at)
+
+    def test_flush_when_due(self):
+        buffer = viewcounts.ViewBuffer(interval=0)
+        self.assertTrue(buffer.record(self.ads[0].pk))
+        buffer = viewcounts.ViewBuffer(max_pending=2)
+        self.assertFalse(buffer.record(self.ads[0].pk))
+        self.assertFalse(buffer.record(self.ads[0].pk))
+        self.assertTrue(buffer.record(self.ads[1].pk))
+        self.assertEqual(buffer.flush(), 2)
+
+    def test_concurrent_records(self):
+        buffer = viewcounts.ViewBuffer()
+
+        def record():
+            for _ in range(1000):
+                buffer.record(self.ads[0].pk)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(buffer.pending(self.ads[0].pk), 8000)
+
+    def test_failed_flush_keeps_views(self):
+        buffer = viewcounts.ViewBuffer()
+        buffer.record(self.ads[0].pk)
+        with self.assertLogs('ads.viewcounts', 'ERROR'), transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {Ad._meta.db_table}')
+            self.assertEqual(buffer.flush(), 0)
+            transaction.set_rollback(True)
+        self.assertEqual(buffer.pending(self.ads[0].pk), 1)
+
+    def test_detail_counts_views(self):
+        ad = self.ads[0]
+        before = self.view_counts()[ad.pk]
+        url = reverse('ad_detail', args=[ad.pk])
+        response = self.client.get(url)
+        self.assertContains(response, f'Просмотров: {before + 1}')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertContains(self.client.get(url), f'Просмотров: {before + 3}')
+        self.assertEqual(self.client.get(reverse('ad_detail', args=[10 ** 6])).status_code, 404)
+        self.assertEqual(self.view_counts()[ad.pk], before)  # Ещё в буфере
+
+        etag = response['ETag']
+        viewcounts.buffer.flush()
+        self.assertEqual(self.view_counts()[ad.pk], before + 3)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        data = self.client.get(f'/api/ads/{ad.pk}/').json()
+        self.assertEqual(data['view_count'], before + 3)
+
+    @override_settings(ROOT_URLCONF='core.urls_async')
+    async def test_async_detail_counts_views(self):
+        ad = self.ads[1]
+        before = viewcounts.buffer.pending(ad.pk)
+        response = await self.async_client.get(reverse('ad_detail', args=[ad.pk]))
+        self.assertContains(response, 'Просмотров:')
+        await self.async_client.get(reverse('ad_detail', args=[ad.pk]), headers={'If-None-Match': response['ETag']})
+        self.assertEqual(viewcounts.buffer.pending(ad.pk), before + 2)
+
+    def test_due_request_flushes(self):
+        ad = self.ads[2]
+        with override_settings(ADS_VIEWS_FLUSH_INTERVAL=0, DATABASE_REPLICAS=['missing']):
+            response = self.client.get(reverse('ad_detail', args=[ad.pk]))
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)  # Запись буфера — не запись зрителя
+        self.assertEqual(self.view_counts()[ad.pk], 1)
+        self.assertEqual(viewcounts.buffer.pending(ad.pk), 0)
+
+    def test_form_does_not_overwrite_views(self):
+        ad = Ad.objects.get(pk=self.ads[0].pk)
+        Ad.objects.filter(pk=ad.pk).update(view_count=F('view_count') + 5)
+        form = AdForm({'title': "Мяч баскетбольный", 'description': "Футбольный", 'category': "Спорт",
+                       'condition': "used"}, instance=ad)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.view_counts()[ad.pk], 5)
+
+
+class ViewCountBenchmarkTest(TransactionTestCase):
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_views', '--ads', '5', '--views', '50', '--threads', '1', '2', stdout=out)
+        self.assertIn('буфер процесса', out.getvalue())
+        self.assertEqual(out.getvalue().count('записано 50'), 4)  # Ни один просмотр не потерян
+        self.assertFalse(Ad.objects.exists())
+
+
+@override_settings(ADS_LIST_CACHE_TIMEOUT=0, ADS_VIEWS_FLUSH_INTERVAL=60 * 60)
+class PopularityTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.resolve("Спорт")
+        cls.owner = User.objects.create_user(username='owner', password='12345')
+        cls.sender = User.objects.create_user(username='sender', password='12345')
+        # Старые объявления первыми: по умолчанию лента показывает их последними
+        cls.ads = [
+            Ad.objects.create(user=cls.owner, title=f"Мяч {number}", description="Футбольный",
+                              category=category, condition="used")
+            for number in range(5)
+        ]
+        cls.offer = Ad.objects.create(user=cls.sender, title="Самокат", description="Описание",
+                                      category=category, condition="new")
+
+    def setUp(self):
+        cache.clear()
+        popularity.rescore()
+
+    def scores(self):
+        return dict(Ad.objects.values_list('pk', 'popularity'))
+
+    def test_score_decays_by_half_life(self):
+        now = timezone.now()
+        half_life = datetime.timedelta(seconds=settings.ADS_POPULAR_HALF_LIFE)
+        # Вдвое большая вовлечённость уравновешивает возраст в один период полураспада
+        self.assertAlmostEqual(popularity.score(0, 1, now), popularity.score(0, 3, now - half_life))
+        self.assertGreater(popularity.score(1, 0, now), popularity.score(0, 1, now))
+        self.assertGreater(popularity.score(0, 0, now), popularity.score(0, 0, now - half_life))
+
+    def test_rescore_only_changed(self):
+        self.assertEqual(popularity.rescore(), 0)
+        before = self.scores()
+        ExchangeProposal.objects.create(ad_sender=self.offer, ad_receiver=self.ads[0])
+        viewcounts.write({self.ads[1].pk: 3})
+        self.assertEqual(
+            set(Ad.objects.filter(popularity_stale=True).values_list('pk', flat=True)),
+            {self.offer.pk, self.ads[0].pk, self.ads[1].pk},
+        )
+        self.assertEqual(popularity.rescore(chunk_size=2), 3)
+        after = self.scores()
+        self.assertGreater(after[self.ads[0].pk], before[self.ads[0].pk])
+        self.assertGreater(after[self.ads[1].pk], before[self.ads[1].pk])
+        self.assertEqual(after[self.ads[2].pk], before[self.ads[2].pk])
+
+    def test_rescore_keeps_fragment_cache(self):
+        updated_at = Ad.objects.get(pk=self.ads[0].pk).updated_at
+        popularity.rescore(everything=True)
+        self.assertEqual(Ad.objects.get(pk=self.ads[0].pk).updated_at, updated_at)
+
+    def test_form_does_not_overwrite_score(self):
+        ad = Ad.objects.get(pk=self.ads[0].pk)
+        Ad.objects.filter(pk=ad.pk).update(popularity=100)
+        serializer = AdSerializer(ad, data={'title': "Мяч баскетбольный"}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.assertEqual(self.scores()[ad.pk], 100)
+        self.assertEqual(Ad.objects.get(pk=ad.pk).title, "Мяч баскетбольный")
+
+    def make_popular(self):
+        """Просмотры: ads[1] популярнее всех, затем ads[3]"""
+        viewcounts.write({self.ads[1].pk: 50, self.ads[3].pk: 5})
+        popularity.rescore()
+        return [self.ads[1].pk, self.ads[3].pk, self.offer.pk, self.ads[4].pk, self.ads[2].pk, self.ads[0].pk]
+
+    def test_list_page(self):
+        expected = self.make_popular()
+        response = self.client.get(reverse('ad_list'), {'ordering': 'popular', 'paginate_by': 5})
+        self.assertEqual([ad.pk for ad in response.context['ads']], expected[:5])
+        self.assertContains(response, 'ordering=popular')  # Ссылки пагинации сохраняют сортировку
+        response = self.client.get(reverse('ad_list'), {'ordering': 'popular', 'paginate_by': 5, 'page': 2})
+        self.assertEqual([ad.pk for ad in response.context['ads']], expected[5:])
+        response = self.client.get(reverse('ad_list'), {'paginate_by': 5})
+        self.assertEqual(response.context['ads'][0].pk, self.offer.pk)  # По умолчанию — новые первыми
+
+    def test_list_cursor(self):
+        expected = self.make_popular()
+        seen, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get(reverse('ad_list'), {'ordering': 'popular', 'paginate_by': 5, 'cursor': cursor})
+            page = response.context['page_obj']
+            seen += [ad.pk for ad in page]
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+    def test_api(self):
+        expected = self.make_popular()
+        seen, url = [], '/api/ads/?ordering=popular&page_size=4&fields=id,title'
+        while url:
+            data = self.assertQueryBudget(1, self.client.get, url).json()
+            seen += [row['id'] for row in data['results']]
+            url = data['next']
+        self.assertEqual(seen, expected)
+        data = self.client.get('/api/ads/', {'ordering': 'popular', 'condition': 'used'}).json()
+        self.assertEqual([row['id'] for row in data['results']], [pk for pk in expected if pk != self.offer.pk])
+        self.assertEqual(self.client.get('/api/ads/', {'ordering': 'popular', 'cursor': 'мусор'}).status_code, 404)
+
+    @override_settings(ROOT_URLCONF='core.urls_async')
+    async def test_async_api(self):
+        expected = await sync_to_async(self.make_popular)()
+        data = (await self.async_client.get('/api/ads/', {'ordering': 'popular', 'page_size': 4})).json()
+        second = (await self.async_client.get(data['next'])).json()
+        self.assertEqual([row['id'] for row in data['results'] + second['results']], expected)
+
+    def test_rescore_changes_popular_etag_only(self):
+        etags = {
+            ordering: self.client.get('/api/ads/', {'ordering': ordering})['ETag'] for ordering in ('', 'popular')
+        }
+        self.make_popular()
+        self.assertEqual(self.client.get('/api/ads/')['ETag'], etags[''])
+        response = self.client.get('/api/ads/', {'ordering': 'popular'}, HTTP_IF_NONE_MATCH=etags['popular'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_command(self):
+        Ad.objects.update(popularity_stale=True)
+        out = StringIO()
+        call_command('update_popularity', '--chunk-size', '4', stdout=out)
+        self.assertIn('Пересчитана популярность объявлений: 6', out.getvalue())
+        call_command('update_popularity', stdout=out)
+        self.assertIn('Пересчитана популярность объявлений: 0', out.getvalue())
+        call_command('update_popularity', '--all', stdout=out)
+        self.assertIn('Пересчитана популярность объявлений: 6', out.getvalue().splitlines()[-1])
+
+
+def tearDownModule():
+    # Просмотры, накопленные тестами, пишутся до удаления тестовой базы, а не при выходе (atexit)
+    viewcounts.buffer.flush()
@@ -17,6 +17,15 @@ urlpatterns = [
     path('update/<int:pk>/', UpdateExchangeProposalStatusView.as_view(), name='update_exchange_proposal_status'),
     path('proposals/', ExchangeProposalListView.as_view(), name='exchange_proposals'),
 
+    # Сохранённые поиски и лента новых объявлений по ним
+    path('searches/', views.SavedSearchListView.as_view(), name='saved_searches'),
+    path('searches/save/', views.SaveSearchView.as_view(), name='save_search'),
+    path('searches/read/', views.ReadSavedSearchesView.as_view(), name='read_saved_searches'),
+    path('searches/<int:pk>/delete/', views.DeleteSavedSearchView.as_view(), name='delete_saved_search'),
+
+    # Выгрузка для аналитики (только персонал)
+    path('export/<str:kind>/', views.ExportView.as_view(), name='export'),
+
     # Авторизация
     path('login/', CustomLoginView.as_view(), name='login'),
     path('logout/', CustomLogoutView.as_view(), name='logout'),
@@ -0,0 +1,126 @@
+"""Счётчик просмотров объявлений с объединением записей в памяти процесса.
+
+``UPDATE`` на каждый просмотр делает запись из каждого чтения страницы: на
+SQLite писатель один (в профиле production транзакция сразу берёт
+блокировку записи), и популярное объявление упирается в очередь за одной
+строкой. Поэтому просмотр (``record``) только увеличивает счётчик в буфере
+процесса, а ``flush`` пишет накопленное одним
+``UPDATE ... SET view_count = view_count + CASE id WHEN ... END`` на все
+объявления буфера:
+
+* раз в ``ADS_VIEWS_FLUSH_INTERVAL`` секунд — запрос, заметивший, что срок
+  вышел, или раньше, если в буфере ``ADS_VIEWS_MAX_PENDING`` объявлений;
+* при остановке процесса (``atexit``).
+
+Число просмотров приблизительное. Если процесс упадёт (SIGKILL, OOM),
+теряются просмотры с последней записи — не больше чем за один интервал
+и не больше чем по ``ADS_VIEWS_MAX_PENDING`` объявлениям на процесс. Если
+запись не удалась (база занята), просмотры возвращаются в буфер до
+следующей попытки. Запись идёт вне состояния маршрутизатора реплик
+(``core.db_router.detached``): она не относится к запросу, который её
+вызвал, и не привязывает его клиента к основной базе. ``updated_at`` запись не меняет: иначе каждый интервал
+сбрасывал бы кэш фрагментов и ETag всех просматриваемых объявлений. Поэтому
+страница объявления выводит число вне кэшированного тела, а ответы 304 и
+API могут показывать его с опозданием до следующего изменения объявления.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Case, F, Value, When
+
+from core.db_router import detached
+
+from .models import Ad
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500  # Объявлений в одном UPDATE: предел параметров запроса
+
+
+def write(counts):
+    """Прибавляет ``{id объявления: просмотры}`` к ``view_count``; возвращает число запросов"""
+    items = sorted(counts.items())
+    for start in range(0, len(items), CHUNK_SIZE):
+        chunk = items[start:start + CHUNK_SIZE]
+        Ad.objects.filter(pk__in=[pk for pk, _ in chunk]).update(view_count=F('view_count') + Case(
+            *[When(pk=pk, then=Value(views)) for pk, views in chunk], default=Value(0),
+        ), popularity_stale=True)
+    return (len(items) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+class ViewBuffer:
+    """Просмотры процесса, ещё не записанные в базу; методы потокобезопасны"""
+
+    def __init__(self, interval=None, max_pending=None):
+        self.interval, self.max_pending = interval, max_pending  # None — из настроек
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def due(self, now):
+        interval = settings.ADS_VIEWS_FLUSH_INTERVAL if self.interval is None else self.interval
+        max_pending = self.max_pending or settings.ADS_VIEWS_MAX_PENDING
+        return now - self.flushed_at >= interval or len(self.counts) >= max_pending
+
+    def record(self, pk):
+        """Учитывает просмотр; True — пора вызвать ``flush`` (ровно один вызывающий получает True)"""
+        with self.lock:
+            self.counts[pk] += 1
+            now = time.monotonic()
+            if not self.due(now):
+                return False
+            self.flushed_at = now  # Следующие просмотры не ждут, пока этот вызывающий пишет
+            return True
+
+    def pending(self, pk):
+        """Просмотры объявления, ещё не записанные этим процессом"""
+        with self.lock:
+            return self.counts.get(pk, 0)
+
+    def flush(self):
+        """Пишет накопленные просмотры в базу; возвращает число объявлений"""
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            self.flushed_at = time.monotonic()
+        if not counts:
+            return 0
+        try:
+            with detached():
+                write(counts)
+        except DatabaseError:
+            # Просмотры вернутся в буфер и запишутся со следующей попыткой
+            logger.exception('Не удалось записать просмотры %s объявлений', len(counts))
+            with self.lock:
+                self.counts.update(counts)
+            return 0
+        return len(counts)
+
+
+buffer = ViewBuffer()
+atexit.register(buffer.flush)
+
+
+def record(pk):
+    """Учитывает просмотр объявления ``pk``; запись в базу — когда подойдёт срок"""
+    if buffer.record(pk):
+        buffer.flush()
+
+
+async def arecord(pk):
+    """Асинхронная версия ``record``: в поток уходит только запись в базу"""
+    if buffer.record(pk):
+        await sync_to_async(buffer.flush)()
+
+
+def current(ad):
+    """Просмотры объявления с учётом ещё не записанных этим процессом"""
+    return ad.view_count + buffer.pending(ad.pk)
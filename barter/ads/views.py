@@ -1,59 +1,187 @@
+import asyncio
+
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.messages import get_messages
 from django.contrib.auth.views import LoginView, LogoutView
-from django.db.models import Q
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
-from django.urls import reverse_lazy
+from django.db import OperationalError, transaction
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.generic import View, ListView, DetailView, CreateView, UpdateView, DeleteView
+from django.urls import NoReverseMatch, reverse, reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticatedOrReadOnly
-
-from .models import Ad, ExchangeProposal
+from rest_framework import mixins, viewsets
+from drf_spectacular.utils import extend_schema
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.response import Response
+
+from .models import Ad, BarterCycle, BarterCycleStep, ExchangeProposal, SavedSearch
 from .forms import AdForm, AdFilterForm, ExchangeProposalForm
 from django.shortcuts import redirect, get_object_or_404
 from django.contrib.auth.forms import UserCreationForm
 
-from .serializers import AdSerializer
+from core.db_router import fail_over, replica_reads
+
+from . import caching, conditional, cycles, export, percolator, recommendations, services, viewcounts
+from .facets import facet_counts
+from .fieldsets import FIELDSET_PARAMETERS, FieldSet, RowBuilder
+from .pagination import AdKeysetPagination, FeedPagination, InvalidCursor, KeysetPaginator
+from .serializers import (
+    AdSerializer, BarterCycleSerializer, CategoryFacetSerializer, ExchangeProposalSerializer,
+    ProposalBulkResponseSerializer, ProposalBulkSerializer, ProposalTransitionSerializer, SavedSearchMatchSerializer,
+    SavedSearchSerializer,
+)
+
+
+class CachedObjectMixin:
+    """Запоминает get_object() на время запроса: test_func и сам view вызывают его повторно"""
+
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+
+class ReplicaReadMixin:
+    """GET и HEAD читают объявления с реплики БД (см. core.db_router).
+
+    Если реплика отказала посреди запроса, он повторяется на основной базе.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        if self.view_is_async:
+            return self.dispatch_replica_async(request, *args, **kwargs)
+        with replica_reads() as used:
+            try:
+                return super().dispatch(request, *args, **kwargs)
+            except OperationalError:
+                if not used:
+                    raise
+        fail_over(used)
+        return super().dispatch(request, *args, **kwargs)
+
+    async def dispatch_replica_async(self, request, *args, **kwargs):
+        dispatch = super(ReplicaReadMixin, self).dispatch
+        with replica_reads() as used:
+            try:
+                response = dispatch(request, *args, **kwargs)
+                return await response if asyncio.iscoroutine(response) else response
+            except OperationalError:
+                if not used:
+                    raise
+        fail_over(used)
+        response = dispatch(request, *args, **kwargs)
+        return await response if asyncio.iscoroutine(response) else response
 
 
 # Главная страница (список объявлений)
-class AdListView(ListView):
+class AdListView(ReplicaReadMixin, ListView):
     """Отображение списка объявлений"""
-    model = Ad
+    queryset = Ad.objects.select_related('category')
     template_name = 'ads/ad_list.html'
     context_object_name = 'ads'
-    ordering = ['-created_at']  # Сортировка по дате создания
     paginate_by = 4  # Пагинация
+    # Параметры, сохраняемые в ссылках
+    filter_params = ('query', 'category', 'condition', 'ordering', 'paginate_by')
+
+    def get(self, request, *args, **kwargs):
+        # Анонимные страницы отдаются из кэша (см. ads.caching)
+        cache_key = self.get_cache_key()
+        response = self.get_cached_response(cache_key)
+        if response is None:
+            response = self.cache_response(super().get(request, *args, **kwargs), cache_key)
+        return response
+
+    def get_cached_response(self, cache_key):
+        cached = caching.get_page(cache_key) if cache_key is not None else None
+        if cached is None:
+            return None
+        content, content_type = cached
+        response = HttpResponse(content, content_type=content_type)
+        response['X-Cache'] = 'HIT'
+        return response
+
+    def cache_response(self, response, cache_key):
+        if cache_key is not None:
+            response['X-Cache'] = 'MISS'
+            response.add_post_render_callback(lambda rendered: caching.set_page(cache_key, rendered))
+        return response
+
+    def get_cache_key(self):
+        """Ключ кэша страницы или None, если её нельзя кэшировать"""
+        request = self.request
+        # Страницы пользователей персональны, а всплывающие сообщения показываются один раз
+        if not caching.timeout() or request.user.is_authenticated or get_messages(request):
+            return None
+        form = AdFilterForm(request.GET)
+        cleaned_data = form.cleaned_data if form.is_valid() else {}
+        if self.use_cursor_pagination():
+            page, cursor = None, request.GET.get('cursor', '')
+        else:
+            page, cursor = request.GET.get('page') or '1', None
+        params = caching.normalize_params(cleaned_data, page, self.get_paginate_by(None), cursor)
+        return caching.page_key(params)
+
+    def get_ordering(self):
+        # Сортировка по дате создания или, с ?ordering=popular, по популярности (ads.popularity)
+        return AdFilterForm(self.request.GET).get_ordering()
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset()  # Сортировка из get_ordering
         form = AdFilterForm(self.request.GET)
 
+        # Поиск по ключевым словам, категории и состоянию; при поиске
+        # объявления сортируются по релевантности, затем по дате
         if form.is_valid():
-            query = form.cleaned_data.get('query')
-            category = form.cleaned_data.get('category')
-            condition = form.cleaned_data.get('condition')
-
-            # Поиск по ключевым словам
-            if query:
-                queryset = queryset.filter(
-                    Q(title__icontains=query) | Q(description__icontains=query)
-                )
-
-            # Фильтрация по категории
-            if category:
-                queryset = queryset.filter(category__icontains=category)
+            queryset = form.filter_queryset(queryset)
 
-            # Фильтрация по состоянию
-            if condition:
-                queryset = queryset.filter(condition=condition)
-
-        return queryset.order_by('-created_at')  # Сортировка по дате создания
+        return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['form'] = AdFilterForm(self.request.GET)
+        context.update(self.get_list_context(context['ads'], facet_counts()))
         return context
 
+    def get_list_context(self, ads, facets):
+        """Контекст страницы поверх пагинации (общий с асинхронной версией)"""
+        # Параметры фильтра для ссылок пагинации
+        # (только параметры фильтра: страница может попасть в кэш и достаться другим)
+        params = self.request.GET.copy()
+        for name in list(params):
+            if name not in self.filter_params:
+                del params[name]
+        return {
+            'form': AdFilterForm(self.request.GET),
+            'facets': facets,  # Счётчики категорий и состояний
+            # Карточки из кэша фрагментов одним запросом к кэшу
+            'ad_cards': caching.render_fragments(
+                'ad_card', 'ads/includes/ad_card.html', ads, self.request.user,
+            ),
+            'pagination_query': params.urlencode(),
+            'cursor_pagination': self.use_cursor_pagination(),
+        }
+
+    def use_cursor_pagination(self):
+        # Курсорный режим включается настройкой или параметром ?cursor=
+        return settings.ADS_LIST_PAGINATION == 'cursor' or 'cursor' in self.request.GET
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_cursor_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        # Keyset-пагинация по (created_at, id) или (popularity, id): без OFFSET и COUNT(*)
+        paginator = KeysetPaginator(queryset, page_size, self.get_ordering())
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404("Некорректный курсор страницы.")
+        return paginator, page, page.object_list, page.has_other_pages()
+
     def get_paginate_by(self, queryset):
         # Получаем значение paginate_by из GET-параметра или используем значение по умолчанию
         try:
@@ -66,12 +194,54 @@ class AdListView(ListView):
 
 
 # Детали объявления
-class AdDetailView(DetailView):
+class AdDetailView(ReplicaReadMixin, DetailView):
     """Детали одного объявления"""
-    model = Ad
+    queryset = Ad.objects.select_related('user', 'category')
     template_name = 'ads/ad_detail.html'
     context_object_name = 'ad'
 
+    def get(self, request, *args, **kwargs):
+        # Всплывающие сообщения показываются один раз: такую страницу не кэшируем в браузере
+        if get_messages(request):
+            return self.get_page(request, *args, **kwargs)
+        version = conditional.ad_version(kwargs['pk'])
+        if version is not None:
+            etag = self.get_etag(version)
+            response = conditional.precondition_response(request, etag, version)
+            if response is not None:
+                viewcounts.record(kwargs['pk'])  # Ответ 304 — тоже просмотр
+                return conditional.set_validators(response, etag, version)
+        response = self.get_page(request, *args, **kwargs)
+        version = conditional.version_of(self.object)
+        return conditional.set_validators(response, self.get_etag(version), version)
+
+    def get_page(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        # Просмотр учитывается, когда всё прочитано: если реплика откажет раньше,
+        # повтор на основной базе (ReplicaReadMixin) не учтёт его дважды
+        viewcounts.record(self.object.pk)
+        return response
+
+    def get_etag(self, version):
+        # Страница зависит от пользователя (кнопки, шапка) и от CSRF-токена в форме выхода
+        user = self.request.user
+        viewer = (user.pk, self.request.COOKIES.get(settings.CSRF_COOKIE_NAME)) if user.is_authenticated else ()
+        return conditional.ad_etag(self.kwargs['pk'], version, *viewer)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Тело страницы кэшируется по (id, версия объявления и счётчиков, отношение зрителя)
+        context['relationship'] = caching.viewer_relationship(self.object, self.request.user)
+        context['fragment_timeout'] = caching.fragment_timeout()
+        # Похожие объявления выводятся вне кэшированного тела (асинхронная версия загружает их заранее)
+        if not hasattr(self, 'similar_ads'):
+            self.similar_ads = recommendations.similar_ads(self.object)
+        context['similar_ads'] = self.similar_ads
+        # Число просмотров меняется без смены updated_at, поэтому тоже вне кэшированного тела;
+        # этот просмотр ещё не учтён (см. get_page)
+        context['view_count'] = viewcounts.current(self.object) + 1
+        return context
+
 
 # Создание объявления
 class AdCreateView(LoginRequiredMixin, CreateView):
@@ -87,9 +257,9 @@ class AdCreateView(LoginRequiredMixin, CreateView):
         return super().form_valid(form)
 
 
-class AdUpdateView(LoginRequiredMixin, UpdateView):
+class AdUpdateView(LoginRequiredMixin, CachedObjectMixin, UpdateView):
     """Редактирование объявления"""
-    model = Ad
+    queryset = Ad.objects.select_related('category')
     form_class = AdForm
     template_name = 'ads/edit_ad.html'
     context_object_name = 'ad'
@@ -97,7 +267,7 @@ class AdUpdateView(LoginRequiredMixin, UpdateView):
     def test_func(self):
         # Проверяем, является ли текущий пользователь автором объявления
         ad = self.get_object()
-        return ad.user == self.request.user
+        return ad.user_id == self.request.user.id
 
     def handle_no_permission(self):
         # Если пользователь не имеет права редактировать, выводим сообщение об ошибке
@@ -110,16 +280,16 @@ class AdUpdateView(LoginRequiredMixin, UpdateView):
         return reverse_lazy('ad_detail', kwargs={'pk': self.object.id})
 
 
-class AdDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class AdDeleteView(LoginRequiredMixin, UserPassesTestMixin, CachedObjectMixin, DeleteView):
     """Удаление объявления"""
-    model = Ad
+    queryset = Ad.objects.select_related('category')  # Категория нужна для сброса кэша списка
     template_name = 'ads/ad_confirm_delete.html'
     context_object_name = 'ad'
 
     def test_func(self):
         # Проверяем, является ли текущий пользователь автором объявления
         ad = self.get_object()
-        return ad.user == self.request.user
+        return ad.user_id == self.request.user.id
 
     def handle_no_permission(self):
         # Если пользователь не имеет права удалять, выводим сообщение об ошибке
@@ -186,7 +356,8 @@ class CreateExchangeProposalView(LoginRequiredMixin, CreateView):
         form.instance.ad_receiver = ad_receiver
         form.instance.ad_sender = self.request.user.ads.first()  # Привязываем объявление отправителя
         messages.success(self.request, "Предложение обмена успешно отправлено!")
-        return super().form_valid(form)
+        with transaction.atomic():  # Предложение и счётчики объявлений (ads.counters) — вместе
+            return super().form_valid(form)
 
     def get_success_url(self):
         return reverse_lazy('exchange_proposals')
@@ -198,23 +369,33 @@ class CreateExchangeProposalView(LoginRequiredMixin, CreateView):
 
 
 # Обновление статуса предложения
-class UpdateExchangeProposalStatusView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
-    model = ExchangeProposal
+class UpdateExchangeProposalStatusView(LoginRequiredMixin, UserPassesTestMixin, CachedObjectMixin, UpdateView):
+    queryset = ExchangeProposal.objects.select_related('ad_sender', 'ad_receiver')
     fields = ['status']
     template_name = 'ads/exchange/update_proposal_status.html'
+    context_object_name = 'proposal'
     success_url = reverse_lazy('exchange_proposals')
 
     def test_func(self):
         proposal = self.get_object()
-        return proposal.ad_receiver.user == self.request.user
+        return proposal.ad_receiver.user_id == self.request.user.id
 
     def handle_no_permission(self):
         messages.error(self.request, "Вы не можете изменять статус своего предложения.")
         return redirect('exchange_proposals')
 
     def form_valid(self, form):
-        messages.success(self.request, f"Статус предложения изменен на: {form.instance.get_status_display()}.")
-        return super().form_valid(form)
+        # Переход через сервис: без гонок с другими принятиями и с отклонением конкурирующих предложений
+        try:
+            rejected = services.change_status(self.object, form.cleaned_data['status'])
+        except services.ProposalConflict as exc:
+            messages.error(self.request, str(exc))
+            return redirect(self.success_url)
+        message = f"Статус предложения изменен на: {self.object.get_status_display()}."
+        if rejected:
+            message += f" Отклонено конкурирующих предложений: {len(rejected)}."
+        messages.success(self.request, message)
+        return redirect(self.success_url)
 
 
 # Просмотр предложений
@@ -230,7 +411,12 @@ class ExchangeProposalListView(LoginRequiredMixin, ListView):
         filter_receiver = self.request.GET.get('receiver')
         filter_status = self.request.GET.get('status')
 
-        queryset = queryset.filter(Q(ad_sender__user=self.request.user) | Q(ad_receiver__user=self.request.user))
+        # Подзапрос по объявлениям пользователя вместо JOIN: СУБД ищет предложения
+        # по индексам ad_sender/ad_receiver, а не сканирует всю таблицу
+        user_ads = Ad.objects.filter(user=self.request.user).values('id')
+        queryset = queryset.filter(Q(ad_sender__in=user_ads) | Q(ad_receiver__in=user_ads))
+        # Шаблон выводит объявления и их авторов для каждой строки
+        queryset = queryset.select_related('ad_sender__user', 'ad_receiver__user')
 
         if filter_sender:
             queryset = queryset.filter(ad_sender__title__icontains=filter_sender)
@@ -246,12 +432,306 @@ class ExchangeProposalListView(LoginRequiredMixin, ListView):
         context['filter_sender'] = self.request.GET.get('sender', '')
         context['filter_receiver'] = self.request.GET.get('receiver', '')
         context['filter_status'] = self.request.GET.get('status', '')
+        # Обмены по кругу с участием пользователя (асинхронная версия загружает их заранее)
+        if not hasattr(self, 'barter_cycles'):
+            self.barter_cycles = cycles.group_steps(cycles.user_steps(self.request.user))
+        context['barter_cycles'] = self.barter_cycles
+        # Поток событий для живых обновлений есть только под ASGI (core.urls_asgi)
+        try:
+            context['events_url'] = reverse('proposal_events')
+        except NoReverseMatch:
+            context['events_url'] = None
         return context
 
 
-class AdViewSet(viewsets.ModelViewSet):
+class SavedSearchListView(LoginRequiredMixin, ListView):
+    """Сохранённые поиски пользователя и лента новых объявлений по ним"""
+    template_name = 'ads/saved_searches.html'
+    context_object_name = 'matches'
+    paginate_by = 20
+
+    def get_queryset(self):
+        return percolator.feed(self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['searches'] = percolator.with_unread(self.request.user.saved_searches.order_by('-id'))
+        return context
+
+
+class SaveSearchView(LoginRequiredMixin, View):
+    """Сохраняет текущий фильтр главной страницы"""
+
+    def post(self, request):
+        form = AdFilterForm(request.POST)
+        if form.is_valid():
+            form.cleaned_data.pop('ordering')  # Сортировка списка к поиску не относится
+            fields = percolator.normalize(**form.cleaned_data)
+        else:
+            fields = {}
+        if not any(fields.values()):
+            messages.error(request, "Укажите запрос, категорию или состояние.")
+        elif request.user.saved_searches.count() >= settings.ADS_SAVED_SEARCH_LIMIT:
+            messages.error(request, f"Можно сохранить не больше {settings.ADS_SAVED_SEARCH_LIMIT} поисков.")
+        else:
+            percolator.save_search(request.user, **fields)
+            messages.success(request, "Поиск сохранён: новые подходящие объявления появятся в ленте.")
+        return redirect('saved_searches')
+
+
+class DeleteSavedSearchView(LoginRequiredMixin, View):
+    def post(self, request, pk):
+        get_object_or_404(SavedSearch, pk=pk, user=request.user).delete()
+        messages.success(request, "Поиск удалён.")
+        return redirect('saved_searches')
+
+
+class ReadSavedSearchesView(LoginRequiredMixin, View):
+    """Отмечает ленту (или один поиск, ``?search=``) прочитанной"""
+
+    def post(self, request):
+        search = request.POST.get('search')
+        if search:
+            search = get_object_or_404(SavedSearch, pk=search, user=request.user)
+        percolator.mark_read(request.user, search or None)
+        return redirect('saved_searches')
+
+
+class ExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Потоковая выгрузка объявлений или предложений для персонала.
+
+    ``/export/ads/?format=csv|ndjson&gzip=1`` и фильтры главной страницы,
+    ``/export/proposals/?status=...``.
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, kind):
+        fmt = request.GET.get('format', 'csv')
+        if kind not in export.EXPORTS or fmt not in export.FORMATS:
+            raise Http404("Неизвестная выгрузка.")
+        compress = request.GET.get('gzip') == '1'
+        response = StreamingHttpResponse(
+            export.export(kind, fmt, request.GET, compress),
+            content_type='application/gzip' if compress else export.FORMATS[fmt],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{export.filename(kind, fmt, compress)}"'
+        return response
+
+
+class AdViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """Вьюсет для API"""
-    queryset = Ad.objects.all()
+    queryset = Ad.objects.select_related('category').order_by('-created_at')
     serializer_class = AdSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = AdKeysetPagination
+
+    def get_queryset(self):
+        queryset = self.get_fieldset().apply(super().get_queryset())
+        if self.action == 'list':
+            # Те же фильтры, что и на главной: ?query=&category=&condition=; сортировку задаёт пагинация
+            form = AdFilterForm(self.request.query_params)
+            if form.is_valid():
+                queryset = form.filter_queryset(queryset)
+        return queryset
+
+    def get_ordering(self):
+        """Сортировка списка для пагинации: по дате создания или ?ordering=popular"""
+        return AdFilterForm(self.request.query_params).get_ordering()
+
+    def get_fieldset(self):
+        """Поля ответа по ?fields=&expand= (ads.fieldsets); запись всегда отвечает полным объектом"""
+        if not hasattr(self, 'fieldset'):
+            self.fieldset = (
+                FieldSet.from_query(self.request.query_params, AdSerializer)
+                if self.request.method in SAFE_METHODS else FieldSet()
+            )
+        return self.fieldset
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'fieldset': self.get_fieldset()}
+
+    @extend_schema(parameters=FIELDSET_PARAMETERS)
+    def list(self, request, *args, **kwargs):
+        etag = conditional.list_etag(
+            request.query_params, self.paginator.get_page_size(request),
+            request.query_params.get(self.paginator.cursor_query_param), request.accepted_renderer.format,
+            *self.get_fieldset().variant,
+        )
+        response = conditional.precondition_response(request, etag)
+        if response is None:
+            # Строки собираются из values() без моделей и сериализатора на каждую
+            builder = RowBuilder(self.get_serializer().fields)
+            page = self.paginate_queryset(builder.queryset(self.filter_queryset(self.get_queryset())))
+            response = self.get_paginated_response(builder.rows(page))
+        return conditional.set_validators(response, etag)
+
+    @extend_schema(parameters=FIELDSET_PARAMETERS)
+    def retrieve(self, request, *args, **kwargs):
+        version = conditional.ad_version(kwargs['pk'])
+        if version is not None:
+            etag = self.get_etag(version)
+            response = conditional.precondition_response(request, etag, version)
+            if response is not None:
+                return conditional.set_validators(response, etag, version)
+        instance = self.get_object()
+        response = Response(self.get_serializer(instance).data)
+        version = conditional.version_of(instance)
+        return conditional.set_validators(response, self.get_etag(version), version)
+
+    def update(self, request, *args, **kwargs):
+        # If-Match: изменение применяется, только если клиент видел текущую версию
+        with transaction.atomic():
+            response = self.check_version(request)
+            if response is not None:
+                return response
+            response = super().update(request, *args, **kwargs)
+        if response.status_code == 200:
+            version = conditional.version_of(self.updated_instance)
+            conditional.set_validators(response, self.get_etag(version), version)
+        return response
+
+    def destroy(self, request, *args, **kwargs):
+        with transaction.atomic():
+            return self.check_version(request) or super().destroy(request, *args, **kwargs)
+
+    def check_version(self, request):
+        """Ответ 412, если If-Match или If-Unmodified-Since не совпадают с текущей версией"""
+        version = conditional.ad_version(self.kwargs['pk'], lock=True)
+        if version is None:
+            return None
+        return conditional.write_precondition_response(request, self.get_etag(version), version)
+
+    def get_etag(self, version):
+        return conditional.ad_etag(
+            self.kwargs['pk'], version, self.request.accepted_renderer.format, *self.get_fieldset().variant,
+        )
+
+    def perform_create(self, serializer):
+        with transaction.atomic():  # Новая категория — только вместе с объявлением
+            serializer.save(user=self.request.user)
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        self.updated_instance = serializer.instance
+
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """Похожие объявления (``?limit=``, не больше ``ADS_SIMILAR_LIMIT`` × 4)"""
+        try:
+            limit = min(max(int(request.query_params.get('limit', settings.ADS_SIMILAR_LIMIT)), 1),
+                        settings.ADS_SIMILAR_LIMIT * 4)
+        except ValueError:
+            limit = settings.ADS_SIMILAR_LIMIT
+        ads = recommendations.similar_ads(self.get_object(), limit)
+        prefetch_related_objects(ads, *self.get_fieldset().expand)
+        return Response(self.get_serializer(ads, many=True).data)
+
+    @action(detail=False)
+    def facets(self, request):
+        """Число объявлений по категориям и состояниям"""
+        data = facet_counts()
+        return Response({
+            'categories': CategoryFacetSerializer(data['categories'], many=True).data,
+            'conditions': data['conditions'],
+        })
+
+
+class BarterCycleViewSet(viewsets.ReadOnlyModelViewSet):
+    """Обмены по кругу с участием текущего пользователя"""
+    serializer_class = BarterCycleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):  # Генерация схемы OpenAPI
+            return BarterCycle.objects.none()
+        steps = BarterCycleStep.objects.select_related('proposal__ad_sender__user', 'proposal__ad_receiver__user')
+        return (
+            BarterCycle.objects.filter(steps__proposal__ad_sender__user=self.request.user)
+            .prefetch_related(Prefetch('steps', queryset=steps))
+            .order_by('-created_at')
+        )
+
+
+class SavedSearchViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
+    """Сохранённые поиски текущего пользователя с числом непрочитанных в ленте"""
+    serializer_class = SavedSearchSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = None
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):  # Генерация схемы OpenAPI
+            return SavedSearch.objects.none()
+        return percolator.with_unread(self.request.user.saved_searches.order_by('-id'))
+
+    @extend_schema(responses=SavedSearchMatchSerializer(many=True))
+    @action(detail=False)
+    def feed(self, request):
+        """Лента новых объявлений по всем поискам (``?search=`` — по одному), новые первыми"""
+        search = request.query_params.get('search')
+        if search:
+            search = self.get_queryset().filter(pk=search).first()
+            if search is None:
+                raise NotFound("Поиск не найден.")
+        paginator = FeedPagination()
+        page = paginator.paginate_queryset(percolator.feed(request.user, search or None), request, self)
+        return paginator.get_paginated_response(SavedSearchMatchSerializer(page, many=True).data)
+
+    @extend_schema(request=None, responses={204: None})
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """Отметить ленту поиска прочитанной"""
+        percolator.mark_read(request.user, self.get_object())
+        return Response(status=204)
+
+
+class ExchangeProposalViewSet(viewsets.ReadOnlyModelViewSet):
+    """Предложения обмена с объявлениями текущего пользователя.
+
+    Получатель принимает (``accept``) или отклоняет (``reject``) предложение,
+    в том числе сразу несколько (``bulk``); см. ``ads.services``.
+    """
+    serializer_class = ExchangeProposalSerializer
+    permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):  # Генерация схемы OpenAPI
+            return ExchangeProposal.objects.none()
+        user_ads = Ad.objects.filter(user=self.request.user).values('id')
+        return (
+            ExchangeProposal.objects.filter(Q(ad_sender__in=user_ads) | Q(ad_receiver__in=user_ads))
+            .select_related('ad_receiver').order_by('-created_at', '-id')
+        )
+
+    @extend_schema(request=None, responses={200: ProposalTransitionSerializer, 409: None})
+    @action(detail=True, methods=['post'])
+    def accept(self, request, pk=None):
+        """Принять предложение; остальные ожидающие предложения с обоими объявлениями отклоняются"""
+        return self.transition('accepted')
+
+    @extend_schema(request=None, responses={200: ProposalTransitionSerializer, 409: None})
+    @action(detail=True, methods=['post'])
+    def reject(self, request, pk=None):
+        return self.transition('rejected')
+
+    def transition(self, status):
+        proposal = self.get_object()
+        if proposal.ad_receiver.user_id != self.request.user.id:
+            raise PermissionDenied("Статус предложения меняет только его получатель.")
+        try:
+            rejected = services.change_status(proposal, status)
+        except services.ProposalConflict as exc:
+            return Response({'detail': str(exc)}, status=409)
+        return Response({'id': proposal.pk, 'status': proposal.status, 'rejected': rejected})
+
+    @extend_schema(request=ProposalBulkSerializer, responses=ProposalBulkResponseSerializer)
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Принять или отклонить несколько входящих предложений одним запросом"""
+        serializer = ProposalBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = services.change_status_many(
+            request.user, serializer.validated_data['ids'], serializer.validated_data['status'],
+        )
+        return Response({'results': results})
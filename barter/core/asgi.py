@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+os.environ.setdefault('BARTER_ASGI', '1')  # Маршруты core.urls_asgi (с потоком событий)
 
 application = get_asgi_application()
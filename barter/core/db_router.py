@@ -0,0 +1,174 @@
+"""Чтение с реплик БД с «прилипанием» к основной базе после записи.
+
+Реплики перечислены в ``settings.DATABASE_REPLICAS``. Читают с них только
+страницы, явно помеченные ``replica_reads()`` (список, объявление, API), и
+только модели приложения ``ads``; остальное, в том числе сессии и
+пользователи, всегда идёт в ``default``.
+
+Реплика выбирается один раз на блок ``replica_reads()`` — при первом
+чтении, тогда же проверяется соединение с ней, — поэтому число строк,
+страница и фасеты одного ответа читаются с одной реплики с одним отставанием.
+
+После записи объявлений ``ReplicaPinMiddleware`` ставит cookie, и следующие
+``ADS_REPLICA_STICKY_SECONDS`` секунд запросы этого клиента читают с
+основной базы: пользователь сразу видит свои изменения, даже если реплика
+отстаёт. Недоступная реплика пропускается на ``ADS_REPLICA_RETRY_SECONDS``;
+если реплика отказала посреди запроса (``OperationalError``), страница
+повторяет его на основной базе (``ReplicaReadMixin``), а реплики, с которых
+он читал, пропускаются тот же срок.
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.connection import ConnectionDoesNotExist
+
+PIN_COOKIE = 'barter_primary'
+REPLICA_APPS = {'ads'}
+
+logger = logging.getLogger(__name__)
+
+_replica_reads = ContextVar('replica_reads', default=None)  # ReplicaReads блока replica_reads()
+_request_state = ContextVar('replica_request_state', default=None)
+_unavailable_until = {}  # alias -> time.monotonic(), до которого реплика пропускается
+
+
+class ReplicaReads:
+    """Реплика блока ``replica_reads()``: выбирается при первом чтении и не меняется"""
+
+    def __init__(self):
+        self.chosen = False
+        self.alias = None  # None — реплик нет, чтение с основной базы
+        self.used = set()  # Реплики, с которых уже читали
+
+
+class RequestState:
+    """Состояние запроса: привязан ли клиент к основной базе и была ли запись"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+@contextmanager
+def replica_reads():
+    """Разрешает чтение с реплик внутри блока; отдаёт множество выбранных реплик"""
+    reads = ReplicaReads()
+    token = _replica_reads.set(reads)
+    try:
+        yield reads.used
+    finally:
+        _replica_reads.reset(token)
+
+
+def fail_over(aliases):
+    """Пропускать реплики ``ADS_REPLICA_RETRY_SECONDS``: запрос к ним упал"""
+    logger.warning('Реплики %s отказали посреди запроса, чтение идёт с основной базы', ', '.join(sorted(aliases)))
+    for alias in aliases:
+        _unavailable_until[alias] = time.monotonic() + settings.ADS_REPLICA_RETRY_SECONDS
+
+
+@contextmanager
+def detached():
+    """Служебная работа вне состояния запроса: её записи не привязывают клиента к основной базе"""
+    reads, state = _replica_reads.set(None), _request_state.set(None)
+    try:
+        yield
+    finally:
+        _request_state.reset(state)
+        _replica_reads.reset(reads)
+
+
+@contextmanager
+def request_state(pinned=False):
+    state = RequestState(pinned)
+    token = _request_state.set(state)
+    try:
+        yield state
+    finally:
+        _request_state.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state, reads = _request_state.get(), _replica_reads.get()
+        if reads is None or model._meta.app_label not in REPLICA_APPS:
+            return None
+        if state is not None and (state.pinned or state.wrote):
+            return DEFAULT_DB_ALIAS
+        if not reads.chosen:
+            reads.alias, reads.chosen = self.choose_replica(), True
+        if reads.alias is None:
+            return DEFAULT_DB_ALIAS
+        reads.used.add(reads.alias)
+        return reads.alias
+
+    def choose_replica(self):
+        """Случайная доступная реплика; соединение проверяется только у выбранной"""
+        now = time.monotonic()
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if _unavailable_until.get(alias, 0) <= now]
+        random.shuffle(replicas)
+        return next((alias for alias in replicas if self.is_available(alias)), None)
+
+    def is_available(self, alias):
+        try:
+            connections[alias].ensure_connection()
+        except (ConnectionDoesNotExist, DatabaseError):
+            _unavailable_until[alias] = time.monotonic() + settings.ADS_REPLICA_RETRY_SECONDS
+            return False
+        return True
+
+    def db_for_write(self, model, **hints):
+        # Сессии и пользователи с реплик не читаются, и их запись не привязывает клиента
+        state = _request_state.get()
+        if state is not None and model._meta.app_label in REPLICA_APPS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На репликах те же данные, что в основной базе
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Реплики получают схему вместе с данными от основной базы
+        return db not in settings.DATABASE_REPLICAS
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def pin(response, state):
+    if state.wrote and settings.DATABASE_REPLICAS:
+        timeout = settings.ADS_REPLICA_STICKY_SECONDS
+        response.set_cookie(PIN_COOKIE, str(time.time() + timeout), max_age=timeout, httponly=True, samesite='Lax')
+    return response
+
+
+class ReplicaPinMiddleware:
+    """Привязывает клиента к основной базе на время после его записи"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with request_state(is_pinned(request)) as state:
+            return pin(self.get_response(request), state)
+
+    async def __acall__(self, request):
+        with request_state(is_pinned(request)) as state:
+            return pin(await self.get_response(request), state)
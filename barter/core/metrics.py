@@ -0,0 +1,347 @@
+"""Метрики запросов по view в формате Prometheus (``/metrics``).
+
+``MetricsMiddleware`` для каждого запроса записывает в реестр процесса
+число запросов, гистограммы длительности и размера ответа, число и время
+запросов к БД с меткой ``view`` — имя маршрута (``ad_list``, ``ad-detail``).
+Запросы к БД считает обёртка ``execute_wrapper``, которая ставится на каждое
+соединение и пишет в счётчики текущего запроса (``contextvars``, поэтому
+учитываются и запросы асинхронного ORM из потоков ``sync_to_async``).
+
+При нескольких процессах-воркерах задайте ``METRICS_DIR``: каждый процесс
+раз в ``METRICS_FLUSH_SECONDS`` сохраняет снимок своего реестра в файл
+``<pid>-<метка процесса>.json``, а ``/metrics`` складывает снимки всех
+процессов. Снимок завершившегося процесса (при выходе или, если процесс
+убит, при следующем сборе ``/metrics``) прибавляется к ``retired.json`` и
+удаляется: файлы не копятся, а счётчики не убывают ни при перезапуске
+воркеров, ни при повторном pid. Каталог — один на машину (проверка pid), на
+Windows снимки не сводятся и остаются в каталоге.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Имя: (тип, описание, границы гистограммы)
+METRICS = {
+    'barter_requests_total': ('counter', 'Число обработанных запросов', None),
+    'barter_request_duration_seconds': ('histogram', 'Время обработки запроса', LATENCY_BUCKETS),
+    'barter_response_size_bytes': ('histogram', 'Размер тела ответа (кроме потоковых)', SIZE_BUCKETS),
+    'barter_db_queries_per_request': ('histogram', 'Запросов к БД на один запрос', QUERY_BUCKETS),
+    'barter_db_queries_total': ('counter', 'Число запросов к БД', None),
+    'barter_db_query_seconds_total': ('counter', 'Суммарное время запросов к БД', None),
+}
+
+RETIRED_FILE = 'retired.json'  # Сумма снимков завершившихся процессов
+LOCK_FILE = '.lock'
+
+_request = ContextVar('metrics_request', default=None)
+_process = {}  # pid -> метка процесса (у потомка после fork свой pid и своя метка)
+
+
+class RequestMetrics:
+    """Счётчики запросов к БД в рамках одного HTTP-запроса"""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+class Registry:
+    """Счётчики и гистограммы процесса; изменения под одной блокировкой"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам..., сумма, количество]
+        self.flushed_at = 0.0
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self.lock:
+            state = self.histograms.get(key)
+            if state is None:
+                state = self.histograms[key] = [0] * (len(buckets) + 3)
+            state[bisect_left(buckets, value)] += 1  # Последняя корзина — +Inf
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), list(state)] for (name, labels), state in self.histograms.items()],
+            }
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+
+
+def merge(snapshots):
+    """Складывает снимки реестров разных процессов; возвращает ``(counters, histograms)``"""
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, state in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], state)]
+            else:
+                histograms[key] = list(state)
+    return counters, histograms
+
+
+def as_snapshot(counters, histograms):
+    """Обратно к формату ``Registry.snapshot`` (для ``retired.json``)"""
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, state] for (name, labels), state in histograms.items()],
+    }
+
+
+def format_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(counters, histograms):
+    """Текстовый формат Prometheus 0.0.4"""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+            continue
+        for (metric, labels), state in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], state):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(state[-2])}')
+            lines.append(f'{name}_count{format_labels(labels)} {state[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot_path():
+    pid = os.getpid()
+    if pid not in _process:
+        _process[pid] = uuid.uuid4().hex[:12]
+    return Path(settings.METRICS_DIR) / f'{pid}-{_process[pid]}.json'
+
+
+def snapshot_pid(path):
+    """pid процесса по имени файла снимка; None — не снимок процесса"""
+    pid = path.stem.partition('-')[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Процесс есть, но чужой
+    return True
+
+
+def read(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None  # Файл удалили во время чтения
+
+
+def write(path, snapshot):
+    temporary = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    temporary.write_text(json.dumps(snapshot))
+    os.replace(temporary, path)  # Читатель не увидит недописанный файл
+
+
+@contextmanager
+def locked(directory):
+    """Исключительная блокировка каталога снимков между процессами"""
+    with open(directory / LOCK_FILE, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def retire(paths):
+    """Прибавляет снимки к ``retired.json`` и удаляет их (вызывать под ``locked``)"""
+    directory = Path(settings.METRICS_DIR)
+    snapshots = [snapshot for snapshot in map(read, paths) if snapshot is not None]
+    if not snapshots:
+        return
+    write(directory / RETIRED_FILE, as_snapshot(*merge([read(directory / RETIRED_FILE) or {
+        'counters': [], 'histograms': [],
+    }, *snapshots])))
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def prune(directory):
+    """Сводит снимки завершившихся процессов, в том числе прежнего владельца нашего pid"""
+    own = snapshot_path()
+    retire([
+        path for path in directory.glob('*.json')
+        if (pid := snapshot_pid(path)) is not None and path != own and (pid == os.getpid() or not is_alive(pid))
+    ])
+
+
+def flush(force=False):
+    """Сохраняет снимок реестра процесса в ``METRICS_DIR`` (не чаще ``METRICS_FLUSH_SECONDS``)"""
+    if not settings.METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - registry.flushed_at < settings.METRICS_FLUSH_SECONDS:
+        return
+    registry.flushed_at = now
+    path = snapshot_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write(path, registry.snapshot())
+
+
+@atexit.register
+def shutdown():
+    """Переносит снимок останавливающегося процесса в ``retired.json``"""
+    if not settings.configured or not settings.METRICS_DIR or fcntl is None or not registry.counters:
+        return  # Процесс без запросов снимок не писал
+    flush(force=True)
+    with locked(Path(settings.METRICS_DIR)):
+        retire([snapshot_path()])
+
+
+def collect():
+    if not settings.METRICS_DIR:
+        return merge([registry.snapshot()])
+    flush(force=True)
+    directory = Path(settings.METRICS_DIR)
+    if fcntl is None:
+        return merge(filter(None, map(read, directory.glob('*.json'))))
+    # Под блокировкой: снимок не попадёт в сумму дважды — и в retired.json, и своим файлом
+    with locked(directory):
+        prune(directory)
+        return merge(filter(None, map(read, directory.glob('*.json'))))
+
+
+def record_query(execute, sql, params, many, context):
+    state = _request.get()
+    if state is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        state.queries += 1
+        state.query_time += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_wrapper(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def record(request, response, state, started):
+    duration = time.perf_counter() - started
+    view = (('view', view_name(request)),)
+    registry.inc('barter_requests_total', (*view, ('method', request.method), ('status', str(response.status_code))))
+    registry.observe('barter_request_duration_seconds', view, duration)
+    registry.observe('barter_db_queries_per_request', view, state.queries)
+    registry.inc('barter_db_queries_total', view, state.queries)
+    registry.inc('barter_db_query_seconds_total', view, state.query_time)
+    if not response.streaming:
+        registry.observe('barter_response_size_bytes', view, len(response.content))
+    flush()
+    return response
+
+
+class MetricsMiddleware:
+    """Записывает метрики каждого запроса (стоит первым, чтобы учитывать все middleware)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, started = RequestMetrics(), time.perf_counter()
+        token = _request.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        return record(request, response, state, started)
+
+    async def __acall__(self, request):
+        state, started = RequestMetrics(), time.perf_counter()
+        token = _request.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.reset(token)
+        return record(request, response, state, started)
+
+
+def metrics_view(request):
+    """Метрики для Prometheus: доступны с адресов ``METRICS_ALLOWED_IPS`` и персоналу"""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(exposition(*collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
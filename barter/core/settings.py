@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,7 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',  # Первым: время запроса с учётом всех middleware
     'django.middleware.security.SecurityMiddleware',
+    'core.db_router.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -53,7 +56,14 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'core.urls'
+# Под ASGI (core/asgi.py задаёт BARTER_ASGI) добавляется поток событий предложений. Асинхронные
+# view для чтения — только с BARTER_ASYNC_VIEWS=1: на SQLite они медленнее синхронных (bench_concurrency)
+if os.environ.get('BARTER_ASYNC_VIEWS'):
+    ROOT_URLCONF = 'core.urls_async'
+elif os.environ.get('BARTER_ASGI'):
+    ROOT_URLCONF = 'core.urls_asgi'
+else:
+    ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
     {
@@ -83,6 +93,51 @@ DATABASES = {
     }
 }
 
+# Профили основной базы, выбираются BARTER_DB_PROFILE (прагмы применяет core/sqlite.py)
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'CONN_MAX_AGE': 600,  # Соединение переиспользуется между запросами
+        'CONN_HEALTH_CHECKS': True,  # и проверяется перед каждым запросом
+        # BEGIN IMMEDIATE: писатель сразу берёт блокировку и ждёт busy_timeout,
+        # а не получает «database is locked» при повышении блокировки
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        'PRAGMAS': {
+            'journal_mode': 'WAL',  # Читатели не блокируются писателем
+            'synchronous': 'NORMAL',  # В WAL данные не теряются при сбое приложения
+            'busy_timeout': 5000,  # мс ожидания блокировки
+            'cache_size': -64000,  # Кэш страниц, КиБ
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+DATABASES['default'].update(SQLITE_PROFILES[os.environ.get('BARTER_DB_PROFILE', 'default')])
+
+# Реплики только для чтения (см. core/db_router.py). Локально — копии SQLite,
+# которые обновляет manage.py sync_replicas:
+# BARTER_DB_REPLICAS=db_replica1.sqlite3,db_replica2.sqlite3
+DATABASE_REPLICAS = []
+for number, name in enumerate(filter(None, os.environ.get('BARTER_DB_REPLICAS', '').split(',')), 1):
+    DATABASES[f'replica{number}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f'file:{BASE_DIR / name.strip()}?mode=ro',
+        'OPTIONS': {'uri': True},
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+DATABASE_ROUTERS = ['core.db_router.ReplicaRouter']
+ADS_REPLICA_STICKY_SECONDS = 5  # Сколько секунд после записи клиент читает с основной базы
+ADS_REPLICA_RETRY_SECONDS = 30  # Через сколько секунд снова пробовать недоступную реплику
+
+# Метрики Prometheus (core/metrics.py). При нескольких процессах-воркерах задайте
+# общий каталог BARTER_METRICS_DIR (один на машину): /metrics сложит снимки всех
+# процессов, снимки завершившихся сводятся в retired.json, и счётчики не сбрасываются
+METRICS_DIR = os.environ.get('BARTER_METRICS_DIR') or None
+METRICS_FLUSH_SECONDS = 5
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -131,9 +186,81 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# Режим пагинации списка объявлений: 'page' — номера страниц,
+# 'cursor' — keyset-пагинация по (created_at, id) без COUNT(*)
+ADS_LIST_PAGINATION = 'page'
+
+# Время жизни страниц списка объявлений в кэше для анонимных посетителей,
+# секунды (0 — не кэшировать). Кэш — CACHES['default']; для нескольких
+# процессов нужен общий бэкенд (Redis, Memcached), иначе кэш у каждого свой
+ADS_LIST_CACHE_TIMEOUT = 60
+
+# Время жизни кэшированных карточек и страниц объявлений, секунды (0 — не
+# кэшировать). Ключ включает updated_at, поэтому срок может быть долгим
+ADS_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Массовые операции API (/api/ads/bulk/): строк в одном запросе к БД
+# по умолчанию (меняется параметром ?chunk_size=) и элементов в одном запросе
+ADS_BULK_CHUNK_SIZE = 500
+ADS_BULK_MAX_ITEMS = 5000
+
+# Обмены по кругу среди ожидающих предложений (ads/cycles.py)
+ADS_CYCLE_MAX_LENGTH = 4  # Участников в одном обмене
+ADS_CYCLE_MAX_RESULTS = 10  # Циклов, сохраняемых для одного нового предложения
+ADS_CYCLE_MAX_NODES = 50_000  # Предел окрестности при обходе графа
+
+# Похожие объявления (ads/recommendations.py)
+ADS_SIMILAR_LIMIT = 6  # Объявлений на странице и в API по умолчанию
+ADS_SIMILAR_TERMS = 8  # Слов объявления в запросе к полнотекстовому индексу
+ADS_SIMILAR_CANDIDATES = 500  # Лучших по bm25 совпадений, для которых считается итоговая оценка
+ADS_SIMILAR_CACHE_TIMEOUT = 60 * 5  # Список похожих для версии объявления, секунды
+ADS_SIMILAR_STATS_TIMEOUT = 60 * 60  # Число объявлений со словом, секунды
+
+# Сохранённые поиски (ads/percolator.py)
+ADS_SAVED_SEARCH_LIMIT = 50  # Поисков у одного пользователя
+
+# Очередь фоновых задач в основной базе (ads/jobs.py, manage.py run_workers)
+ADS_JOBS_BATCH_SIZE = 20  # Задач, которые воркер забирает за раз
+ADS_JOBS_POLL_INTERVAL = 1.0  # Пауза воркера при пустой очереди, секунды
+ADS_JOBS_MAX_ATTEMPTS = 5
+ADS_JOBS_BACKOFF_BASE = 5  # Пауза перед второй попыткой, секунды; дальше удваивается
+ADS_JOBS_BACKOFF_MAX = 60 * 60
+ADS_JOBS_LEASE_SECONDS = 60 * 10  # Через сколько задачи упавшего воркера возвращаются в очередь
+# Выполнять задачи сразу при постановке, без очереди и воркеров (разработка и тесты).
+# В production выключите и запустите manage.py run_workers, иначе задачи не выполнятся
+ADS_JOBS_EAGER = DEBUG
+
+# События предложений для открытых страниц, Server-Sent Events (ads/events.py, только ASGI).
+# LocalChannel доставляет события в пределах процесса; для нескольких
+# ASGI-процессов нужен канал через общий брокер (подкласс ads.events.Channel)
+ADS_EVENTS_CHANNEL = 'ads.events.LocalChannel'
+ADS_EVENTS_BUFFER = 100  # Недоставленных событий на соединение, дальше — resync
+ADS_EVENTS_HEARTBEAT = 15  # Комментарий-пинг простаивающему соединению, секунды
+ADS_EVENTS_RETRY_MS = 3000  # Пауза браузера перед переподключением
+
+# Просмотры объявлений (ads/viewcounts.py): копятся в памяти процесса и пишутся
+# одним UPDATE раз в интервал; при падении процесса теряется не больше интервала
+ADS_VIEWS_FLUSH_INTERVAL = 10  # Секунды между записями
+ADS_VIEWS_MAX_PENDING = 1000  # Объявлений в буфере, после которых запись не ждёт интервала
+
+# Популярные объявления, ?ordering=popular (ads/popularity.py, manage.py update_popularity).
+# Вес — входящие предложения и просмотры, затухающие вдвое за HALF_LIFE секунд
+ADS_POPULAR_HALF_LIFE = 60 * 60 * 24 * 3
+ADS_POPULAR_PROPOSAL_WEIGHT = 10  # Одно входящее предложение весит как столько просмотров
+ADS_POPULAR_VIEW_WEIGHT = 1
+ADS_POPULAR_CHUNK_SIZE = 1000  # Объявлений в одной транзакции пересчёта
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Barter API',
     'DESCRIPTION': 'API для платформы обмена объявлениями.',
     'VERSION': '1.0.0',
     'SERVE_INCLUDE_SCHEMA': False,
+    # Несколько полей status с разными наборами значений: имена перечислений задаются явно,
+    # чтобы схема не зависела от порядка обхода (manage.py spectacular --validate --fail-on-warn)
+    'ENUM_NAME_OVERRIDES': {
+        'ProposalStatusEnum': 'ads.models.ExchangeProposal.STATUS_CHOICES',
+        'TransitionStatusEnum': 'ads.serializers.TRANSITION_STATUSES',
+        'BulkStatusEnum': 'ads.serializers.BULK_STATUSES',
+        'ProposalBulkStatusEnum': 'ads.serializers.PROPOSAL_BULK_STATUSES',
+    },
 }
@@ -0,0 +1,21 @@
+"""Настройка соединений SQLite под профиль из ``settings.SQLITE_PROFILES``.
+
+Прагмы из ``DATABASES[alias]['PRAGMAS']`` выполняются для каждого нового
+соединения (сигнал ``connection_created``): большинство из них действует
+только в пределах соединения, поэтому задать их один раз в файле БД нельзя.
+"""
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def apply_pragmas(connection, pragmas):
+    """Выполняет ``PRAGMA name = value`` для курсора или соединения sqlite3"""
+    for name, value in pragmas.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor == 'sqlite' and pragmas:
+        apply_pragmas(connection.connection, pragmas)
@@ -3,8 +3,11 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),  # Админка Django
+    path('metrics', metrics_view, name='metrics'),  # Метрики Prometheus
     path('', include('ads.urls')),    # Подключаем маршруты из приложения ads
     path('api/', include('ads.api')),  # Маршруты API
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),  # Схема OpenAPI
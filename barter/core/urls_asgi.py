@@ -0,0 +1,14 @@
+"""Маршруты под ASGI по умолчанию (см. core/asgi.py).
+
+Те же синхронные страницы, что в core.urls, и поток событий предложений
+(Server-Sent Events): под WSGI каждое его соединение занимало бы поток.
+"""
+from django.urls import path
+
+from ads import async_views
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('events/proposals/', async_views.ProposalEventsView.as_view(), name='proposal_events'),
+] + sync_urlpatterns
@@ -0,0 +1,18 @@
+"""Маршруты с асинхронными view для чтения (BARTER_ASYNC_VIEWS=1, см. settings).
+
+Страницы и API для чтения обслуживают view из ads.async_views, остальное —
+маршруты core.urls_asgi.
+"""
+from django.urls import path
+
+from ads import async_views
+
+from .urls_asgi import urlpatterns as asgi_urlpatterns
+
+urlpatterns = [
+    path('', async_views.AdListAsyncView.as_view(), name='ad_list'),
+    path('<int:pk>/', async_views.AdDetailAsyncView.as_view(), name='ad_detail'),
+    path('proposals/', async_views.ExchangeProposalListAsyncView.as_view(), name='exchange_proposals'),
+    path('api/ads/', async_views.AdApiListAsyncView.as_view(), name='ad-list'),
+    path('api/ads/<int:pk>/', async_views.AdApiDetailAsyncView.as_view(), name='ad-detail'),
+] + asgi_urlpatterns